@@ -23,11 +23,15 @@ module contents are automatically imported directly into iesh's
 namespace on startup."""
 
 import cPickle
+import multiprocessing
 import os.path
 import sys
 import traceback
 
 from infinity import core
+from infinity import snapshot
+from infinity.extract import extract_objects
+from infinity.scripts import build_script_index, get_script_index
 from infinity.stream import ResourceStream, FileStream, OverrideStream
 
 ###################################################
@@ -37,7 +41,11 @@ def load_game (game_dir, chitin_file = None, dialog_file = None):
     The `game_dir' parameter is mandatory, the others are optional.
     Many commands assume that these two files are
     already loaded. The loaded objects are stored in core.keys, core.override
-    and core.strrefs."""
+    and core.strrefs.
+
+    The loaded data are saved into a snapshot file in `game_dir' (see
+    the core.snapshot_file option) and restored from it next time, unless
+    any of the files it was built from changed."""
 
     if chitin_file is None:
         chitin_file = core.get_option ('core.chitin_file')
@@ -45,6 +53,14 @@ def load_game (game_dir, chitin_file = None, dialog_file = None):
     if dialog_file is None:
         dialog_file = core.get_option ('core.dialog_file')
 
+    snapshot_file = core.get_option ('core.snapshot_file')
+    if snapshot_file:
+        snapshot_file = os.path.join (game_dir, snapshot_file)
+        if snapshot.load_snapshot (snapshot_file, game_dir, chitin_file, dialog_file):
+            print("Game data restored from %s" %snapshot_file)
+            return
+
+    core.flush_caches ()
     core.game_dir = game_dir
     core.game_data_path = game_dir
     core.override_dir = core.locate_override ()
@@ -81,22 +97,30 @@ def load_game (game_dir, chitin_file = None, dialog_file = None):
     print("Detecting game type...")
     core.game_type = core.detect_game_type ()
 
+    if snapshot_file:
+        try:
+            snapshot.save_snapshot (snapshot_file)
+        except EnvironmentError as e:
+            print("Could not save snapshot: %s" %e)
+
 ###################################################
 def save_state (filename):
     """Saves some core variables (especially keys and strrefs), so that they
-    can be later loaded faster than from IE data files."""
-    data = [core.game_dir, core.override, core.override_dir, core.chitin_file,
-            core.dialog_file, core.keys, core.strrefs, core.game_data_path,
-            core.game_type
-            ]
-    fh = open (filename,  'w')
-    cPickle.dump (data,  fh)
-    fh.close ()
+    can be later loaded faster than from IE data files.
+
+    The state is saved as a snapshot, see infinity.snapshot."""
+    snapshot.save_snapshot (filename)
 
 ###################################################
 def restore_state (filename):
     """Loads some core variables (especially keys and strrefs) saved
     by save_state() function, much faster than from IE data files."""
+    if snapshot.is_snapshot (filename):
+        if not snapshot.load_snapshot (filename):
+            raise RuntimeError ("Snapshot %s is out of date or damaged" %filename)
+        return
+
+    # pickled state from older versions
     fh = open (filename)
     data = cPickle.load (fh)
     fh.close ()
@@ -111,17 +135,17 @@ def restore_state (filename):
     else:
         core.game_dir, core.override, core.override_dir, core.chitin_file, \
         core.dialog_file, core.keys, core.strrefs, core.game_data_path, core.game_type = data
+        # the pickled override is a plain list of records
+        if core.override_dir is not None:
+            core.override = core.load_override ()
 
 ###################################################
 def find_objects (name, filetype = None):
     """Look up named objects in game's data or in the override directory."""
 
     filetype = core.ext_to_type(filetype)
-    override_obj = core.search_override (name, filetype)
-    resref_obj = core.keys.get_resref_by_name (name)
-
-    if filetype is not None:
-        resref_obj = filter (lambda o: o['type'] == filetype, resref_obj)
+    override_obj = core.override is not None and core.search_override (name, filetype)
+    resref_obj = core.keys.get_resref_by_name_and_type (name, filetype)
 
     if override_obj:
         print ("Override:")
@@ -144,7 +168,7 @@ def find_objects (name, filetype = None):
         print "Nothing found in game data!"
 
 ###################################################
-def load_object (name, type = None, index = 0, ignore_override = False):
+def load_object (name, type = None, index = 0, ignore_override = False, cache = False):
     """Load named object from a file located in filesystem or in game's data.
 
     Load file or resref `name' and return Format object of appropriate type.
@@ -152,7 +176,30 @@ def load_object (name, type = None, index = 0, ignore_override = False):
     `index' if there's still more than one.
 
     If you want to avoid the override folder, specify the appropriate value for
-    `ignore_override' parameter."""
+    `ignore_override' parameter.
+
+    Each call returns a new object, which can be modified freely. With
+    `cache' True, loaded objects are cached and loading the same object
+    again returns the same instance, until the file it was loaded from
+    changes, which saves time in scans which don't modify the objects."""
+
+    if cache:
+        # cache key: (name, type, source, index), objects loaded from files are
+        #   valid while the file's mtime doesn't change
+        filetype = core.ext_to_type (type)
+        key = path = None
+        if not ignore_override:
+            found = core.override is not None and core.search_override (name, filetype) or []
+            if index < len (found) and (len (found) == 1 or filetype is not None):
+                key, path = (name.upper (), filetype, 'override', index), found[index]['path']
+            elif os.path.isfile (name):
+                key, path = (os.path.abspath (name), None, 'file', 0), name
+        if key is None:
+            key = (name.upper (), filetype, 'bif', index)
+
+        res = core.get_cached_object (key, path)
+        if res is not None:
+            return res
 
     stream = None
 
@@ -175,6 +222,8 @@ def load_object (name, type = None, index = 0, ignore_override = False):
             return None
 
     res = stream.load_object ()
+    if cache:
+        core.cache_object (key, res, len (stream.buffer or ''), path)
     stream.close ()
     return res
 
@@ -182,7 +231,7 @@ def load_object (name, type = None, index = 0, ignore_override = False):
 def print_object (name, type = None,  index = 0):
     """Load and print named object. See `load_object()' for details."""
 
-    obj = load_object (name,  type,  index)
+    obj = load_object (name,  type,  index, cache = True)
     obj.printme ()
 
 ###################################################
@@ -212,6 +261,27 @@ def export_object (name, filename, type = None, index = 0, ignore_override=False
 
 
 ###################################################
+def init_object_worker ():
+    # BIF files opened by the parent share file offsets with it
+    core.bif_files.flush ()
+
+def load_object_chunk (chunk):
+    """Load resources in list of (position, name, type) `chunk' in a worker
+    of ObjectIterator. Return list of (position, object, error), where
+    error is None or (exception, message, traceback) strings."""
+    res = []
+    for pos, name, type in chunk:
+        try:
+            obj = ResourceStream ().open (name, type).load_object ()
+            res.append ((pos, obj, None))
+        except Exception, e:
+            try:
+                cPickle.dumps (e, 2)
+            except Exception:
+                e = RuntimeError (str (e))
+            res.append ((pos, None, (e, traceback.format_exception_only (sys.exc_type, sys.exc_value), traceback.format_exc ())))
+    return res
+
 class ObjectIterator:
     """Iterate over specified resrefs, load them as objects and generate pairs (resref, object).
 
@@ -222,7 +292,16 @@ class ObjectIterator:
              resrefs which should be selected
     sort - fiels name to sort on or ref to function which compares two resrefs
     error=[ignore|msg|traceback|throw|<fn>] - how to handle errors during a loading of a resref
-    names=all - print resref names as they are loaded."""
+    names=all - print resref names as they are loaded.
+    workers=<num> - load the objects in a pool of `num' processes
+    ordered=[True|False] - with workers, generate the pairs in order of the resrefs,
+             or as soon as they are loaded
+    chunk=<num> - with workers, max # of resrefs loaded by a worker at once
+
+    With workers, resrefs are split into chunks of resrefs from the same
+    BIF file, so that each worker opens each BIF file just once (keep the
+    'use_cache' option on). Objects are sent back to the iterating process,
+    so the `error' function gets None for the object."""
 
     # FIXME: this function opens and decodes a bif file EACH time some
     #   object from it is accessed, unless you set 'use_cache' option
@@ -231,13 +310,13 @@ class ObjectIterator:
     #   print the label
 
     def __init__ (self, **kw):
-        self.resrefs = core.keys.resref_list[:]
-
         if 'type' in kw and type (kw['type']) == type (1):
-            self.resrefs = filter (lambda r, t=kw['type']: r['type'] == t, self.resrefs)
+            self.resrefs = core.keys.get_resref_by_type (kw['type'])
         elif 'type' in kw:
             tid = core.find_res_type (name=kw['type'])[0][0]
-            self.resrefs = filter (lambda r, t=tid: r['type'] == t, self.resrefs)
+            self.resrefs = core.keys.get_resref_by_type (tid)
+        else:
+            self.resrefs = core.keys.resref_list[:]
 
         if 'filter' in kw and callable (kw['filter']):
             self.resrefs = filter (kw['filter'], self.resrefs)
@@ -255,39 +334,114 @@ class ObjectIterator:
         else:
             self.print_names = 'all'
 
+        self.workers = kw.get ('workers', 1)
+        self.ordered = kw.get ('ordered', True)
+        self.chunk_size = kw.get ('chunk', 64)
+
+        self.results = None
+
 
     def __iter__ (self):
         return self
 
 
     def next (self):
-        if not self.resrefs:
-            raise StopIteration
+        if self.results is None:
+            if self.workers > 1 and len (self.resrefs) > 1:
+                self.results = self.iter_parallel ()
+            else:
+                self.results = self.iter_serial ()
 
-        res = self.resrefs.pop (0)
+        return self.results.next ()
+
+
+    def iter_serial (self):
+        for res in self.resrefs:
+            if self.print_names == 'all':
+                print(res['resref_name'])
+
+            obj = None
+
+            #if error_fn in ['msg', 'traceback', 'ignore'] or callable (error_fn):
+            try:
+                obj = ResourceStream ().open (res['resref_name'], res['type']).load_object ()
+                #fn (res, obj)
+            except Exception, e:
+                if callable (self.error_fn):
+                    self.error_fn (res, obj, e)
+                elif self.error_fn == 'msg':
+                    for msg in traceback.format_exception_only (sys.exc_type, sys.exc_value):
+                        print msg
+                elif self.error_fn == 'traceback':
+                    traceback.print_exc ()
+                elif self.error_fn == 'ignore':
+                    pass
+                else:
+                    #traceback.print_exc ()
+                   raise
+
+            yield res, obj
 
-        if self.print_names == 'all':
-            print(res['resref_name'])
 
-        obj = None
+    def get_chunks (self):
+        """Split resrefs into chunks of (position, name, type) from the same BIF."""
+        bifs = {}
+        for pos, res in enumerate (self.resrefs):
+            bifs.setdefault (res['locator_src_ndx'], []).append ((pos, res['resref_name'], res['type']))
 
-        #if error_fn in ['msg', 'traceback', 'ignore'] or callable (error_fn):
+        chunks = []
+        for items in bifs.values ():
+            for i in range (0, len (items), self.chunk_size):
+                chunks.append (items[i:i + self.chunk_size])
+
+        # chunks with the first resrefs first, so that ordered results come early
+        chunks.sort ()
+        return chunks
+
+
+    def iter_parallel (self):
+        pool = multiprocessing.Pool (self.workers, init_object_worker)
         try:
-            obj = ResourceStream ().open (res['resref_name'], res['type']).load_object ()
-            #fn (res, obj)
-        except Exception, e:
+            pending = {}
+            next_pos = 0
+            for chunk in pool.imap_unordered (load_object_chunk, self.get_chunks ()):
+                if not self.ordered:
+                    for pos, obj, error in chunk:
+                        yield self.get_result (pos, obj, error)
+                    continue
+
+                # results loaded out of order wait for the preceding ones
+                for pos, obj, error in chunk:
+                    pending[pos] = (obj, error)
+                while next_pos in pending:
+                    obj, error = pending.pop (next_pos)
+                    yield self.get_result (next_pos, obj, error)
+                    next_pos += 1
+
+            pool.close ()
+        finally:
+            pool.terminate ()
+            pool.join ()
+
+
+    def get_result (self, pos, obj, error):
+        res = self.resrefs[pos]
+        if self.print_names == 'all':
+            print(res['resref_name'])
+
+        if error is not None:
+            e, msgs, tb = error
             if callable (self.error_fn):
                 self.error_fn (res, obj, e)
             elif self.error_fn == 'msg':
-                for msg in traceback.format_exception_only (sys.exc_type, sys.exc_value):
+                for msg in msgs:
                     print msg
             elif self.error_fn == 'traceback':
-                traceback.print_exc ()
+                sys.stderr.write (tb)
             elif self.error_fn == 'ignore':
                 pass
             else:
-                #traceback.print_exc ()
-               raise
+                raise e
 
         return res, obj
 
@@ -300,7 +454,7 @@ def find_str (regexp):
     expression 'regexp' and prints the STRREFs and strings to stdout."""
 
     for o in core.strrefs.get_strref_by_str_re(regexp):
-        print(core.strrefs.strref_list.index(o), o['string'])
+        print(o['_strref'], o['string'])
 
 
 ###################################################
@@ -327,13 +481,7 @@ def load_ids ():
 def print_restype_stats ():
     """Print list of RESREFs with count of objects of each type."""
 
-    stats = {}
-
-    for o in core.keys.resref_list:
-        if not stats.has_key (o['type']):
-            stats[o['type']] = 1
-        else:
-            stats[o['type']] = stats[o['type']] + 1
+    stats = core.keys.get_resref_types ()
 
     for s in stats.keys ():
         if core.restype_hash.has_key (s):
@@ -348,6 +496,7 @@ def print_restype_stats ():
 def print_formats ():
     """List recognized/implemented IE file formats"""
 
+    core.load_lazy_formats ()
     flist = filter (lambda a: a[1] is not None,  core.fmt_signatures.items ())
     flist.sort (lambda a, b: cmp (a[0], b[0]))
 
@@ -16,41 +16,125 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
 
-class Cache:
-    def __init__ (self):
-        self.objects = {}
-        self.first = -1
-        self.last = 0
-        self.max_count = 0
-        self.max_size = 0
+import collections
+
+
+class Cache (object):
+    """LRU cache of objects.
+
+    Each object is added with its size in bytes and the number of files
+    it holds open. When there are more than `max_count' objects, or they
+    take more than `max_size' bytes or hold more than `max_files' files,
+    the least recently used objects are evicted and `on_evict' is called
+    as on_evict (key, obj), e.g. to close the files. Zero means no limit.
+    Objects added with add_permanent() are never evicted."""
+
+    def __init__ (self, max_count = 0, max_size = 0, max_files = 0, on_evict = None):
+        # key -> [obj, size, files, permanent], in LRU order
+        self.objects = collections.OrderedDict ()
+        self.max_count = max_count
+        self.max_size = max_size
+        self.max_files = max_files
+        self.on_evict = on_evict
+
+        self.size = 0
+        self.files = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__ (self):
+        return len (self.objects)
+
+    def __contains__ (self, key):
+        return key in self.objects
+
+    def set_limits (self, max_count = 0, max_size = 0, max_files = 0):
+        if (max_count, max_size, max_files) != (self.max_count, self.max_size, self.max_files):
+            self.max_count = max_count
+            self.max_size = max_size
+            self.max_files = max_files
+            self.trim ()
 
     def flush (self):
-        self.objects = {}
+        """Evict all objects, including permanent ones."""
+        while self.objects:
+            self.evict (next (iter (self.objects)))
 
-    def get (self, key):
+    def get (self, key, default = None, valid = None):
+        """Return object stored under `key' and mark it as most recently used.
+        If `valid' is given, it's called as valid (obj) and the object is
+        evicted when it returns False."""
         try:
-            rec = self.objects[key]
-            self.
-            rec[1] =
-        else:
-            return None
+            rec = self.objects.pop (key)
+        except KeyError:
+            self.misses += 1
+            return default
 
-    def add (self, key, obj):
-        self.add_permanent (key, obj)
-        self.lru.append (obj)
+        if valid is not None and not valid (rec[0]):
+            self.objects[key] = rec
+            self.evict (key)
+            self.misses += 1
+            return default
 
-    def add_permanent (self, key, obj):
+        self.objects[key] = rec
+        self.hits += 1
+        return rec[0]
+
+    def add (self, key, obj, size = 0, files = 0):
+        self.store (key, [ obj, size, files, False ])
+
+    def add_permanent (self, key, obj, size = 0, files = 0):
+        self.store (key, [ obj, size, files, True ])
+
+    def store (self, key, rec):
         if key in self.objects:
-            obj_old = self.objects[key]
-            i = self.lru.index (obj_old)
-            if i >= 0:
-                self.lru.pop (i)
-        self.objects[key] = obj
+            self.remove (key)
+
+        self.objects[key] = rec
+        self.size += rec[1]
+        self.files += rec[2]
+        self.trim (keep = key)
+
+    def remove (self, key):
+        """Remove object `key' from the cache without calling on_evict and return it."""
+        rec = self.objects.pop (key)
+        self.size -= rec[1]
+        self.files -= rec[2]
+        return rec[0]
+
+    def evict (self, key):
+        obj = self.remove (key)
+        self.evictions += 1
+        if self.on_evict is not None:
+            self.on_evict (key, obj)
+
+    def over_limits (self):
+        return ((self.max_count and len (self.objects) > self.max_count)
+                or (self.max_size and self.size > self.max_size)
+                or (self.max_files and self.files > self.max_files))
+
+    def trim (self, keep = None):
+        """Evict least recently used objects until the limits are met,
+        sparing the object `keep'."""
+        if not self.over_limits ():
+            return
+
+        for key in list (self.objects.keys ()):
+            if not self.over_limits ():
+                break
+            if key == keep or self.objects[key][3]:
+                continue
+            self.evict (key)
 
-    def trim (self):
-        while self.max_count and len (self.lru) > self.max_count:
-            key = self.lru.pop (0)
-            self.objects.del (key)
+    def stats (self):
+        return { 'count': len (self.objects),
+                 'size': self.size,
+                 'files': self.files,
+                 'hits': self.hits,
+                 'misses': self.misses,
+                 'evictions': self.evictions }
 
 
-# End of file defaults.py
+# End of file cache.py
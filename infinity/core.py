@@ -25,8 +25,10 @@ import os
 import re
 import string
 import sys
+import time
 
 import infinity.defaults
+from infinity.cache import Cache
 
 #global formats
 #formats = {}
@@ -37,6 +39,16 @@ global fmt_regexps
 fmt_regexps = {}
 fmt_regexps_list = []
 
+# Distinct lengths of registered signatures, longest first, see get_format ()
+fmt_signature_lengths = []
+
+# Formats registered by register_lazy_format (), whose modules were not
+#   imported yet: signature -> module name, regexp -> module name.
+#   The lazy regexps are in fmt_regexps_list too, to keep their order.
+global fmt_lazy_signatures
+fmt_lazy_signatures = {}
+fmt_lazy_regexps = {}
+
 global fmt_extensions
 fmt_extensions = {}
 
@@ -59,12 +71,31 @@ override = None
 global options
 options = infinity.defaults.options
 
-# Loaded IDS files
+# Loaded IDS files, (IDS object or None, source) keyed by name, see get_ids ()
 global ids
 ids = {}
 
+# Open BIF files, (BIFF_Format, stream) pairs keyed by BIF file name
+def close_bif_file (name, bif):
+    bif[1].close ()
+
 global bif_files
-bif_files = {}
+bif_files = Cache (on_evict = close_bif_file)
+
+# Cached directory listings, [mtime, time of check, listing] keyed by
+#   directory, see list_dir ()
+global dir_index
+dir_index = {}
+
+# BIF file tables restored from a snapshot, (path, BIFF_Format) pairs keyed
+#   by BIF file name, see infinity.snapshot
+global bif_tables
+bif_tables = {}
+
+# Parsed objects, (object, mtime) pairs keyed by (name, type, source, index),
+#   see get_cached_object ()
+global objects
+objects = Cache ()
 
 # These variables are filled after call to load_game()
 game_dir = None
@@ -359,9 +390,10 @@ def register_format (klass, **kw):
     if 'signature' in kw:
         for sig in seq (kw['signature']):
             bind (fmt_signatures, sig, klass)
+            add_signature_length (sig)
     if 'regexp' in kw:
         for rexp in seq (kw['regexp']):
-            if bind (fmt_regexps, rexp, klass):
+            if bind (fmt_regexps, rexp, klass) and rexp not in [ r for c, r in fmt_regexps_list ]:
                 fmt_regexps_list.append ((re.compile(rexp), rexp))
     if 'extension' in kw:
         for ext in seq (kw['extension']):
@@ -389,6 +421,28 @@ def register_format (klass, **kw):
 #    formats[(signature,  None)] = (klass,  desc)
 
 
+def register_lazy_format (module, signature = (), regexp = ()):
+    """Register format implemented in `module' (full module name) by its
+    `signature's and `regexp's, without importing the module. It's
+    imported when get_format() is asked for the format for the first time,
+    and registers the format with register_format() then."""
+    for sig in signature:
+        if sig not in fmt_signatures:
+            fmt_lazy_signatures.setdefault (sig, module)
+            add_signature_length (sig)
+    for rexp in regexp:
+        if rexp not in fmt_regexps and rexp not in fmt_lazy_regexps:
+            fmt_lazy_regexps[rexp] = module
+            fmt_regexps_list.append ((re.compile(rexp), rexp))
+
+def add_signature_length (signature):
+    if len (signature) not in fmt_signature_lengths:
+        fmt_signature_lengths.append (len (signature))
+        fmt_signature_lengths.sort (reverse = True)
+
+def import_format (module):
+    __import__ (module)
+
 def get_format (**kw):
     if 'signature' in kw:
         signature = kw['signature']
@@ -397,17 +451,39 @@ def get_format (**kw):
         except KeyError:
             pass
 
-        for sig in fmt_signatures.keys():
-            if signature.startswith (sig):
+        # the longest registered signature the signature starts with wins
+        for length in fmt_signature_lengths:
+            sig = signature[:length]
+            try:
                 return fmt_signatures[sig][0]
+            except KeyError:
+                pass
+
+            if sig in fmt_lazy_signatures:
+                import_format (fmt_lazy_signatures[sig])
+                del fmt_lazy_signatures[sig]
+                if sig in fmt_signatures:
+                    return fmt_signatures[sig][0]
 
         for rexpc, rexp in fmt_regexps_list:
             #print rexp
             if rexpc.match (signature):
-                return fmt_regexps[rexp][0]
+                if rexp in fmt_lazy_regexps:
+                    import_format (fmt_lazy_regexps[rexp])
+                    del fmt_lazy_regexps[rexp]
+                if rexp in fmt_regexps:
+                    return fmt_regexps[rexp][0]
 
         return None
 
+def load_lazy_formats ():
+    """Import modules of all the formats registered by register_lazy_format()."""
+    modules = set (fmt_lazy_signatures.values () + fmt_lazy_regexps.values ())
+    for module in sorted (modules):
+        import_format (module)
+    fmt_lazy_signatures.clear ()
+    fmt_lazy_regexps.clear ()
+
 
 
 # FIXME: replace with find_res_type()
@@ -418,24 +494,108 @@ def get_format_by_type (type):
     except:
         return None
 
-def id_to_symbol (idsfile, id):
+def get_cached_object (key, path = None):
+    """Return object cached by cache_object() under `key', or None.
+    If `path' is given, the object is dropped when the mtime of file
+    `path' differs from the one it was cached with."""
+    def valid (rec):
+        if path is None:
+            return True
+        try:
+            return os.stat (path).st_mtime == rec[1]
+        except OSError:
+            return False
+
+    rec = objects.get (key, valid = valid)
+    if rec is None:
+        return None
+    return rec[0]
+
+def cache_object (key, obj, size = 0, path = None):
+    """Cache parsed object `obj' loaded from `size' bytes of data under `key'.
+    If `path' is given, the object is tied to mtime of file `path'."""
+    if not get_option ('cache.object.enabled'):
+        return
+
+    objects.set_limits (get_option ('cache.object.max_count'),
+                        get_option ('cache.object.max_size'))
+
+    mtime = None
+    if path is not None:
+        try:
+            mtime = os.stat (path).st_mtime
+        except OSError:
+            return
+    objects.add (key, (obj, mtime), size)
+
+def flush_caches ():
+    """Drop all open BIF files and tables, directory listings, parsed objects
+    and IDS files."""
+    bif_files.flush ()
+    bif_tables.clear ()
+    dir_index.clear ()
+    objects.flush ()
+    ids.clear ()
+
+def get_ids (idsfile):
+    """Return IDS object `idsfile' from game data or None if it can't be loaded.
+    IDS files are kept in core.ids and in the object cache under the same
+    keys as load_object() uses. Files from override or elsewhere in the game
+    data path are loaded again when they change, as are failures."""
     # FIXME: ugly
     import traceback
-    from stream import ResourceStream
+    from stream import FileStream, ResourceStream
     idsfile = idsfile.upper ()
+    type = ext_to_type ('IDS')
+
+    key = path = None
+    found = override is not None and search_override (idsfile, type) or []
+    if found:
+        key, path = (idsfile, type, 'override', 0), found[0]['path']
+    else:
+        path = find_file (idsfile + '.IDS')
+        if path is not None:
+            key = (os.path.abspath (path), None, 'file', 0)
+        else:
+            key = (idsfile, type, 'bif', 0)
+
+    stamp = None
+    if path is not None:
+        try:
+            stamp = file_stamp (path)
+        except OSError:
+            pass
 
-    if not ids.has_key (idsfile):
+    rec = ids.get (idsfile)
+    if rec is not None and rec[1] == (key, stamp):
+        return rec[0]
+
+    idsobj = get_cached_object (key, path)
+    if idsobj is None:
         try:
-            # FIXME: ugly
-            idsobj = ResourceStream ().open (idsfile, 'IDS').load_object ()
-            ids[idsfile] = idsobj
+            if path is not None:
+                stream = FileStream ().open (path)
+            else:
+                stream = ResourceStream ().open (idsfile, 'IDS')
+            idsobj = stream.load_object ()
+            cache_object (key, idsobj, len (stream.buffer or ''), path)
+            stream.close ()
         except Exception as e:
             traceback.print_exc()
             print(e)
-            return id
+
+    # failures are remembered as well, not to retry on each lookup, but
+    # only until the file changes
+    ids[idsfile] = (idsobj, (key, stamp))
+    return idsobj
+
+def id_to_symbol (idsfile, id):
+    idsobj = get_ids (idsfile)
+    if idsobj is None:
+        return id
 
     try:
-        return ids[idsfile].ids[id]
+        return idsobj.ids[id]
     except KeyError as e:
         sys.stderr.write ("Warning: No such id %d in %s\n" %(id, idsfile))
         return id
@@ -446,24 +606,13 @@ def id_to_symbol (idsfile, id):
     #    return None
 
 def symbol_to_id (idsfile, sym):
-    # FIXME: ugly
-    import traceback
-    from stream import ResourceStream
-    idsfile = idsfile.upper ()
-
-    if not ids.has_key (idsfile):
-        try:
-            # FIXME: ugly
-            idsobj = ResourceStream ().open (idsfile, 'IDS').load_object ()
-            ids[idsfile] = idsobj
-        except Exception as e:
-            traceback.print_exc()
-            print(e)
-            #return id
-            return None
+    idsobj = get_ids (idsfile)
+    if idsobj is None:
+        #return id
+        return None
 
     try:
-        return ids[idsfile].ids_re[sym]
+        return idsobj.ids_re[sym]
     except KeyError as e:
         sys.stderr.write ("Warning: No such symbol %s in %s\n" %(sym, idsfile))
         #return sym
@@ -482,9 +631,6 @@ def find_file (filename, type = None):
     #   (if no type is specified, maybe it could be acquired from keys.resref_hash?)
     #   Possibly try different extension even if one was specified, e.g. wav -> wavc, bif -> cbf
 
-    # NOTE: it could cache os.listdir() results, but IMO it would be an overkill
-    #   for probable use cases
-
     filename = filename.replace ('\\', '/')
     subdirs = filename.split (os.path.sep)  # FIXME: platform specific separator
     names = [ subdirs[-1] ]
@@ -498,13 +644,9 @@ def find_file (filename, type = None):
 
     for dir in dirs:
         for subdir in subdirs:
-            if os.path.exists (os.path.join (dir, subdir)):
-                dir = os.path.join (dir, subdir)
-                continue
-            dirents = os.listdir (dir)
-            matches = filter (lambda de: de.lower () == subdir.lower (), dirents)
-            if matches:
-                dir = os.path.join (dir, matches[0])
+            match = find_in_dir (dir, subdir)
+            if match is not None:
+                dir = os.path.join (dir, match)
                 continue
             else:
                 dir = None
@@ -513,16 +655,66 @@ def find_file (filename, type = None):
         if dir is None:
             continue
 
-        dirents = os.listdir (dir)
         for name in names:
-            if os.access (os.path.join (dir,  name), os.F_OK):
-                return os.path.join (dir,  name)
-            matches = filter (lambda de: de.lower () == name.lower (), dirents)
-            if matches:
-                return os.path.join (dir,  matches[0])
+            match = find_in_dir (dir, name)
+            if match is not None:
+                return os.path.join (dir, match)
+
+    return None
+
+def find_in_dir (dir, name):
+    """Return name of the entry of directory `dir' matching `name', exactly
+    or case insensitively, or None."""
+    listing = list_dir (dir)
+    if listing is None:
+        return None
+
+    names, folded = listing
+    if name in names:
+        return name
 
+    matches = folded.get (name.lower ())
+    if matches:
+        return matches[0]
     return None
 
+def list_dir (dir):
+    """Return listing of directory `dir' as (set of names, dict of lists of names
+    keyed by lowercased name), or None if it can't be read.
+
+    Listings are cached in core.dir_index and read again when the mtime
+    of the directory changes. The mtime is checked at most each
+    core.dir_index_interval seconds."""
+    now = time.time ()
+    rec = dir_index.get (dir)
+    if rec is not None and now - rec[1] < get_option ('core.dir_index_interval'):
+        return rec[2]
+
+    try:
+        mtime = os.stat (dir).st_mtime
+        if rec is not None and rec[0] == mtime:
+            rec[1] = now
+            return rec[2]
+
+        entries = os.listdir (dir)
+    except OSError:
+        dir_index.pop (dir, None)
+        return None
+
+    folded = {}
+    for entry in entries:
+        folded.setdefault (entry.lower (), []).append (entry)
+
+    listing = (set (entries), folded)
+    dir_index[dir] = [ mtime, now, listing ]
+    return listing
+
+def file_stamp (filename):
+    """Return (size, mtime) of file or directory `filename', for stamping
+    data derived from it."""
+    st = os.stat (filename)
+    return (st.st_size, st.st_mtime)
+
 def locate_override ():
     for override in ["override", "Override"]:
         dir = os.path.join (game_dir, override)
@@ -533,42 +725,28 @@ def locate_override ():
     return None
 
 def load_override ():
-    entries = os.listdir (override_dir)
-    override = []
-
-    print("Processing %d items from override" %(len(entries)))
-
-    for entry in entries:
-        (fname, ext) = os.path.splitext (entry)
-        try:
-            file_type = find_res_type (ext=ext)[0][0]
-            file_path = os.path.join(override_dir, entry)
-        except:
-            print ("Warning: unrecognized file: %s" %(entry))
-            continue
-
-        rec = {'path': file_path, 'resref_name': fname, 'type': file_type}
-        override.append (rec)
-
-    print("%d items indexed" %(len(override)))
+    from infinity.override import OverrideIndex
 
+    override = OverrideIndex (override_dir)
+    override.load (verbose = True)
     return override
 
 def search_override (name, type = None):
-    obj = filter (lambda s, name=name.upper (): s['resref_name'].upper () == name, override)
-
-    if type is not None:
-        obj = filter (lambda o: o['type'] == type, obj)
+    return override.search (name, type)
 
-    return obj
+def notify_override (*paths):
+    """Tell the override index that files `paths' were added to or removed
+    from the override directory, see OverrideIndex.notify()."""
+    if override is not None:
+        override.notify (*paths)
 
 def detect_game_type ():
     detected_type = None
     detected_weight = 0
 
-    for game_type in defaults.game_types:
-        name, ext = defaults.game_types[game_type]
-        weight = defaults.game_type_weights[game_type]
+    for game_type in infinity.defaults.game_types:
+        name, ext = infinity.defaults.game_types[game_type]
+        weight = infinity.defaults.game_type_weights[game_type]
         type = ext_to_type (ext)
         obj = keys.get_resref_by_name_and_type(name, type)
 
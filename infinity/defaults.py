@@ -22,11 +22,30 @@
 options = {
     'core.chitin_file': ['CHITIN.KEY', ""],
     'core.dialog_file': ['dialog.tlk', ""],
+    'core.dir_index_interval': [0.0, "Seconds for which cached directory listings are used without checking the directory for changes"],
+    'core.override_refresh_interval': [0.0, "Seconds for which the override index is used without checking the override dir for changes"],
+    'core.snapshot_file': ['iesh.snapshot', "Snapshot of game data saved and reused by load_game(), relative to the game dir, None to disable"],
     'pager': ['more', "Program to use for paging command output"],
     'use_cache': [True, "Cache open BIF files"],
+    'cache.bif.max_count': [64, "Max # of BIF files kept in cache, 0 for no limit"],
+    'cache.bif.max_size': [256 * 1024 * 1024, "Max # of bytes of BIF data kept in cache, 0 for no limit"],
+    'cache.bif.max_files': [32, "Max # of file handles held by cached BIF files, 0 for no limit"],
+    'cache.object.enabled': [True, "Cache parsed objects loaded by load_object()"],
+    'cache.object.max_count': [256, "Max # of parsed objects kept in cache, 0 for no limit"],
+    'cache.object.max_size': [64 * 1024 * 1024, "Max # of bytes of data of parsed objects kept in cache, 0 for no limit"],
+    'extract.workers': [0, "# of workers used by extract_objects(), 0 for # of CPUs"],
+    'extract.pool': ['thread', "Pool of workers used by extract_objects(), 'process' or 'thread'"],
     'encoding': [None, "Encoding used for printing strings, e.g. 'utf8'"],
+    'scripts.ast_file': ['iesh.scripts', "Cache of compiled BCS scripts keyed by their MD5, relative to the game dir, None to disable"],
+    'scripts.index_file': ['iesh.scriptindex', "Index of triggers, actions, variables and resrefs used by BCS scripts, relative to the game dir, None to disable"],
+    'scripts.workers': [0, "# of processes compiling scripts in build_script_index(), 0 for # of CPUs"],
 
+    'stream.compressed.max_retained': [None, "Max # of bytes of decompressed data kept by a compressed stream, None for no limit"],
     'stream.debug_coverage': [False, "On stream close print info on offsets not read or read more than once"],
+    'format.lazy_load': [True, "Import format modules only when their format is first needed"],
+    'format.compact_records': [True, "Keep records of KEY resrefs, BIF file tables and TLK strrefs in slotted objects instead of dicts"],
+    'format.keep_source': [True, "Keep data of loaded objects, so that write() copies unchanged records from it verbatim"],
+    'format.lazy_sections': [False, "Read lists of ARE, CRE, GAM and WMAP files only when they are first accessed"],
     'format.debug_read': [False, "Print each read op to stdout"],
     'format.debug_write': [False, "Print each write op to stdout"],
     'format.print_offset': [False, "Print field's offset"],
@@ -39,12 +58,12 @@ options = {
     'format.bam.print_palette': [True, "Print BAM frame palette" ],
 
     'format.biff.read_data': [False,  "When reading BIFF file read its data too"],
+    'format.biff.block_cache_size': [16,  "# of decompressed blocks of a BIFC file kept in memory"],
+    'format.biff.block_threads': [4,  "# of threads decompressing blocks of BIFC files, less than 2 to decompress in the reading thread"],
 
     'format.bmp.print_bitmap': [True, "Print BMP bitmap"],
     'format.bmp.print_palette': [True, "Print BMP palette" ],
 
-    'format.key.tick_size': [ 100, "# of RESREFs read to print a dot" ],
-    'format.key.tack_size': [ 5000, "# of RESREFs read to print a number" ],
     'format.key.max_read_resrefs': [None,  "Max # of RESREFs to read from KEY file"],
 
     'format.mos.print_tiles': [True,  "Print MOS tiles"],
@@ -53,13 +72,18 @@ options = {
     'format.plt.print_bitmap': [True, "Print PLT bitmap"],
 
     'format.sav.read_data': [False,  "When reading SAV file read its data too"],
+    'format.sav.threads': [4,  "# of threads (de)compressing files of SAV files at once"],
 
     'format.tis.print_tiles': [False,  "Print TIS tiles"],
     'format.tis.print_palettes': [False,  "Print TIS palettes"],
 
-    'format.tlk.tick_size': [ 100, "# of STRREFs read to print a dot" ],
-    'format.tlk.tack_size': [ 5000, "# of STRREFs read to print a number" ],
+    'format.tlk.tick_size': [ 100, "# of STRREFs written to print a dot" ],
+    'format.tlk.tack_size': [ 5000, "# of STRREFs written to print a number" ],
     'format.tlk.decode_strrefs': [True,  "Read TLK strrefs, not only header"],
+    'format.tlk.lazy': [True,  "Decode TLK strrefs only when accessed, keeping the file mapped"],
+    'format.tlk.string_cache_size': [1024,  "# of strings cached by TLK get_string()"],
+    'format.tlk.trigram_search': [False,  "Use trigram index for TLK regex searches"],
+    'format.tlk.save_trigrams': [True,  "Save TLK trigram index to a .tri file next to the TLK file"],
     'format.tlk.encoding': [None, "Encoding of strings in game data, e.g. cp1250 (Czech), cp932 (Japanese), cp949 (Korean), cp950 (Chinese)"],
     #src_enc = 'cp1250' # Czech
     #src_enc = 'cp949' # Korean, but some strings are in French
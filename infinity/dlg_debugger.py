@@ -414,7 +414,7 @@ class DLGDebugger (object):
 
     def print_state (self, d, state):
         if core.strrefs:
-            print('  Text:', core.strrefs.strref_list[state['npc_text']]['string'])
+            print('  Text:', core.strrefs.get_string (state['npc_text']))
         else:
             print('  Text:', state['npc_text'])
 
@@ -435,7 +435,7 @@ class DLGDebugger (object):
 
         if (transition['flags'] & 0x01) and transition['pc_text'] != 0xffffffff:
             if core.strrefs:
-                print('    ', core.strrefs.strref_list[transition['pc_text']]['string'])
+                print('    ', core.strrefs.get_string (transition['pc_text']))
             else:
                 print('    ', transition['pc_text'])
 
@@ -468,7 +468,7 @@ class DLGDebugger (object):
 
         if (transition['flags'] & 0x01) and transition['pc_text'] != 0xffffffff:
             if core.strrefs:
-                print('SELF:', core.strrefs.strref_list[transition['pc_text']]['string'])
+                print('SELF:', core.strrefs.get_string (transition['pc_text']))
             else:
                 print('SELF:', transition['pc_text'])
 
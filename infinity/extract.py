@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# -*-python-*-
+# ie_shell.py - Simple shell for Infinity Engine-based game files
+# Copyright (C) 2004-2011 by Jaroslav Benkovsky, <edheldil@users.sf.net>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+
+"""
+Bulk extraction of game resources into files.
+
+The resources to extract are grouped by the BIF file they are stored in
+and each BIF is read by one worker, in the order of the data offsets of
+the resources, i.e. sequentially. Resources found in the override or
+loose in the game data path are copied. The workers are threads (or
+processes, see option extract.pool) of a multiprocessing pool and each
+of them holds just one resource in memory at a time (except for
+compressed BIFs, which are decompressed whole).
+
+Usage from the shell:
+
+    extract_objects ('/tmp/items', type = 'ITM')
+    extract_objects ('/tmp/areas', glob = 'AR01*', workers = 4)
+
+or from the command line, see `python -m infinity.extract --help'.
+"""
+
+from __future__ import print_function
+
+import multiprocessing
+import multiprocessing.pool
+import os
+import shutil
+import sys
+import traceback
+
+from infinity import core
+from infinity.stream import find_bif_file, get_bif_record, read_bif
+
+
+def select_resrefs (names = None, type = None, glob = None):
+    """Return KEY records of resources `names', or of resources matching
+    shell-style pattern `glob', or of all the resources, restricted to
+    type `type' if given."""
+    keys = core.keys
+    type = core.ext_to_type (type)
+
+    if names is not None:
+        resrefs = []
+        for name in names:
+            resrefs.extend (keys.get_resref_by_name_and_type (name, type))
+    elif glob is not None:
+        resrefs = keys.get_resref_by_glob (glob, type)
+    elif type is not None:
+        resrefs = keys.get_resref_by_type (type)
+    else:
+        resrefs = list (keys.resref_list)
+
+    return resrefs
+
+
+def plan_extraction (resrefs, outdir, ignore_override = False):
+    """Return list of (file name, path, items) tasks to extract KEY records
+    `resrefs' into directory `outdir'.
+
+    For a BIF file, `file_name' is its name in the KEY file, `path' its
+    location (None if not found) and items a list of (KEY record, output
+    path). Files found in the override or in the game data path are copied
+    by tasks with `file_name' None and items a list of (source path,
+    output path).
+    As with export_object(), only the first resource of each name and type
+    is extracted."""
+    seen = set ()
+    bifs = {}
+    copies = []
+    for o in resrefs:
+        name = o['resref_name']
+        key = (name.upper (), o['type'])
+        if key in seen:
+            continue
+        seen.add (key)
+
+        exts = core.type_to_ext (o['type'])
+        filename = os.path.join (outdir, name + '.' + (exts and exts[0] or '%04X' %o['type']))
+
+        src = None
+        if not ignore_override and core.override is not None:
+            found = core.search_override (name, o['type'])
+            if found:
+                src = found[0]['path']
+        if src is None:
+            for ext in exts:
+                src = core.find_file (name + '.' + ext)
+                if src is not None:
+                    break
+        if src is not None:
+            copies.append ((src, filename))
+            continue
+
+        bifs.setdefault (o['locator_src_ndx'], []).append ((o, filename))
+
+    tasks = []
+    for src_ndx, items in bifs.items ():
+        file_name = core.keys.bif_list[src_ndx]['file_name']
+        try:
+            path = find_bif_file (file_name)
+        except IOError:
+            # reported by extract_task()
+            path = None
+        tasks.append ((file_name, path, items))
+
+    # biggest BIFs first, so that the workers finish at about the same time
+    tasks.sort (key = lambda task: -len (task[2]))
+    if copies:
+        tasks.append ((None, None, copies))
+
+    return tasks
+
+
+def extract_task (task):
+    """Extract the items of a task returned by plan_extraction(). Return
+    # of extracted items and list of (output path, error message)."""
+    file_name, path, items = task
+    errors = []
+
+    if file_name is None:
+        for src, filename in items:
+            try:
+                shutil.copyfile (src, filename)
+            except EnvironmentError as e:
+                errors.append ((filename, str (e)))
+        return len (items) - len (errors), errors
+
+    try:
+        if path is None:
+            raise IOError ("Archive not found in path")
+        b, bif_stream = read_bif (file_name, path)
+    except Exception as e:
+        return 0, [ (filename, "%s: %s" %(file_name, e)) for o, filename in items ]
+
+    try:
+        records = [ (get_bif_record (b, o), filename) for o, filename in items ]
+        records.sort (key = lambda rec: rec[0]['data_offset'])
+
+        for obj, filename in records:
+            try:
+                data = b.read_file_data (bif_stream, obj)
+                fh = open (filename, 'wb')
+                try:
+                    fh.write (data)
+                finally:
+                    fh.close ()
+            except Exception as e:
+                errors.append ((filename, str (e)))
+    finally:
+        bif_stream.close ()
+
+    return len (items) - len (errors), errors
+
+
+def init_extract_worker (options):
+    # processes that are spawned rather than forked start with the default
+    # options and no formats registered
+    import infinity.formats
+    core.options.update (options)
+    core.bif_files.flush ()
+
+def extract_task_safe (task):
+    # exceptions raised in pool workers lose their traceback
+    try:
+        return extract_task (task)
+    except Exception:
+        return 0, [ (filename, traceback.format_exc ()) for item, filename in task[2] ]
+
+
+def extract_objects (outdir, names = None, type = None, glob = None, ignore_override = False, workers = None, pool = None, verbose = True):
+    """Extract resources into files in directory `outdir'.
+
+    Resources are selected by list of `names', shell-style pattern `glob'
+    and/or resource `type', see select_resrefs(), all of them by default.
+    Specify `ignore_override' to extract straight from the game's data.
+
+    `workers' is # of workers (default option extract.workers) and `pool'
+    either 'process' or 'thread' (default option extract.pool). Return
+    # of extracted resources and list of (output path, error message)."""
+    if core.keys is None:
+        raise RuntimeError ("Core game files are not loaded. See load_game ().")
+
+    if workers is None:
+        workers = core.get_option ('extract.workers')
+    if not workers:
+        workers = multiprocessing.cpu_count ()
+    if pool is None:
+        pool = core.get_option ('extract.pool')
+
+    if not os.path.isdir (outdir):
+        os.makedirs (outdir)
+
+    resrefs = select_resrefs (names, type, glob)
+    tasks = plan_extraction (resrefs, outdir, ignore_override)
+
+    if workers == 1 or len (tasks) <= 1:
+        results = map (extract_task_safe, tasks)
+    else:
+        if pool == 'thread':
+            p = multiprocessing.pool.ThreadPool (workers)
+        elif pool == 'process':
+            p = multiprocessing.Pool (workers, init_extract_worker, (core.options, ))
+        else:
+            raise ValueError ("Unknown pool type `%s'" %pool)
+
+        try:
+            # results are small, the output is written by the workers
+            results = p.imap_unordered (extract_task_safe, tasks)
+            results = list (results)
+        finally:
+            p.close ()
+            p.join ()
+
+    count = 0
+    errors = []
+    for n, errs in results:
+        count += n
+        errors.extend (errs)
+
+    if verbose:
+        print("%d resources extracted into %s" %(count, outdir))
+        for filename, msg in errors:
+            print("Error: %s: %s" %(filename, msg))
+
+    return count, errors
+
+
+def main (argv):
+    import argparse
+    from infinity import builtins
+
+    parser = argparse.ArgumentParser (description = "Extract resources from Infinity Engine game data.")
+    parser.add_argument ('game_dir', help = "game directory with the KEY and TLK files")
+    parser.add_argument ('outdir', help = "directory to extract the resources into")
+    parser.add_argument ('names', nargs = '*', help = "names of the resources, all by default")
+    parser.add_argument ('-t', '--type', help = "resource type, e.g. ITM")
+    parser.add_argument ('-g', '--glob', help = "shell-style pattern of resource names, e.g. 'AR01*'")
+    parser.add_argument ('-j', '--workers', type = int, help = "# of workers, default # of CPUs")
+    parser.add_argument ('--processes', action = 'store_true', help = "use processes instead of threads")
+    parser.add_argument ('--ignore-override', action = 'store_true', help = "extract from the game's data even if the resource is overridden")
+    args = parser.parse_args (argv[1:])
+
+    import infinity.formats
+    builtins.load_game (args.game_dir)
+
+    count, errors = extract_objects (args.outdir, args.names or None, args.type, args.glob,
+                                     args.ignore_override, args.workers,
+                                     args.processes and 'process' or None)
+    return errors and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit (main (sys.argv))
+
+# End of file extract.py
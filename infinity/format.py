@@ -26,6 +26,7 @@ in infinity.formats package to the various IE file formats
 like 2DA, BAM, TLK etc."""
 
 from __future__ import print_function
+import mmap
 import os.path
 import re
 import string
@@ -33,7 +34,8 @@ import struct
 import types
 
 from infinity import core
-from infinity.stream import Stream, FileStream, ResourceStream
+from infinity.stream import Stream, FileStream, MemoryStream, WriteStream
+from infinity.struc import compile_struc, unpack_table, PackedTable, RecordList
 
 
 def ResolveFilePath (filename):
@@ -53,6 +55,76 @@ class Format (object):
         self.indent = ''
 
 
+    def __getattr__ (self, name):
+        # called only for attributes not found the usual way
+        deferred = self.__dict__.get ('deferred')
+        if not deferred or name not in deferred:
+            raise AttributeError ("'%s' object has no attribute '%s'" %(self.__class__.__name__, name))
+
+        fn, args = deferred.pop (name)
+        if not deferred:
+            # so that the object looks the same as if read right away
+            del self.__dict__['deferred']
+        value = fn (*args)
+        self.__dict__[name] = value
+        return value
+
+
+    def __getstate__ (self):
+        self.read_deferred ()
+        state = self.__dict__
+        if isinstance (state.get ('source'), mmap.mmap):
+            # mappings can't be pickled, see keep_source ()
+            state = dict (state)
+            state['source'] = state['source'][:]
+        return state
+
+
+    def defer (self, name, fn, *args):
+        """Set attribute `name' to the value of fn (*args) when it's first accessed."""
+        # pending attributes are kept in self.deferred, created on demand
+        self.__dict__.pop (name, None)
+        self.__dict__.setdefault ('deferred', {})[name] = (fn, args)
+
+
+    def read_deferred (self):
+        """Read all the deferred attributes."""
+        for name in list (self.__dict__.get ('deferred', ())):
+            getattr (self, name)
+
+
+    def get_section_stream (self, stream):
+        """Return stream for reading sections of the file after read() returns,
+        or None if they should be read right away.
+
+        Sections are read lazily when the format.lazy_sections option is on
+        and `stream' is backed by a buffer, which is then kept (without
+        copying) until all the sections are read."""
+        if not self.get_option ('format.lazy_sections') or self.get_option ('format.debug_read'):
+            return None
+
+        buffer = stream.detach_buffer ()
+        if buffer is None:
+            return None
+        return MemoryStream ().open (buffer, stream.name)
+
+
+    def read_lists (self, stream, names, section_stream = None):
+        """Read lists `names' with read_list(), or defer reading each of them
+        until first access if `section_stream' is given."""
+        for name in names:
+            if section_stream is None:
+                self.read_list (stream, name)
+            else:
+                self.defer (name + '_list', self.read_deferred_list, section_stream, name)
+
+
+    def read_deferred_list (self, stream, name):
+        self.__dict__[name + '_list'] = []
+        self.read_list (stream, name)
+        return self.__dict__[name + '_list']
+
+
     @classmethod
     def load(cls, fh):
         if type(fh) in (str, unicode):
@@ -69,6 +141,34 @@ class Format (object):
         return cls.load(fh)
 
 
+    def save (self, filename):
+        """Write the object into file `filename' at once."""
+        data = self.save_to_string ()
+        fh = open (filename, 'wb')
+        try:
+            fh.write (data)
+        finally:
+            fh.close ()
+
+
+    def save_to_string (self):
+        """Write the object into a memory buffer and return the data."""
+        stream = WriteStream ().open ()
+        self.write (stream)
+        return stream.getvalue ()
+
+
+    def measure (self):
+        """First pass of writing for formats which can lay out the file up
+        front: compute offsets and counts of the header and the records
+        for the data as they are now and return size of the file.
+
+        write() of such formats calls it and reserves the size in the
+        stream before emitting the data. Return None if the size is known
+        only after writing."""
+        return None
+
+
     def read_header (self, stream, desc = None):
         if desc is None:
             self.header = {}
@@ -91,45 +191,225 @@ class Format (object):
     def read_list (self, stream, name,  header = None, desc = None, list = None):
         if desc is None:
             desc = self.__getattribute__ (name + '_desc')
-        if list is None:
-            list = self.__getattribute__ (name + '_list')
         if header is None:
             header = self.header
 
-        off = header[name + '_off']
-        size = self.get_struc_size (desc)
+        records = self.read_records (stream, header[name + '_off'], header[name + '_cnt'], desc)
+
+        if list is None:
+            list = getattr (self, name + '_list')
+            if not list:
+                # records are decoded lazily when the list is ours
+                self.__setattr__ (name + '_list', records)
+                return
+
+        list.extend (records)
+
+
+    def read_records (self, stream, offset, count, desc, size = None, packed = False):
+        """Read table of `count' records described by `desc' at `offset'.
+
+        Fixed-size records are unpacked at once and returned as a RecordList,
+        which builds the record dicts on first access. Otherwise they are read
+        one by one into a plain list. Records are `size' bytes apart,
+        by default the size of the structure.
+
+        If `packed' is True, the records are left packed in the stream's
+        buffer and unpacked only when accessed, so the buffer has to stay
+        valid as long as the list is used (see Stream.detach_buffer())."""
+        if size is None:
+            size = self.get_struc_size (desc)
+
+        layout = compile_struc (desc)
+        if count <= 0 or layout.slow_desc or layout.size > size or self.get_option ('format.debug_read'):
+            return self.read_records_slow (stream, offset, count, desc, size)
+
+        buffer = stream.buffer
+        buffer_offset = offset
+        if buffer is None:
+            buffer = stream.read_blob (offset, count * size)
+            buffer_offset = 0
+        if buffer_offset + (count - 1) * size + layout.size > len (buffer):
+            # truncated table
+            return self.read_records_slow (stream, offset, count, desc, size)
+
+        if packed:
+            values = PackedTable (layout, buffer, buffer_offset, count, size)
+        else:
+            values = unpack_table (layout, buffer, buffer_offset, count, size)
+        return RecordList (layout, values, offset, size)
+
 
-        for i in range (header[name + '_cnt']):
+    def read_records_slow (self, stream, offset, count, desc, size):
+        records = []
+        for i in range (count):
             obj = {}
-            self.read_struc (stream, off, desc, obj)
-            list.append (obj)
-            off += size
+            self.read_struc (stream, offset, desc, obj)
+            records.append (obj)
+            offset += size
+
+        return records
 
 
     def write_list (self, stream, offset, name,  header = None, desc = None, list = None):
         if desc is None:
             desc = self.__getattribute__ (name + '_desc')
         if list is None:
-            list = self.__getattribute__ (name + '_list')
+            list = getattr (self, name + '_list')
         if header is None:
             header = self.header
 
         header[name + '_off'] = offset
         header[name + '_cnt'] = len (list)
-        size = self.get_struc_size (desc)
 
-        for obj in list:
-            self.write_struc (stream, offset, desc, obj)
-            offset += size
+        return self.write_records (stream, offset, desc, list)
+
+
+    def write_records (self, stream, offset, desc, list, size = None):
+        """Write records from `list' described by `desc' starting at `offset'
+        and return offset after the last one.
+
+        When the records tile the table without gaps, the whole table is packed
+        and written at once. Records of a RecordList which were never accessed
+        are written from their original values. Records unchanged since they
+        were read from the source (see keep_source ()) are copied from it."""
+        if size is None:
+            size = self.get_struc_size (desc)
+
+        layout = compile_struc (desc)
+        if list and self.source is not None and not layout.slow_desc and layout.size <= size and not self.get_option ('format.debug_write'):
+            return self.write_records_from_source (stream, offset, desc, list, size)
+
+        if not list or layout.slow_desc or layout.runs != [ (0, size) ] or self.get_option ('format.debug_write'):
+            for obj in list:
+                self.write_struc (stream, offset, desc, obj)
+                offset += size
+            return offset
+
+        pack = layout.struct.pack
+        if isinstance (list, RecordList):
+            chunks = []
+            for i in range (len (list)):
+                if list.is_decoded (i):
+                    chunks.append (pack (*layout.pack (list[i])))
+                else:
+                    chunks.append (pack (*list.values[i]))
+        else:
+            chunks = [ pack (*layout.pack (obj)) for obj in list ]
+
+        stream.write_blob (b''.join (chunks), offset)
+        return offset + len (list) * size
+
+
+    def write_records_from_source (self, stream, offset, desc, list, size):
+        # consecutive clean records read from consecutive offsets are
+        #   copied from the source by a single slice
+        layout = compile_struc (desc)
+        pack = layout.struct.pack
+        packed = layout.runs == [ (0, size) ]
+        source = self.source
+
+        chunks = []
+        start = end = None
+        chunk_offset = offset
+        for i in range (len (list)):
+            src = self.get_clean_offset (list, i, layout)
+            if src is not None and src + size > len (source):
+                src = None
+            if src is not None and src == end:
+                end += size
+                continue
 
-        return offset
+            if start is not None:
+                chunks.append (source[start:end])
+                start = end = None
+
+            if src is not None:
+                start, end = src, src + size
+            elif packed:
+                chunks.append (pack (*layout.pack (list[i])))
+            else:
+                # the gaps have to be left alone
+                if chunks:
+                    stream.write_blob (b''.join (chunks), chunk_offset)
+                self.write_struc (stream, offset + i * size, desc, list[i])
+                chunks = []
+                chunk_offset = offset + (i + 1) * size
+
+        if start is not None:
+            chunks.append (source[start:end])
+        if chunks:
+            stream.write_blob (b''.join (chunks), chunk_offset)
+
+        return offset + len (list) * size
+
+
+    def keep_source (self, stream):
+        """Remember the data of `stream' the object was read from.
+
+        write_struc () and write_records () then copy records whose fields
+        were not changed since they were read from the source verbatim,
+        instead of encoding them again.
+
+        Files mapped by FileStream are not copied, the object keeps the
+        read-only mapping instead, so save () writes the object into memory
+        first and only then into the file, which may be the source one."""
+        buffer = stream.detach_buffer ()
+        if buffer is None:
+            return
+        if isinstance (buffer, memoryview):
+            buffer = buffer.tobytes ()
+        elif not isinstance (buffer, (str, mmap.mmap)):
+            # e.g. bytearray, which may change under our hands
+            buffer = str (buffer[:])
+        self.__dict__['source'] = buffer
+
+
+    @property
+    def source (self):
+        return self.__dict__.get ('source')
+
+
+    def get_clean_offset (self, list, index, layout):
+        """Return offset in the source of record `index' of `list' if its fields
+        are the same as when it was read, else None."""
+        source = self.source
+        if isinstance (list, RecordList) and not list.is_decoded (index):
+            # never accessed, so unchanged, but its values might have come
+            #   from another buffer
+            if list.offsets is not None:
+                off = list.offsets[index]
+            else:
+                off = list.offset + index * list.stride
+            if off + layout.size <= len (source) and layout.struct.unpack_from (source, off) == tuple (list.values[index]):
+                return off
+            return None
+
+        return self.get_clean_record_offset (list[index], layout)
+
+
+    def get_clean_record_offset (self, obj, layout):
+        """Return offset of record `obj' in the source if its fields are the
+        same as when it was read, else None."""
+        source = self.source
+        off = obj.get ('_offset')
+        if source is None or off is None or layout.slow_desc or off < 0 or off + layout.size > len (source):
+            return None
+
+        orig = {}
+        layout.unpack (layout.struct.unpack_from (source, off), orig)
+        for key, value in orig.iteritems ():
+            if key not in obj or obj[key] != value:
+                return None
+
+        return off
 
 
     def print_list (self, name, desc = None, list = None):
         if desc is None:
             desc = self.__getattribute__ (name + '_desc')
         if list is None:
-            list = self.__getattribute__ (name + '_list')
+            list = getattr (self, name + '_list')
 
         i = 0
         for obj in list:
@@ -177,10 +457,40 @@ class Format (object):
 
     def read_struc (self, stream, offset, desc, obj):
         obj['_offset'] = offset
-        for d in desc:
+
+        if self.get_option ('format.debug_read'):
+            for d in desc:
+                self.read_datum(stream, offset, d, obj)
+            return
+
+        layout = compile_struc (desc)
+        values = self.unpack_struc (stream, offset, layout)
+        if values is None:
+            # record is truncated, let the interpreter deal with it
+            for d in desc:
+                self.read_datum(stream, offset, d, obj)
+            return
+
+        layout.unpack (values, obj)
+        for d in layout.slow_desc:
             self.read_datum(stream, offset, d, obj)
 
 
+    def unpack_struc (self, stream, offset, layout):
+        """Decode all fixed-size fields of `layout' at `offset' with one unpack_from.
+        Return None if the stream is too short."""
+        buffer = stream.buffer
+        if buffer is not None:
+            if offset + layout.size > len (buffer):
+                return None
+            return layout.struct.unpack_from (buffer, offset)
+
+        data = stream.read_blob (offset, layout.size)
+        if len (data) < layout.size:
+            return None
+        return layout.struct.unpack_from (data, 0)
+
+
     def print_struc (self, obj, desc):
         for d in desc:
             self.print_datum (obj, d)
@@ -188,11 +498,53 @@ class Format (object):
 
 
     def write_struc (self, stream, offset, desc, obj):
-        for d in desc:
+        if self.get_option ('format.debug_write'):
+            for d in desc:
+                self.write_datum(stream, offset, d, obj)
+            return
+
+        layout = compile_struc (desc)
+        src = self.get_clean_record_offset (obj, layout)
+        if src is not None:
+            stream.write_blob (self.source[src:src + layout.size], offset)
+            return
+
+        if layout.runs == [ (0, layout.size) ] and not layout.slow_desc:
+            # no gaps, so the record can be packed right into the stream
+            try:
+                stream.pack_into (layout.struct, offset, *layout.pack (obj))
+                return
+            except struct.error:
+                pass
+
+        try:
+            data = layout.struct.pack (*layout.pack (obj))
+        except struct.error:
+            # value out of range for its field, e.g. a key shared by two
+            #   fields of different types, let the interpreter deal with it
+            for d in desc:
+                self.write_datum(stream, offset, d, obj)
+            return
+
+        # gaps not covered by the descriptor are left untouched
+        for start, end in layout.runs:
+            stream.write_blob (data[start:end], offset + start)
+
+        for d in layout.slow_desc:
             self.write_datum(stream, offset, d, obj)
 
 
     def get_struc_size (self, desc, obj = None):
+        if obj is None:
+            layout = compile_struc (desc)
+            if layout.struc_size is None:
+                layout.struc_size = self.compute_struc_size (desc)
+            return layout.struc_size
+
+        return self.compute_struc_size (desc, obj)
+
+
+    def compute_struc_size (self, desc, obj = None):
         total_size = 0
 
         for d in desc:
@@ -523,7 +875,7 @@ class Format (object):
                 try: value2 = '(' + '0x%08x' %value + ')'
                 except: pass
             elif rec_type == 'STRREF' and core.strrefs and value >= 0:
-                try: value2 = '(' + core.strrefs.strref_list[value]['string'] + ')'
+                try: value2 = '(' + core.strrefs.get_string (value) + ')'
                 except: pass
             elif rec_type == 'RGBA':
                 try: value2 = '(' + '%08x' %value + ')'
@@ -534,15 +886,7 @@ class Format (object):
                     except: pass
 
                 elif type (enum) == types.StringType:
-                    if not core.ids.has_key (enum):
-                        try:
-                            # FIXME: ugly
-                            ids = ResourceStream ().open (enum, 'IDS').load_object ()
-                            core.ids[enum] = ids
-                        except:
-                            pass
-
-                    try: value2 = '(' + core.ids[enum].ids[value] + ')'
+                    try: value2 = '(' + core.get_ids (enum).ids[value] + ')'
                     except: pass
 
 
@@ -1,48 +1,79 @@
 # -*-python-*-
 
-import infinity.formats.are_v10
-import infinity.formats.are_v91
-import infinity.formats.baf
-import infinity.formats.bam
-import infinity.formats.bcs
-import infinity.formats.biff
-import infinity.formats.bmp
-import infinity.formats.chr_v10
-import infinity.formats.chr_v12
-import infinity.formats.chr_v20
-import infinity.formats.chr_v22
-import infinity.formats.chr_v90
-import infinity.formats.chui
-import infinity.formats.cre_v10
-import infinity.formats.cre_v12
-import infinity.formats.cre_v22
-import infinity.formats.cre_v90
-import infinity.formats.d2a
-import infinity.formats.dlg
-import infinity.formats.eff_v20
-import infinity.formats.gam
-import infinity.formats.gam_v11
-import infinity.formats.gam_v22
-import infinity.formats.ids
-import infinity.formats.ini
-import infinity.formats.itm_v1
-import infinity.formats.itm_v11
-import infinity.formats.itm_v20
-import infinity.formats.key
-import infinity.formats.mos
-import infinity.formats.mus
-import infinity.formats.plt
-import infinity.formats.pro
-import infinity.formats.sav
-import infinity.formats.spl
-import infinity.formats.stor_v10
-import infinity.formats.stor_v11
-import infinity.formats.stor_v90
-import infinity.formats.tis
-import infinity.formats.tlk
-import infinity.formats.var
-import infinity.formats.vvc
-import infinity.formats.wavc
-import infinity.formats.wed
-import infinity.formats.wfx
-import infinity.formats.wmap
+"""
+IE file format implementations.
+
+The format modules are not imported with this package. Each of them is
+registered by its signatures (and regexps) with core.register_lazy_format()
+and imported the first time core.get_format() is asked for a stream with
+such signature. Set the format.lazy_load option to False before importing
+this package, or call load_all(), to import all of them at once.
+
+Keep the signatures in sync with the register_format() calls at the end
+of the modules.
+"""
+
+from infinity import core
+
+
+# (module, signatures, regexps), in the order the modules are registered
+lazy_formats = (
+    ('are_v10', ('AREAV1.0',), ()),
+    ('are_v91', ('AREAV9.1',), ()),
+    ('baf', ('BAF', 'IF\n', 'IF\r\n'), ()),
+    ('bam', ('BAM V1  ', 'BAMCV1  '), ()),
+    ('bcs', ('BCS', 'SC\nCR\nCO', 'SC\r\nCR\r\n'), ()),
+    ('biff', ('BIFFV1  ', 'BIF V1.0', 'BIFCV1.0'), ()),
+    ('bmp', ('BM',), ()),
+    ('chr_v10', ('CHR V1.0',), ()),
+    ('chr_v12', ('CHR V1.2',), ()),
+    ('chr_v20', ('CHR V2.0', 'CHR V2.1'), ()),
+    ('chr_v22', ('CHR V2.2',), ()),
+    ('chr_v90', ('CHR V9.0',), ()),
+    ('chui', ('CHUIV1  ',), ()),
+    ('cre_v10', ('CRE V1.0',), ()),
+    ('cre_v12', ('CRE V1.2', 'CRE V1.1'), ()),
+    ('cre_v22', ('CRE V2.2',), ()),
+    ('cre_v90', ('CRE V9.0', 'CRE V9.1'), ()),
+    ('d2a', (), (' ?2DA[\r\n\t ]',)),
+    ('dlg', ('DLG V1.0',), ()),
+    ('eff_v20', ('EFF V2.0',), ()),
+    ('gam', ('GAMEV2.0',), ()),
+    ('gam_v11', ('GAMEV1.1',), ()),
+    ('gam_v22', ('GAMEV2.2',), ()),
+    ('ids', ('IDS',), ('([0-9]{1,4}|0[xX][0-9A-Fa-f]{1,4}|-1)[\r\n ].*',)),
+    ('ini', ('INI',), ()),
+    ('itm_v1', ('ITM V1  ',), ()),
+    ('itm_v11', ('ITM V1.1',), ()),
+    ('itm_v20', ('ITM V2.0',), ()),
+    ('key', ('KEY V1  ',), ()),
+    ('mos', ('MOS V1  ', 'MOSCV1  '), ()),
+    ('mus', (), ('[A-Za-z][A-Za-z0-9_-]+[\r\n]+[0-9]+[\r\n]+.*',)),
+    ('plt', ('PLT V1  ',), ()),
+    ('pro', ('PRO V1.0',), ()),
+    ('sav', ('SAV V1.0',), ()),
+    ('spl', ('SPL V1  ', 'SPL V2.0'), ()),
+    ('stor_v10', ('STORV1.0',), ()),
+    ('stor_v11', ('STORV1.1',), ()),
+    ('stor_v90', ('STORV9.0',), ()),
+    ('tis', ('TIS V1  ',), ()),
+    ('tlk', ('TLK V1  ',), ()),
+    ('var', ('902     ',), ()),
+    ('vvc', ('VVC V1.0',), ()),
+    ('wavc', ('WAVCV1.0',), ()),
+    ('wed', ('WED V1.3',), ()),
+    ('wfx', ('WFX V1.0',), ()),
+    ('wmap', ('WMAPV1.0',), ()),
+    )
+
+for module, signatures, regexps in lazy_formats:
+    core.register_lazy_format ('infinity.formats.' + module, signatures, regexps)
+
+
+def load_all ():
+    """Import all the format modules."""
+    for module, signatures, regexps in lazy_formats:
+        core.import_format ('infinity.formats.' + module)
+
+if not core.get_option ('format.lazy_load'):
+    load_all ()
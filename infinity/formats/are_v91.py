@@ -1412,21 +1412,13 @@ class ARE_V91_Format (Format):
     def read (self, stream):
         self.read_header (stream)
 
-        self.read_list (stream, 'actor')
-        self.read_list (stream, 'region')
-        self.read_list (stream, 'spawnpoint')
-        self.read_list (stream, 'entrance')
-        self.read_list (stream, 'container')
-        self.read_list (stream, 'item')
-        self.read_list (stream, 'vertex')
-        self.read_list (stream, 'ambient')
-        self.read_list (stream, 'variable')
+        section_stream = self.get_section_stream (stream)
+        self.read_lists (stream, ('actor', 'region', 'spawnpoint', 'entrance', 'container', 'item', 'vertex', 'ambient', 'variable'), section_stream)
         self.explored_bitmask = stream.read_blob (self.header['explored_bitmask_off'], self.header['explored_bitmask_size'])
-        self.read_list (stream, 'door')
-        self.read_list (stream, 'animation')
+        self.read_lists (stream, ('door', 'animation'), section_stream)
         ##self.read_list (stream, 'automap_note')
 
-        self.read_list (stream, 'tiled_object')
+        self.read_lists (stream, ('tiled_object', ), section_stream)
 
         obj = {}
         self.read_struc (stream, self.header['song_off'], self.song_desc, obj)
@@ -1437,26 +1429,34 @@ class ARE_V91_Format (Format):
         self.rest_interrupt = obj
 
 
+    def get_list_names (self):
+        """Return names of the lists written before and after the explored bitmask."""
+        before = ('actor', 'region', 'spawnpoint', 'entrance', 'container', 'item', 'vertex', 'ambient', 'variable')
+        ##after = ('door', 'animation', 'automap_note', 'tiled_object')
+        after = ('door', 'animation', 'tiled_object')
+        return before, after
+
+    def measure (self):
+        size = self.get_struc_size (self.header_desc)
+        before, after = self.get_list_names ()
+        for name in before + after:
+            size += len (getattr (self, name + '_list')) * self.get_struc_size (getattr (self, name + '_desc'))
+        size += len (self.explored_bitmask)
+        return size + self.get_struc_size (self.song_desc) + self.get_struc_size (self.rest_interrupt_desc)
+
     def write (self, stream):
+        stream.reserve (self.measure ())
         off = self.get_struc_size (self.header_desc)
+        before, after = self.get_list_names ()
 
-        off = self.write_list (stream, off, 'actor')
-        off = self.write_list (stream, off, 'region')
-        off = self.write_list (stream, off, 'spawnpoint')
-        off = self.write_list (stream, off, 'entrance')
-        off = self.write_list (stream, off, 'container')
-        off = self.write_list (stream, off, 'item')
-        off = self.write_list (stream, off, 'vertex')
-        off = self.write_list (stream, off, 'ambient')
-        off = self.write_list (stream, off, 'variable')
+        for name in before:
+            off = self.write_list (stream, off, name)
 
         stream.write_blob (self.explored_bitmask, off)
         off  += len (self.explored_bitmask)
 
-        off = self.write_list (stream, off, 'door')
-        off = self.write_list (stream, off, 'animation')
-        ##off = self.write_list (stream, off, 'automap_note')
-        off = self.write_list (stream, off, 'tiled_object')
+        for name in after:
+            off = self.write_list (stream, off, name)
 
         self.header['song_off'] = off
         self.write_struc (stream, off, self.song_desc, self.song)
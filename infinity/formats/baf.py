@@ -25,93 +25,77 @@ from infinity.format import Format, register_format
 class BAF_Format (Format):
     fn_spec_re = re.compile ('([A-Za-z0-9_]+)\s*\((.*)\)')
 
+    # Each match is the whitespace before a token and one of the token
+    # alternatives, `bad' catching any character not starting a token
+    token_re = re.compile (r"""
+        (?P<space>\s*)
+        (?: (?P<point>\[[^]]*\])
+          | (?P<string>"[^"]*")
+          | (?P<punct>[#(),])
+          | (?P<number>-?[0-9]+)
+          | (?P<word>[A-Z][A-Za-z]*)
+          | (?P<bad>\S)
+          | $ )
+        """, re.VERBOSE)
+
     def __init__ (self):
-        self.c = None
+        self.tokens = None
+        self.unknown = None
         self.token = None
         self.lineno = 1
         self.ids_codes = {}
 
 
-    def read_token (self, stream):
-        def getc ():
-            if self.c is None:
-                return stream.get_char ()
-            else:
-                c = self.c
-                self.c = None
-                return c
-
-        def nextc ():
-            if self.c is None:
-                self.c = stream.get_char ()
-                return self.c
-            else:
-                return self.c
-
-        # Skip over spaces and newlines
-        c = getc ()
-        while c.isspace ():
-            if c == "\n":
-                self.lineno += 1
-            c = getc ()
-
-        if c == '':
-            return None
-
-        elif c == '[':
-            res = c
-            while True:
-                c = getc ()
-                res = res + c
-                if c == ']':
-                    break
-            return res
-
-        elif c == '"':
-            res = c
-            while True:
-                c = getc ()
-                res = res + c
-                if c == '"':
-                    break
-            return res
-
-        elif c in ['#', '(', ')', ',']:
-            return c
+    def tokenize (self, data):
+        """Split script `data' into list of (token, line #) at once. The list
+        is reversed, so that tokens are popped from its end. An unknown
+        character ends the list and is reported only when it's reached."""
+        tokens = []
+        append = tokens.append
+        lineno = 1
+
+        for space, point, string, punct, number, word, bad in self.token_re.findall (data):
+            if space:
+                lineno += space.count ('\n')
+
+            if word:
+                append ((word, lineno))
+            elif punct:
+                append ((punct, lineno))
+            elif number:
+                append ((int (number), lineno))
+            elif string or point:
+                append ((string or point, lineno))
+            elif bad:
+                self.unknown = bad
+                break
+
+        # end of the script, after the trailing newlines
+        append ((None, lineno))
+        tokens.reverse ()
+        return tokens
 
-        elif c.isdigit () or (c == '-' and nextc ().isdigit ()):
-            if c == '-':
-                signum = -1
-                c = getc ()
-            else:
-                signum = 1
 
-            res = c
-            while nextc ().isdigit ():
-                res = res + getc ()
-            res = signum * int (res)
-            return res
+    def read_token (self, stream):
+        if self.tokens is None:
+            self.tokens = self.tokenize (stream.read ())
 
-        elif c.isupper ():
-            res = c
-            while nextc ().isalpha ():
-                res = res + getc ()
-            return res
+        if not self.tokens:
+            return None
 
-        else:
-            raise ValueError ("Unknown token: %s (at line %d)" %(c, self.lineno))
+        tok, self.lineno = self.tokens.pop ()
+        if tok is None and self.unknown is not None:
+            raise ValueError ("Unknown token: %s (at line %d)" %(self.unknown, self.lineno))
+        return tok
 
 
     def get_token (self, stream):
         if self.token is None:
             tok = self.read_token (stream)
-            p='.'
         else:
             tok = self.token
             self.token = None
-            p='x'
 
-        print('>>' + p+':'+repr(tok) + '<<')
         return tok
 
     def next_token (self, stream):
@@ -129,10 +113,15 @@ class BAF_Format (Format):
 
 
     def read (self, stream):
+        self.tokens = None
+        self.unknown = None
+        self.token = None
+
         obj = []
 
         while self.next_token (stream) != None:
             obj.append (self.read_condition_response_block (stream))
+        self.tokens = None
 
         self.script = obj
         return self
@@ -323,6 +312,27 @@ class BAF_Format (Format):
 #        #print core.id_to_symbol ('OBJECT', obj[10])
 #        return obj
 
+    def get_ast (self):
+        """Return the script as compact AST of nested tuples, with function
+        names instead of opcodes. See infinity.scripts."""
+        def args (items):
+            res = []
+            for tok, sub in items:
+                if sub is not None:
+                    # nested call, e.g. an object specifier
+                    tok = (tok, args (sub))
+                res.append (tok)
+            return tuple (res)
+
+        blocks = []
+        for co, rs in self.script:
+            triggers = tuple ([ (tr[0], args (tr[1])) for tr in co ])
+            responses = tuple ([ (re[0], tuple ([ (ac[0], args (ac[1])) for ac in re[1:] ])) for re in rs ])
+            blocks.append ((triggers, responses))
+
+        return tuple (blocks)
+
+
     def printme (self):
         odef = {
                 'pst_tr': {
@@ -25,8 +25,21 @@ from infinity.format import Format, register_format
 class BCS_Format (Format):
     fn_spec_re = re.compile ('([A-Za-z0-9_]+)\s*\((.*)\)')
 
+    # Each match is the whitespace before a token and one of the token
+    # alternatives, `bad' catching any character not starting a token
+    token_re = re.compile (r"""
+        (?P<space>\s*)
+        (?: (?P<point>\[[^]]*\])
+          | (?P<string>"[^"]*")
+          | (?P<number>-?[0-9]+)
+          | (?P<word>[A-Z][A-Za-z]*)
+          | (?P<bad>\S)
+          | $ )
+        """, re.VERBOSE)
+
     def __init__ (self):
-        self.c = None
+        self.tokens = None
+        self.unknown = None
         self.token = None
         self.lineno = 1
         self.ids_codes = {}
@@ -34,78 +47,58 @@ class BCS_Format (Format):
         self.type = 'bg2'
 
 
-    def read_token (self, stream):
-        def getc ():
-            if self.c is None:
-                return stream.get_char ()
-            else:
-                c = self.c
-                self.c = None
-                return c
-
-        def nextc ():
-            if self.c is None:
-                self.c = stream.get_char ()
-                return self.c
-            else:
-                return self.c
+    def tokenize (self, data):
+        """Split script `data' into list of (token, line #) at once. The list
+        is reversed, so that tokens are popped from its end. An unknown
+        character ends the list and is reported only when it's reached.
+        Points are kept as strings and decoded by read_token (), for the
+        same reason."""
+        tokens = []
+        append = tokens.append
+        lineno = 1
+
+        for space, point, string, number, word, bad in self.token_re.findall (data):
+            if space:
+                lineno += space.count ('\n')
+
+            if word:
+                append ((word, lineno))
+            elif number:
+                append ((int (number), lineno))
+            elif string:
+                append ((string, lineno))
+            elif point:
+                # decoded by read_token (), so that errors come in order
+                append ((point, lineno))
+            elif bad:
+                self.unknown = bad
+                break
+
+        # end of the script, after the trailing newlines
+        append ((None, lineno))
+        tokens.reverse ()
+        return tokens
 
-        # Skip over spaces and newlines
-        c = getc ()
-        while c.isspace ():
-            if c == "\n":
-                self.lineno += 1
-            c = getc ()
 
-        if c == '':
-            return None
-
-        elif c == '[':
-            #res = c
-            res = ''
-            while True:
-                c = getc ()
-                if c == ']':
-                    break
-                res = res + c
-            res2 = res.split (',')
-            if len (res2) != 2:
-                res2 = res.split ('.')
-                if len (res2) != 4:
-                    raise ValueError ("[]  len")
-            res = [ int (n) for n in res2 ]
-            return res
-
-        elif c == '"':
-            res = c
-            while True:
-                c = getc ()
-                res = res + c
-                if c == '"':
-                    break
-            return res
-
-        elif c.isdigit () or (c == '-' and nextc ().isdigit ()):
-            if c == '-':
-                signum = -1
-                c = getc ()
-            else:
-                signum = 1
+    def read_token (self, stream):
+        if self.tokens is None:
+            self.tokens = self.tokenize (stream.read ())
 
-            res = c
-            while nextc ().isdigit ():
-                res = res + getc ()
-            res = signum * int (res)
-            return res
+        if not self.tokens:
+            return None
 
-        elif c.isupper ():
-            res = c
-            while nextc ().isalpha ():
-                res = res + getc ()
-            return res
+        tok, self.lineno = self.tokens.pop ()
+        if tok is None and self.unknown is not None:
+            raise ValueError ("Unknown token: %s (at line %d)" %(self.unknown, self.lineno))
 
-        else:
-            raise ValueError ("Unknown token: %s (at line %d)" %(c, self.lineno))
+        if tok.__class__ is str and tok[0] == '[':
+            res = tok[1:-1].split (',')
+            if len (res) != 2:
+                res = tok[1:-1].split ('.')
+                if len (res) != 4:
+                    raise ValueError ("[]  len")
+            tok = [ int (n) for n in res ]
+        return tok
 
 
     def get_token (self, stream):
@@ -139,12 +132,17 @@ class BCS_Format (Format):
         ### <SCtail> -> <CR> <SCtail>
         ### <SCtail> -> SC
 
+        self.tokens = None
+        self.unknown = None
+        self.token = None
+
         obj = []
 
         obj.append (self.expect_token (stream, 'SC'))
         while self.next_token (stream) == 'CR':
             obj.append (self.read_condition_response_block (stream))
         self.expect_token (stream, 'SC')
+        self.tokens = None
 
         self.script = obj
         return self
@@ -286,6 +284,34 @@ class BCS_Format (Format):
         #print core.id_to_symbol ('OBJECT', obj[10])
         return obj
 
+    def get_ast (self):
+        """Return the script as compact AST of nested tuples, without the
+        section markers. See infinity.scripts."""
+        def args (tokens):
+            res = []
+            for tok in tokens:
+                if isinstance (tok, list):
+                    if tok and tok[0] == 'OB':
+                        # object
+                        tok = args (tok[1:])
+                    else:
+                        # point or rectangle
+                        tok = tuple (tok)
+                res.append (tok)
+            return tuple (res)
+
+        blocks = []
+        for cr in self.script[1:]:
+            # condition and response set pairs
+            for i in range (1, len (cr) - 1, 2):
+                co, rs = cr[i], cr[i + 1]
+                triggers = tuple ([ (tr[1], args (tr[2:])) for tr in co[1:] ])
+                responses = tuple ([ (re[1], tuple ([ (ac[1], args (ac[2:])) for ac in re[2:] ])) for re in rs[1:] ])
+                blocks.append ((triggers, responses))
+
+        return tuple (blocks)
+
+
     def printme (self):
         odef = {
                 'pst_tr': {
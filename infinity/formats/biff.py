@@ -19,7 +19,8 @@
 
 import gzip
 from infinity.format import Format, register_format
-from infinity.stream import CompressedStream
+from infinity.stream import BlockCompressedStream, CompressedStream
+from infinity.struc import RecordList
 
 
 class BIFF_Format (Format):
@@ -118,22 +119,20 @@ class BIFF_Format (Format):
         self.file_list = []
         self.tileset_list = []
 
+        # set when data of all the files were read into the records
+        self.all_data_read = False
+
 
     def read (self, stream):
         self.read_header (stream)
 
         off = self.header['files_offset']
-        for i in range (self.header['num_of_files']):
-            obj = {}
-            self.read_file_record (stream, off, obj)
-            self.file_list.append (obj)
-            off = off + 16
-
-        for i in range (self.header['num_of_tilesets']):
-            obj = {}
-            self.read_tileset_record (stream, off, obj)
-            self.tileset_list.append (obj)
-            off = off + 20
+        self.file_list = self.read_records (stream, off, self.header['num_of_files'], self.file_record_desc)
+        off = off + 16 * self.header['num_of_files']
+        self.tileset_list = self.read_records (stream, off, self.header['num_of_tilesets'], self.tileset_record_desc)
+        for records in (self.file_list, self.tileset_list):
+            if isinstance (records, RecordList):
+                records.compact (('data', ))
 
         if self.get_option ('format.biff.read_data'):
             self.read_all_data (stream)
@@ -174,6 +173,17 @@ class BIFF_Format (Format):
         for obj in self.tileset_list:
             self.read_tileset_data (stream, obj)
 
+        self.all_data_read = True
+
+    def has_all_data (self):
+        return self.all_data_read
+
+    def get_data_size (self):
+        """Return # of bytes of file data held in the records by read_all_data()."""
+        if not self.all_data_read:
+            return 0
+        return sum ([ len (obj['data']) for obj in self.file_list + self.tileset_list ])
+
 
     def read_ntset_data (self, stream, obj):
         obj['data'] = stream.read_blob (obj['data_offset'], obj['data_size'])
@@ -195,6 +205,17 @@ class BIFF_Format (Format):
         else:
             return self.read_ntset_data (stream, obj)
 
+    def read_file_data (self, stream, obj):
+        """Return data of file or tileset record `obj', without storing
+        them in the record unless they were read already."""
+        if obj.has_key ('data'):
+            return obj['data']
+
+        if obj.has_key ('tile_cnt'):
+            return stream.read_blob (obj['data_offset'], obj['tile_size'] * obj['tile_cnt'])
+        else:
+            return stream.read_blob (obj['data_offset'], obj['data_size'])
+
     # FIXME: this is ugly
 
     def save_file_data (self, stream, filename, obj):
@@ -205,6 +226,7 @@ class BIFF_Format (Format):
         fh.close ()
 
 
+# 'BIF V1.0' (CBF) files, compressed as a whole
 class BIFC_V1_Format (BIFF_Format):
     envelope_desc = (
             { 'key': 'signature',
@@ -271,5 +293,53 @@ class BIFC_V1_Format (BIFF_Format):
 
 
 
+# 'BIFCV1.0' files, compressed in blocks which are decompressed only
+#   when the data in them are read
+class BIFC_V10_Format (BIFF_Format):
+    envelope_desc = (
+            { 'key': 'signature',
+              'type': 'STR4',
+              'off': 0x0000,
+              'label': 'Signature' },
+
+            { 'key': 'version',
+              'type': 'STR4',
+              'off':0x0004,
+              'label': 'Version'},
+
+            { 'key': 'uncompressed_size',
+              'type': 'DWORD',
+              'off': 0x0008,
+              'label': 'Uncompressed size'},
+             )
+
+    def __init__ (self):
+        BIFF_Format.__init__ (self)
+        self.data_stream = None
+
+    def read (self, stream):
+        self.read_envelope (stream)
+        self.data_stream = BlockCompressedStream ().open (stream, 0x000C, self.envelope['uncompressed_size'], name = stream.name)
+        return BIFF_Format.read (self, self.data_stream)
+
+    def read_file_data (self, stream, obj):
+        # `stream' is the compressed stream
+        return BIFF_Format.read_file_data (self, self.data_stream, obj)
+
+    def printme (self):
+        self.print_envelope ()
+        print()
+        BIFF_Format.printme (self)
+
+    def read_envelope (self, stream):
+        self.envelope = {}
+        self.read_struc (stream, 0x0000, self.envelope_desc, self.envelope)
+
+    def print_envelope (self):
+        self.print_struc (self.envelope, self.envelope_desc)
+
+
+
 register_format (BIFF_Format, signature='BIFFV1  ', extension='BIF', name=('BIF', 'BIFF'))
 register_format (BIFC_V1_Format, signature='BIF V1.0', extension='CBF', name='CBF')
+register_format (BIFC_V10_Format, signature='BIFCV1.0', name='BIFC')
@@ -497,22 +497,42 @@ class CHUI_Format (Format):
         return self
 
 
-    def write (self, stream):
-        # update
+    def measure (self):
         self.header['window_offset'] = self.get_struc_size (self.header_desc, self.header)
         self.header['num_of_windows'] = len (self.window_list)
 
         offset = self.header['window_offset']
-        controls = []
+        controls = self.get_controls ()
         for obj in self.window_list:
             offset += self.get_struc_size (self.window_record_desc, obj)
-            obj['control_ndx'] = len (controls)
             obj['num_of_controls'] = len (obj['control_list'])
-            controls.extend(obj['control_list'])
 
         self.header['control_table_offset'] = offset
 
-        # write
+        control_table_record_size = self.get_struc_size (self.control_table_record_desc)
+        control_offset = offset + len (controls) * control_table_record_size
+        for obj in controls:
+            obj['control_offset'] = control_offset
+            obj['control_len'] = self.get_control_record_size (obj)
+            control_offset += obj['control_len']
+
+        return control_offset
+
+
+    def get_controls (self):
+        """Return list of controls of all the windows, setting the index
+        of the first control of each window."""
+        controls = []
+        for obj in self.window_list:
+            obj['control_ndx'] = len (controls)
+            controls.extend(obj['control_list'])
+        return controls
+
+
+    def write (self, stream):
+        stream.reserve (self.measure ())
+        controls = self.get_controls ()
+
         self.write_header (stream)
         offset = self.header['window_offset']
         for obj in self.window_list:
@@ -520,12 +540,8 @@ class CHUI_Format (Format):
             offset += self.get_struc_size (self.window_record_desc, obj)
 
         control_table_record_size = self.get_struc_size (self.control_table_record_desc)
-        control_offset = offset + len (controls) * control_table_record_size
         for obj in controls:
-            obj['control_offset'] = control_offset
-            obj['control_len'] = self.get_control_record_size (obj)
             self.write_struc (stream, offset, self.control_table_record_desc, obj)
-            control_offset += obj['control_len']
             offset += control_table_record_size
 
         for obj in controls:
@@ -757,10 +757,7 @@ class CRE_V10_Format (Format):
 
     def read (self, stream):
         self.read_header (stream)
-        self.read_list (stream, 'known_spell')
-        self.read_list (stream, 'spell_memorization')
-        self.read_list (stream, 'memorized_spell')
-        self.read_list (stream, 'item')
+        self.read_lists (stream, ('known_spell', 'spell_memorization', 'memorized_spell', 'item'), self.get_section_stream (stream))
 
         self.slots = {}
         self.read_struc (stream, self.header['item_slot_off'], self.item_slot_desc, self.slots)
@@ -1307,59 +1307,57 @@ class CRE_V22_Format (Format):
     def read (self, stream):
         self.read_header (stream)
 
-        self.known_spells = {}
-        for key in self.magic_class_keys:
-            self.known_spells[key] = []
-            for i, (cnt, off) in enumerate(zip(self.header[key+'_spell_count'], self.header[key+'_spell_offset'])):
-                spells = []
-                for j in range(cnt):
-                    obj = {}
-                    self.read_struc (stream, off, self.known_spell_desc, obj)
-                    spells.append(obj)
-                    off += self.get_struc_size(self.known_spell_desc)
+        section_stream = self.get_section_stream (stream)
+        for name, fn in (('known_spells', self.read_known_spells),
+                         ('domain_spells', self.read_domain_spells),
+                         ('abilities', self.read_abilities)):
+            if section_stream is None:
+                setattr (self, name, fn (stream))
+            else:
+                self.defer (name, fn, section_stream)
 
-                obj2 = {}
-                self.read_struc (stream, off, self.spell_memorization_desc, obj2)
+        #self.read_list (stream, 'known_spell')
+        #self.read_list (stream, 'spell_memorization')
+        # effects
+        self.read_lists (stream, ('item', ), section_stream)
 
-                self.known_spells[key].append({ 'spells': spells, 'memorization_info': obj2 })
+        self.slots = {}
+        self.read_struc (stream, self.header['item_slot_off'], self.item_slot_desc, self.slots)
+
+    def read_known_spells (self, stream):
+        known_spells = {}
+        for key in self.magic_class_keys:
+            known_spells[key] = []
+            for i, (cnt, off) in enumerate(zip(self.header[key+'_spell_count'], self.header[key+'_spell_offset'])):
+                known_spells[key].append (self.read_spells (stream, cnt, off))
+        return known_spells
 
-        self.domain_spells = {}
+    def read_domain_spells (self, stream):
+        domain_spells = {}
         for key in range(1, 10):
             cnt, off = self.header['domain%d_spell_count' %key], self.header['domain%d_spell_offset' %key]
-            spells = []
-            for j in range(cnt):
-                obj = {}
-                self.read_struc (stream, off, self.known_spell_desc, obj)
-                spells.append(obj)
-                off += self.get_struc_size(self.known_spell_desc)
-
-            obj2 = {}
-            self.read_struc (stream, off, self.spell_memorization_desc, obj2)
-
-            self.domain_spells[key] = { 'spells': spells, 'memorization_info': obj2 }
+            domain_spells[key] = self.read_spells (stream, cnt, off)
+        return domain_spells
 
-        self.abilities = {}
+    def read_abilities (self, stream):
+        abilities = {}
         for key in ('ability', 'song', 'shape'):
             cnt, off = self.header['%s_cnt' %key], self.header['%s_off' %key]
-            spells = []
-            for j in range(cnt):
-                obj = {}
-                self.read_struc (stream, off, self.known_spell_desc, obj)
-                spells.append(obj)
-                off += self.get_struc_size(self.known_spell_desc)
+            abilities[key] = self.read_spells (stream, cnt, off)
+        return abilities
 
-            obj2 = {}
-            self.read_struc (stream, off, self.spell_memorization_desc, obj2)
+    def read_spells (self, stream, cnt, off):
+        spells = []
+        for j in range(cnt):
+            obj = {}
+            self.read_struc (stream, off, self.known_spell_desc, obj)
+            spells.append(obj)
+            off += self.get_struc_size(self.known_spell_desc)
 
-            self.abilities[key] = { 'spells': spells, 'memorization_info': obj2 }
+        obj2 = {}
+        self.read_struc (stream, off, self.spell_memorization_desc, obj2)
 
-        #self.read_list (stream, 'known_spell')
-        #self.read_list (stream, 'spell_memorization')
-        # effects
-        self.read_list (stream, 'item')
-
-        self.slots = {}
-        self.read_struc (stream, self.header['item_slot_off'], self.item_slot_desc, self.slots)
+        return { 'spells': spells, 'memorization_info': obj2 }
 
     def printme (self):
         self.print_header ()
@@ -38,15 +38,14 @@ class D2A_Format (Format):
 
 
     def read (self, stream):
-        s = ""
-        line_no = 0
+        lines = stream.iter_lines ()
 
-        self.signature = stream.get_line ().strip ()
+        self.signature = lines.next ().strip ()
         # FIXME: check the header
 
-        self.default_value = stream.get_line ().strip ()
+        self.default_value = lines.next ().strip ()
 
-        s = stream.get_line ()
+        s = lines.next ()
         s = s.strip ()
         # FIXME: canonize the column names
         self.cols = s.split (None)
@@ -54,11 +53,7 @@ class D2A_Format (Format):
 
         line_no = 3
 
-        while s is not None:
-            s = stream.get_line ()
-            if s is None:
-                break
-
+        for s in lines:
             line_no = line_no + 1
 
             s = s.strip ()
@@ -348,7 +348,7 @@ class DLG_Format (Format):
             if (state['trigger_index'] != 0xffffffff):
                 print('  Trigger:', self.state_trigger_list[state['trigger_index']]['code'])
             if core.strrefs:
-                print('  Text:', core.strrefs.strref_list[state['npc_text']]['string'])
+                print('  Text:', core.strrefs.get_string (state['npc_text']))
             else:
                 print('  Text:', state['npc_text'])
 
@@ -367,7 +367,7 @@ class DLG_Format (Format):
 
         if (transition['flags'] & 0x01) and transition['pc_text'] != 0xffffffff:
             if core.strrefs:
-                print('    Text:', core.strrefs.strref_list[transition['pc_text']]['string'])
+                print('    Text:', core.strrefs.get_string (transition['pc_text']))
             else:
                 print('    Text:', transition['pc_text'])
 
@@ -363,10 +363,7 @@ class GAM_V11_Format (Format):
     def read (self, stream):
         self.read_header (stream)
 
-        self.read_list (stream, 'pc')
-        self.read_list (stream, 'npc')
-        self.read_list (stream, 'global')
-        self.read_list (stream, 'journal_entry')
+        self.read_lists (stream, ('pc', 'npc', 'global', 'journal_entry'), self.get_section_stream (stream))
 
     def update (self):
         off = self.size_struc (self.header_desc)
@@ -1000,12 +1000,7 @@ class GAM_V22_Format (Format):
     def read (self, stream):
         self.read_header (stream)
 
-        self.read_list (stream, 'pc')
-        self.read_list (stream, 'npc')
-        self.read_list (stream, 'global')
-        self.read_list (stream, 'journal_entry')
-        self.read_list (stream, 'stored_location')
-        self.read_list (stream, 'pocket_plane_location')
+        self.read_lists (stream, ('pc', 'npc', 'global', 'journal_entry', 'stored_location', 'pocket_plane_location'), self.get_section_stream (stream))
 
         obj = {}
         self.read_struc (stream, self.header['familiar_off'], self.familiar_info_desc, obj)
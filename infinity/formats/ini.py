@@ -33,14 +33,9 @@ class INI_Format (Format):
         self.ids_list = []
 
     def read (self, stream):
-        s = ""
         line_no = 0
 
-        while s is not None:
-            s = stream.get_line ()
-            if s is None:
-                break
-
+        for s in stream.iter_lines ():
             line_no = line_no + 1
 
             s = s.strip ()
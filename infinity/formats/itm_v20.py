@@ -540,9 +540,9 @@ class ITM_V20_Format (Format):
         size_extended = self.get_struc_size (self.extended_header_desc)
         size_feature = self.get_struc_size (self.feature_desc)
 
-        self.header['extended_header_off'] = self.get_struc_size (self.header)
+        self.header['extended_header_off'] = self.get_struc_size (self.header_desc)
         self.header['extended_header_cnt'] = len (self.extended_header_list)
-        self.header['feature_block_off'] = len (self.extended_header_list) * size_extended
+        self.header['feature_block_off'] = self.header['extended_header_off'] + len (self.extended_header_list) * size_extended
         self.header['equipping_feature_ndx'] = 0
         self.header['equipping_feature_cnt'] = len (self.equipping_feature_list)
 
@@ -595,7 +595,7 @@ class ITM_V20_Format (Format):
             off2 += size_feature
 
     def write_extended_header (self, stream, offset, obj):
-        self.write_struc (stream, offset, obj)
+        self.write_struc (stream, offset, self.extended_header_desc, obj)
         size_feature = self.get_struc_size (self.feature_desc)
         off2 = self.header['feature_block_off'] +obj['feature_ndx'] * size_feature
         for obj2 in obj['feature_list']:
@@ -614,6 +614,9 @@ class ITM_V20_Format (Format):
     def read_feature (self, stream, offset, obj):
         self.read_struc (stream, offset, self.feature_desc, obj)
 
+    def write_feature (self, stream, offset, obj):
+        self.write_struc (stream, offset, self.feature_desc, obj)
+
     def print_feature (self, obj):
         self.print_struc (obj, self.feature_desc)
 
@@ -17,11 +17,11 @@
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
 
 
-import re
-import sys
 
 from infinity import core
 from infinity.format import Format, register_format
+from infinity.query import NameIndex
+from infinity.struc import RecordList
 
 class KEY_Format (Format):
     header_desc = (
@@ -135,7 +135,10 @@ class KEY_Format (Format):
         self.bif_hash = {}
 
         self.resref_list = []
-        self.resref_hash = {}
+
+        # lookup tables over resref_list, see build_resref_index ()
+        self.resref_index = None
+        self.bif_name_index = None
 
         # when set to some number, read that number of resources at most
         #self.options['max_read_bifs'] = None
@@ -144,47 +147,40 @@ class KEY_Format (Format):
     def read (self, stream):
         self.read_header (stream)
 
-        off = self.header['bif_offset']
-        bif_record_size = self.get_struc_size (self.bif_record_desc)
+        # NOTE: bif_list is indexed by the resrefs' locator_src_ndx, so the bad
+        #   BIFs have to stay in it, but resrefs referencing them are dropped
         bad_biffs = [ "data/progtest.bif", "data/ProgTes2.bif" ]
-        for i in range (self.header['num_of_bifs']):
-            obj = {}
-            self.read_bif_record (stream, off, obj)
+        self.bif_list = self.read_records (stream, self.header['bif_offset'], self.header['num_of_bifs'], self.bif_record_desc)
+        good_bifs = set ()
+        for i, obj in enumerate (self.bif_list):
             if obj['file_name'] in bad_biffs:
-                # no need to decrease self.header['num_of_bifs']
                 continue
-            self.bif_list.append (obj)
+            good_bifs.add (i)
             self.bif_hash[obj['file_name']] = obj
-            off = off + bif_record_size
 
-        off = self.header['resref_offset']
         max_read_resrefs = self.header['num_of_resrefs']
         if self.get_option ('format.key.max_read_resrefs'):
             max_read_resrefs = min (max_read_resrefs, self.get_option ('format.key.max_read_resrefs'))
 
-        resref_record_size = self.get_struc_size (self.resref_record_desc)
-        tick_size = self.get_option ('format.key.tick_size')
-        tack_size = self.get_option ('format.key.tack_size')
-        for i in range (max_read_resrefs):
-            #if i == 1000:
-            #    break
-
-            obj = {}
-            self.read_resref_record (stream, off, obj)
-            try:
-                obj['file_name'] = self.bif_list[obj['locator_src_ndx']]
-            except IndexError:
-                continue # entries referencing bad_biffs
-            self.resref_list.append (obj)
-            self.resref_hash[obj['resref_name']] = obj
-            off = off + resref_record_size
-
-            if not (i % tick_size):
-                sys.stdout.write('.')
-                if not (i % tack_size):
-                    sys.stdout.write('%d' %i)
-                sys.stdout.flush ()
-        print()
+        resrefs = self.read_records (stream, self.header['resref_offset'], max_read_resrefs, self.resref_record_desc)
+        if isinstance (resrefs, RecordList):
+            # drop entries referencing bad_biffs before they are decoded
+            get_src_ndx = resrefs.layout.getter ('locator_src_ndx')
+            resrefs.filter_values (lambda v: get_src_ndx (v) in good_bifs)
+            resrefs.finish = self.finish_resref_record
+            resrefs.compact (('file_name', ))
+            self.resref_list = resrefs
+        else:
+            for obj in resrefs:
+                if obj['locator_src_ndx'] in good_bifs:
+                    self.finish_resref_record (obj)
+                    self.resref_list.append (obj)
+
+        self.build_resref_index ()
+
+
+    def finish_resref_record (self, obj, index = None):
+        obj['file_name'] = self.bif_list[obj['locator_src_ndx']]
 
     def write (self, stream):
         # FIXME: STROFF is missing
@@ -243,29 +239,95 @@ class KEY_Format (Format):
 
 
     def get_bif_by_name_re (self, name):
-        rx = re.compile (name)
-        return filter (lambda s, rx=rx: rx.search (s['file_name']), self.bif_list)
+        if self.bif_name_index is None or len (self.bif_name_index) != len (self.bif_list):
+            self.bif_name_index = NameIndex ([ o['file_name'] for o in self.bif_list ])
+        return [ self.bif_list[i] for i in self.bif_name_index.search (name) ]
+
+
+    def build_resref_index (self):
+        """Build lookup tables over resref_list.
+
+        The tables hold positions in resref_list, keyed by uppercased name,
+        by (uppercased name, type), by type and by BIF index, in resref_list
+        order. The sorted name index for pattern queries is built on first
+        use. They are rebuilt automatically when the length of resref_list
+        changes, call this after modifying the entries in place."""
+
+        if isinstance (self.resref_list, RecordList):
+            names = self.resref_list.column ('resref_name')
+            types = self.resref_list.column ('type')
+            src_ndxs = self.resref_list.column ('locator_src_ndx')
+        else:
+            names = [ o['resref_name'] for o in self.resref_list ]
+            types = [ o['type'] for o in self.resref_list ]
+            src_ndxs = [ o['locator_src_ndx'] for o in self.resref_list ]
+
+        by_name = {}
+        by_name_and_type = {}
+        by_type = {}
+        by_file = {}
+        for i, name in enumerate (names):
+            name = name.upper ()
+            type = types[i]
+            by_name.setdefault (name, []).append (i)
+            by_name_and_type.setdefault ((name, type), []).append (i)
+            by_type.setdefault (type, []).append (i)
+            by_file.setdefault (src_ndxs[i], []).append (i)
+
+        self.resref_index = {
+            'len': len (names),
+            'name': by_name,
+            'name_and_type': by_name_and_type,
+            'type': by_type,
+            'file': by_file,
+            'names': names,
+            'types': types,
+            'sorted': None,
+            }
+
+    def get_resref_index (self, table):
+        if self.resref_index is None or self.resref_index['len'] != len (self.resref_list):
+            self.build_resref_index ()
+        if table == 'sorted' and self.resref_index['sorted'] is None:
+            self.resref_index['sorted'] = NameIndex (self.resref_index['names'], fold = True)
+        return self.resref_index[table]
+
+    def get_resrefs_at (self, positions, type = None):
+        if type is not None:
+            types = self.get_resref_index ('types')
+            positions = [ i for i in positions if types[i] == type ]
+        return [ self.resref_list[i] for i in positions ]
+
+    def get_resref_types (self):
+        """Return dict of resource types found in resref_list with their counts."""
+        return dict ([ (type, len (pos)) for type, pos in self.get_resref_index ('type').items () ])
 
 
     def get_resref_by_file_index (self, index):
-        return filter (lambda s, i=index: s['locator_src_ndx'] == i, self.resref_list)
+        return self.get_resrefs_at (self.get_resref_index ('file').get (index, []))
+
+    def get_resref_by_name_re (self, name, type = None):
+        return self.get_resrefs_at (self.get_resref_index ('sorted').search (name), type)
 
-    def get_resref_by_name_re (self, name):
-        rx = re.compile (name)
-        return filter (lambda s, rx=rx: rx.search (s['resref_name']), self.resref_list)
+    def get_resref_by_prefix (self, prefix, type = None):
+        """Return resrefs whose names start with `prefix' (case insensitive)."""
+        return self.get_resrefs_at (self.get_resref_index ('sorted').prefix (prefix), type)
+
+    def get_resref_by_glob (self, pattern, type = None):
+        """Return resrefs whose names match shell-style `pattern', e.g. `AR01*'
+        or `*SR' (case insensitive)."""
+        return self.get_resrefs_at (self.get_resref_index ('sorted').glob (pattern), type)
 
     def get_resref_by_name (self, name):
-        return filter (lambda s, name=name.upper (): s['resref_name'].upper () == name, self.resref_list)
+        return self.get_resrefs_at (self.get_resref_index ('name').get (name.upper (), []))
 
     def get_resref_by_type (self, type):
-        return filter (lambda s, type=type: s['type'] == type, self.resref_list)
+        return self.get_resrefs_at (self.get_resref_index ('type').get (type, []))
 
     def get_resref_by_name_and_type (self, name, type):
-        obj = self.get_resref_by_name (name)
-
         if type is None:
-            return obj
+            return self.get_resref_by_name (name)
 
-        return filter (lambda o: o['type'] == type, obj)
+        return self.get_resrefs_at (self.get_resref_index ('name_and_type').get ((name.upper (), type), []))
 
 register_format (KEY_Format, signature='KEY V1  ', extension='KEY', name='KEY')
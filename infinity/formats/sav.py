@@ -18,10 +18,18 @@
 
 
 import gzip
+import os.path
+import struct
+import zlib
+from multiprocessing.pool import ThreadPool
+
 from infinity.format import Format, register_format
 from infinity.stream import CompressedStream
 
 
+sizes_struct = struct.Struct ('<II')
+
+
 class SAV_Format (Format):
     header_desc = (
           { 'key': 'signature',
@@ -73,19 +81,26 @@ class SAV_Format (Format):
 
 
     def read (self, stream):
+        """Read the header and index the files, without reading their data."""
         self.read_header (stream)
 
         off = self.get_struc_size (self.header_desc)
 
         while True:
-            obj = {}
-            try:
-                self.read_struc (stream, off, self.file_desc, obj)
-            except:
-                # Assume all exception to be struct.error due to eof
+            # filename length (DWORD), asciiz filename, sizes (2x DWORD)
+            data = stream.read_blob (off, 4)
+            if len (data) < 4:
                 break
-            off += len (obj['filename']) + 1
-            self.read_struc (stream, off, self.file2_desc, obj)
+            length = struct.unpack ('<I', data)[0]
+            data = stream.read_blob (off + 4, length)
+            filename = data.split ('\0', 1)[0]
+            off += len (filename) + 1
+
+            data = stream.read_blob (off + 4, sizes_struct.size)
+            if len (data) < sizes_struct.size:
+                break
+            obj = { 'filename': filename }
+            obj['uncompressed_size'], obj['compressed_size'] = sizes_struct.unpack (data)
             off += self.get_struc_size (self.file2_desc)
             obj['data_offset'] = off
             off += obj['compressed_size']
@@ -108,7 +123,7 @@ class SAV_Format (Format):
             off += len (obj['filename']) + 1
             self.write_struc (stream, off, self.file2_desc, obj)
             off += self.get_struc_size (self.file2_desc)
-            stream.write_blob (obj['data'], off, obj['compressed_size'])
+            stream.write_blob (obj['data'], off)
             off += obj['compressed_size']
 
 
@@ -136,19 +151,112 @@ class SAV_Format (Format):
 
 
     def read_all_data (self, stream):
-        for obj in self.file_list:
-            self.read_data (stream, obj)
-            # FIXME: uncompress
+        objs = [ obj for obj in self.file_list if not obj.has_key ('data') ]
+        for obj, data in zip (objs, self.map_threads (zlib.decompress, [ self.read_compressed_data (stream, obj) for obj in objs ])):
+            obj['data'] = data[:obj['uncompressed_size']]
 
     def read_data (self, stream, obj):
-        data = stream.read_blob (obj['data_offset'], obj['compressed_size'])
-        stream2 = CompressedStream ().open (data)
+        stream2 = self.get_file_stream (stream, obj)
         obj['data'] = stream2.read_blob (0, obj['uncompressed_size'])
         return obj['data']
 
-    # FIXME: there should be a fn, which would just return a stream. That stream
-    #   would (if read) on-demand read the original file and uncompress it on the fly
-    #   to minimize memory consumption
+    def read_compressed_data (self, stream, obj):
+        return stream.read_blob (obj['data_offset'], obj['compressed_size'])
+
+    def get_file_stream (self, stream, obj):
+        """Return stream decompressing data of file `obj' as they are read."""
+        return CompressedStream ().open (self.read_compressed_data (stream, obj), name = obj['filename'])
+
+    def get_file_by_name (self, filename):
+        for obj in self.file_list:
+            if obj['filename'].upper () == filename.upper ():
+                return obj
+        return None
+
+    def map_threads (self, fn, values):
+        """Return map (fn, values), computed in format.sav.threads threads.
+        zlib releases the GIL, so the threads (de)compress in parallel."""
+        threads = self.get_option ('format.sav.threads')
+        if threads < 2 or len (values) < 2:
+            return map (fn, values)
+
+        pool = ThreadPool (threads)
+        try:
+            return pool.map (fn, values)
+        finally:
+            pool.close ()
+            pool.join ()
+
+    def get_extract_path (self, dir, filename):
+        """Return path of file `filename' extracted into directory `dir', or
+        None if it's not a plain file name, which would be written elsewhere."""
+        if filename in ('', '.', '..') or '/' in filename or '\\' in filename or os.path.isabs (filename):
+            return None
+
+        path = os.path.join (dir, filename)
+        if os.path.dirname (os.path.realpath (path)) != os.path.realpath (dir):
+            return None
+        return path
+
+    def extract_all (self, stream, dir):
+        """Decompress all files into directory `dir'. Files are decompressed
+        in parallel, a batch of format.sav.threads files at a time. Files
+        with names other than plain file names are not extracted. Return
+        list of (filename, error message)."""
+        errors = []
+        objs = []
+        for obj in self.file_list:
+            if self.get_extract_path (dir, obj['filename']) is None:
+                errors.append ((obj['filename'], "Not a plain file name or points outside the directory, not extracted"))
+            else:
+                objs.append (obj)
+
+        batch = max (1, self.get_option ('format.sav.threads'))
+        for i in range (0, len (objs), batch):
+            batch_objs = objs[i:i + batch]
+            datas = self.map_threads (zlib.decompress, [ self.read_compressed_data (stream, obj) for obj in batch_objs ])
+            for obj, data in zip (batch_objs, datas):
+                fh = open (self.get_extract_path (dir, obj['filename']), 'wb')
+                try:
+                    fh.write (data[:obj['uncompressed_size']])
+                finally:
+                    fh.close ()
+
+        return errors
+
+    def write_files (self, stream, files):
+        """Write SAV file with `files', an iterable of (filename, data), into
+        `stream'. Unlike append_file() and write(), the files aren't kept in
+        file_list, they are compressed in parallel, a batch of
+        format.sav.threads files at a time, and written right away."""
+        self.header = {}
+        self.header['signature'] = 'SAV '
+        self.header['version'] = 'V1.0'
+        self.write_header (stream)
+        off = self.get_struc_size (self.header_desc)
+
+        batch = max (1, self.get_option ('format.sav.threads'))
+        pending = []
+        files = iter (files)
+        while True:
+            for filename, data in files:
+                pending.append ((filename, data))
+                if len (pending) >= batch:
+                    break
+
+            if not pending:
+                break
+
+            datas = self.map_threads (zlib.compress, [ data for filename, data in pending ])
+            for (filename, data), cdata in zip (pending, datas):
+                obj = { 'filename': filename, 'uncompressed_size': len (data), 'compressed_size': len (cdata) }
+                self.write_struc (stream, off, self.file_desc, obj)
+                off += len (filename) + 1
+                self.write_struc (stream, off, self.file2_desc, obj)
+                off += self.get_struc_size (self.file2_desc)
+                stream.write_blob (cdata, off)
+                off += len (cdata)
+            pending = []
 
     # FIXME: the following API is ugly
 
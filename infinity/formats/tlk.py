@@ -20,12 +20,14 @@
 # Conforms to IESDP 2012-04-22
 from __future__ import print_function
 import codecs
-import re
+import collections
 import string
 import sys
 
 from infinity import core
 from infinity.format import Format, register_format
+from infinity.query import NameIndex, TrigramIndex
+from infinity.struc import compile_struc, RecordList
 
 
 class TLK_Format (Format):
@@ -105,60 +107,101 @@ class TLK_Format (Format):
         self.expect_signature = 'TLK'
 
         self.strref_list = []
+        # sorted index over the strings for regex queries
+        self.string_index = None
+        # trigram index for substring, word and regex searches
+        self.trigram_index = None
+        # name of the file read, if any
+        self.filename = None
+
+        # buffer holding the file when reading lazily
+        self.buffer = None
+        # recently used strings of not yet decoded strrefs, see get_string ()
+        self.string_cache = collections.OrderedDict ()
 
 
     def read (self, stream):
         self.read_header (stream)
+        if getattr (stream, 'filename', '<file>') != '<file>':
+            self.filename = stream.filename
 
         off = 0x0012
 
         if not self.get_option ('format.tlk.decode_strrefs'):
             return
 
-        tick_size = core.get_option ('format.tlk.tick_size')
-        tack_size = core.get_option ('format.tlk.tack_size')
-
-        for i in range (self.header['num_of_strrefs']):
-
-            obj = {}
+        if self.get_option ('format.tlk.lazy') and stream.buffer is not None:
+            # keep the entries packed and the strings in the (mapped) file,
+            #   strrefs are decoded when accessed
+            self.buffer = stream.detach_buffer ()
+            records = self.read_records (stream, off, self.header['num_of_strrefs'], self.strref_record_desc, packed = True)
+            if isinstance (records, RecordList):
+                records.finish = self.finish_strref_record
+                records.compact (('_strref', 'string_raw', 'string'))
+                self.strref_list = records
+                return
+
+        records = self.read_records (stream, off, self.header['num_of_strrefs'], self.strref_record_desc)
+        for i, obj in enumerate (records):
             obj['_strref'] = i
-            self.read_strref_record (stream, off, obj)
+            self.read_strref_string (stream, obj)
             self.strref_list.append (obj)
-            off = off + 26
 
-            if not (i % tick_size):
-                sys.stdout.write('.')
-                if not (i % tack_size):
-                    sys.stdout.write('%d' %i)
-                sys.stdout.flush ()
-        print()
 
+    def measure (self):
+        return self.layout_strrefs ()[0]
 
-    def write (self, stream):
-        tick_size = core.get_option ('format.tlk.tick_size')
-        tack_size = core.get_option ('format.tlk.tack_size')
 
-        self.header['num_strings'] = len (self.strref_list)
-        self.header['string_offset'] = self.get_struc_size (self.header_desc, self.header) + len (self.strref_list) * self.get_struc_size (self.strref_record_desc, None)
-        self.write_struc (stream, 0x0000, self.header_desc, self.header)
+    def layout_strrefs (self):
+        """Encode the strings and lay them out after the strref table.
+        Return size of the file, the packed table and list of the strings.
 
-        strref_offset = self.get_struc_size (self.header_desc, self.header)
+        Strrefs of a lazily read TLK which were never accessed are not
+        decoded, their raw strings are taken from the file as they are."""
+        tick_size = core.get_option ('format.tlk.tick_size')
+        tack_size = core.get_option ('format.tlk.tack_size')
+        tlk_enc = self.get_option ('format.tlk.encoding')
+        io_enc = self.get_option ('encoding')
+
+        strrefs = self.strref_list
+        self.header['num_of_strrefs'] = len (strrefs)
+        self.header['string_offset'] = self.get_struc_size (self.header_desc, self.header) + len (strrefs) * self.get_struc_size (self.strref_record_desc, None)
+
+        layout = compile_struc (self.strref_record_desc)
+        pack = layout.struct.pack
+        lazy = isinstance (strrefs, RecordList) and self.buffer is not None and not layout.slow_desc
+        if lazy:
+            offset_ndx = layout.field_ndx['string_offset']
+            get_offset = layout.getter ('string_offset')
+            get_len = layout.getter ('string_len')
+
+        table = []
+        strings = []
         string_offset = 0
-        strref_size = self.get_struc_size (self.strref_record_desc, None)
-        for i, strref in enumerate (self.strref_list):
-            # FIXME: possibly test strref type instead
-            self.encode(strref)
-
-            if len (strref['string_raw']) != 0:
-                strref['string_offset'] = string_offset
-                stream.write_sized_string (strref['string_raw'], self.header['string_offset'] + string_offset, len (strref['string_raw']))
+        for i in range (len (strrefs)):
+            # None once the strref is decoded
+            values = lazy and strrefs.values[i]
+            if values:
+                values = list (values)
+                raw = self.read_raw_string (get_offset (values), get_len (values))
+                values[offset_ndx] = len (raw) and string_offset
+                table.append (pack (*values))
             else:
-                strref['string_offset'] = 0
-            strref['string_len'] = len (strref['string_raw'])
-            self.write_struc (stream, strref_offset, self.strref_record_desc, strref)
-            # FIXME: or raw_string ?
-            strref_offset += strref_size
-            string_offset += len (strref['string_raw'])
+                strref = strrefs[i]
+                # FIXME: possibly test strref type instead
+                if tlk_enc or io_enc:
+                    self.encode(strref, tlk_enc, io_enc)
+                else:
+                    strref['string_raw'] = strref['string']
+
+                raw = strref['string_raw']
+                strref['string_offset'] = len (raw) and string_offset
+                strref['string_len'] = len (raw)
+                if not layout.slow_desc:
+                    table.append (pack (*layout.pack (strref)))
+
+            strings.append (raw)
+            string_offset += len (raw)
 
             if not (i % tick_size):
                 sys.stdout.write('.')
@@ -167,6 +210,24 @@ class TLK_Format (Format):
                 sys.stdout.flush ()
         print()
 
+        if layout.slow_desc:
+            table = None
+        return self.header['string_offset'] + string_offset, table, strings
+
+
+    def write (self, stream):
+        size, table, strings = self.layout_strrefs ()
+        stream.reserve (size)
+        self.write_struc (stream, 0x0000, self.header_desc, self.header)
+
+        strref_offset = self.get_struc_size (self.header_desc, self.header)
+        if table is None:
+            self.write_records (stream, strref_offset, self.strref_record_desc, self.strref_list)
+        else:
+            stream.write_blob (b''.join (table), strref_offset)
+        # FIXME: or raw_string ?
+        stream.write_blob (b''.join (strings), self.header['string_offset'])
+
 
     def printme (self):
         self.print_header ()
@@ -180,9 +241,73 @@ class TLK_Format (Format):
 
     def read_strref_record (self, stream, offset, obj):
         self.read_struc (stream, offset, self.strref_record_desc, obj)
+        self.read_strref_string (stream, obj)
+
+
+    def read_strref_string (self, stream, obj):
         obj['string_raw'] = stream.read_sized_string (self.header['string_offset'] + obj['string_offset'], obj['string_len'])
         self.decode(obj)
 
+    def finish_strref_record (self, obj, index):
+        obj['_strref'] = index
+        obj['string_raw'] = self.read_raw_string (obj['string_offset'], obj['string_len'])
+        self.string_cache.pop (index, None)
+        self.decode (obj)
+
+    def read_raw_string (self, offset, size):
+        offset = self.header['string_offset'] + offset
+        return self.buffer[offset:offset + size]
+
+    def get_string (self, strref, cache = True):
+        """Return the text of `strref'.
+
+        When the TLK was read lazily and the strref wasn't accessed yet,
+        only its string is decoded, without building the strref record.
+        Recently used such strings are cached, unless `cache' is False."""
+        if not isinstance (self.strref_list, RecordList) or self.strref_list.is_decoded (strref):
+            return self.strref_list[strref]['string']
+
+        if not cache:
+            return self.string_cache.get (strref) or self.decode_string (strref)
+
+        cache = self.string_cache
+        try:
+            text = cache.pop (strref)
+        except KeyError:
+            text = self.decode_string (strref)
+            if len (cache) >= self.get_option ('format.tlk.string_cache_size'):
+                cache.popitem (last = False)
+        cache[strref] = text
+        return text
+
+    def get_uncached_string (self, strref):
+        return self.get_string (strref, False)
+
+    def decode_string (self, strref):
+        values = self.strref_list.values[strref]
+        layout = self.strref_list.layout
+        obj = { '_strref': strref }
+        obj['string_raw'] = self.read_raw_string (layout.getter ('string_offset') (values), layout.getter ('string_len') (values))
+        self.decode (obj)
+        return obj['string']
+
+    def iter_strings (self):
+        """Generate texts of all the strrefs, without building the records
+        or filling the string cache."""
+        for i in range (len (self.strref_list)):
+            if isinstance (self.strref_list, RecordList) and not self.strref_list.is_decoded (i):
+                yield self.decode_string (i)
+            else:
+                yield self.strref_list[i]['string']
+
+    def __getstate__ (self):
+        # the file buffer can't be saved, decode all the strrefs instead
+        state = dict (self.__dict__)
+        state['strref_list'] = list (self.strref_list)
+        state['buffer'] = None
+        state['string_cache'] = collections.OrderedDict ()
+        return state
+
 
     def print_strref_record (self, obj):
         self.print_struc (obj, self.strref_record_desc)
@@ -263,8 +388,58 @@ class TLK_Format (Format):
 
 
     def get_strref_by_str_re (self, text):
-        rx = re.compile (text)
-        return filter (lambda s, rx=rx: rx.search (s['string']), self.strref_list)
+        if self.trigram_index is not None or self.get_option ('format.tlk.trigram_search'):
+            positions = self.get_trigram_index ().search (text, self.get_uncached_string)
+        else:
+            if self.string_index is None or len (self.string_index) != len (self.strref_list):
+                self.build_string_index ()
+            positions = self.string_index.search (text)
+        return [ self.strref_list[i] for i in positions ]
+
+    def get_strref_by_substr (self, text, ignore_case = False):
+        positions = self.get_trigram_index ().search_substring (text, self.get_uncached_string, ignore_case)
+        return [ self.strref_list[i] for i in positions ]
+
+    def get_strref_by_words (self, words):
+        """Return strrefs containing all the `words' (as whole words, ignoring case)."""
+        positions = self.get_trigram_index ().search_words (words, self.get_uncached_string)
+        return [ self.strref_list[i] for i in positions ]
+
+    def get_trigram_index (self):
+        if self.trigram_index is None or len (self.trigram_index) != len (self.strref_list):
+            self.build_trigram_index ()
+        return self.trigram_index
+
+    def build_trigram_index (self, filename = None, force = False):
+        """(Re)build the trigram index used for searching the strings.
+
+        The index is loaded from `filename' if it was saved there for the
+        same TLK file, else built and saved into it. By default it's the
+        TLK file name with `.tri' appended, if format.tlk.save_trigrams
+        is set. Call this with `force' after modifying the strings in place."""
+        if filename is None and self.filename is not None and self.get_option ('format.tlk.save_trigrams'):
+            filename = self.filename + '.tri'
+
+        stamp = None
+        if self.filename is not None:
+            stamp = core.file_stamp (self.filename) + (len (self.strref_list), )
+
+        index = TrigramIndex ()
+        if force or filename is None or stamp is None or not index.load (filename, stamp):
+            index.build (self.iter_strings ())
+            index.stamp = stamp
+            if filename is not None and stamp is not None:
+                try:
+                    index.save (filename)
+                except IOError as e:
+                    print ('Trigram index not saved:', e, file=sys.stderr)
+
+        self.trigram_index = index
+
+    def build_string_index (self):
+        """(Re)build the index used by get_strref_by_str_re(). Call this
+        after modifying the strings in place."""
+        self.string_index = NameIndex (list (self.iter_strings ()))
 
 
 
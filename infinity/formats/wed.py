@@ -17,8 +17,11 @@
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
 
 
+import struct
+
 from infinity import core
 from infinity.format import Format, register_format
+from infinity.struc import RecordList
 
 class WED_Format (Format):
     header_desc = (
@@ -349,28 +352,18 @@ class WED_Format (Format):
 
     def read_overlay (self, stream, offset, obj):
         self.read_struc (stream, offset, self.overlay_desc, obj)
-        obj['tilemap_list'] = []
         cnt = obj['width'] * obj['height']
-        size = self.get_struc_size (self.tilemap_desc)
-
-        off2 = obj['tilemap_off']
-        tile_index_cnt = 0
-
-        for i in range (cnt):
-            obj2 = {}
-            self.read_tilemap (stream, off2, obj2,  obj)
-            obj['tilemap_list'].append (obj2)
-            off2 = off2 + size
-            tile_index_cnt +=  obj2['tile_index_lut_cnt']
-
-        obj['tile_index_list'] = []
-        size = 2 # FIXME: don't hardwire the size
-        off2 = obj['tile_index_lookup_off']
-
-        for i in range (tile_index_cnt):
-            tile_index = stream.read_word (off2)
-            obj['tile_index_list'].append (tile_index)
-            off2 += size
+        obj['tilemap_list'] = self.read_records (stream, obj['tilemap_off'], cnt, self.tilemap_desc)
+        tilemaps = obj['tilemap_list']
+        if isinstance (tilemaps, RecordList):
+            tile_index_cnt = sum (tilemaps.column ('tile_index_lut_cnt'))
+        else:
+            tile_index_cnt = sum ([ obj2['tile_index_lut_cnt'] for obj2 in tilemaps ])
+
+        # FIXME: don't hardwire the size
+        data = stream.read_blob (obj['tile_index_lookup_off'], 2 * tile_index_cnt)
+        tile_index_cnt = len (data) // 2
+        obj['tile_index_list'] = list (struct.unpack ('<%dH' %tile_index_cnt, data[:2 * tile_index_cnt]))
 
 
     def print_overlay (self, obj):
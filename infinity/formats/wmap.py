@@ -293,11 +293,23 @@ class WMAP_V10_Format (Format):
 
     def read (self, stream):
         self.read_header (stream)
+        self.read_list (stream,  'wmap')
+
+        section_stream = self.get_section_stream (stream)
+        if section_stream is None:
+            self.read_areas (stream)
+        else:
+            # a wmap has just a few entries, but hundreds of areas and links
+            self.defer ('area_list', self.read_deferred_areas, section_stream, 'area_list')
+            self.defer ('area_link_list', self.read_deferred_areas, section_stream, 'area_link_list')
 
+
+    def read_areas (self, stream):
         size_area = self.get_struc_size (self.area_desc)
         size_area_link = self.get_struc_size (self.area_link_desc)
 
-        self.read_list (stream,  'wmap')
+        self.area_list = []
+        self.area_link_list = []
 
         for wmap in self.wmap_list:
             off = wmap['area_off']
@@ -315,6 +327,17 @@ class WMAP_V10_Format (Format):
                 off += size_area_link
 
 
+    def read_deferred_areas (self, stream, name):
+        # both lists are read at once
+        deferred = self.__dict__.pop ('deferred', {})
+        deferred.pop ('area_list', None)
+        deferred.pop ('area_link_list', None)
+        if deferred:
+            self.__dict__['deferred'] = deferred
+        self.read_areas (stream)
+        return self.__dict__[name]
+
+
     def printme (self):
         self.print_header ()
 
@@ -0,0 +1,191 @@
+# -*-python-*-
+# ie_shell.py - Simple shell for Infinity Engine-based game files
+# Copyright (C) 2004-2011 by Jaroslav Benkovsky, <edheldil@users.sf.net>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+
+"""
+Index of the files in the override directory.
+
+Each file is described by a record {'path', 'resref_name', 'type'} and
+the records are looked up by uppercased resref name, or by name and type.
+The index is kept up to date incrementally: when the mtime of the
+directory changes, it's listed again and only the added and removed
+files are indexed or dropped. Programs adding or removing files can
+call notify() instead, which updates just the given files.
+"""
+
+import os
+import time
+
+from infinity import core
+
+
+class OverrideIndex (object):
+    def __init__ (self, dir):
+        self.dir = dir
+        # file name -> record, None for files of unknown type
+        self.entries = {}
+        # NAME -> [records], in the order the files were found
+        self.names = {}
+        # (NAME, type) -> [records]
+        self.names_and_types = {}
+
+        self.count = 0
+        # extension -> resource type, None if unknown
+        self.ext_types = {}
+
+        self.mtime = None
+        self.checked = 0
+
+    def __len__ (self):
+        return self.count
+
+    def __iter__ (self):
+        for recs in self.names.itervalues ():
+            for rec in recs:
+                yield rec
+
+    def get_records (self):
+        return list (self)
+
+    def load (self, verbose = False):
+        """Index all files in the directory."""
+        self.entries = {}
+        self.names = {}
+        self.names_and_types = {}
+        self.count = 0
+
+        self.mtime = os.stat (self.dir).st_mtime
+        self.checked = time.time ()
+        entries = os.listdir (self.dir)
+
+        if verbose:
+            print("Processing %d items from override" %(len(entries)))
+
+        for entry in entries:
+            if self.add_entry (entry) is None and verbose:
+                print ("Warning: unrecognized file: %s" %(entry))
+
+        if verbose:
+            print("%d items indexed" %(len(self)))
+
+    def load_records (self, records, mtime):
+        """Fill the index with `records' saved from get_records() when the
+        directory had `mtime'."""
+        self.entries = {}
+        self.names = {}
+        self.names_and_types = {}
+        self.count = 0
+        for rec in records:
+            self.add_record (os.path.basename (rec['path']), rec)
+        self.mtime = mtime
+        self.checked = 0
+
+    def refresh (self, force = False):
+        """Index files added and drop files removed since the last check, if
+        the mtime of the directory changed. The mtime is checked at most each
+        core.override_refresh_interval seconds, unless `force' is True."""
+        now = time.time ()
+        if not force and now - self.checked < core.get_option ('core.override_refresh_interval'):
+            return
+
+        self.checked = now
+        try:
+            mtime = os.stat (self.dir).st_mtime
+        except OSError:
+            mtime = None
+        if mtime == self.mtime and not force:
+            return
+
+        self.mtime = mtime
+        try:
+            entries = set (os.listdir (self.dir))
+        except OSError:
+            entries = set ()
+
+        for entry in self.entries.keys ():
+            if entry not in entries:
+                self.remove_entry (entry)
+
+        for entry in entries:
+            if entry not in self.entries:
+                self.add_entry (entry)
+
+    def notify (self, *paths):
+        """Update records of files `paths' which were added to or removed from
+        the directory.
+
+        The current mtime of the directory is taken as indexed, so the
+        notifying program should be the only one changing the directory."""
+        for path in paths:
+            entry = os.path.basename (path)
+            if entry in self.entries:
+                self.remove_entry (entry)
+            if os.path.isfile (os.path.join (self.dir, entry)):
+                self.add_entry (entry)
+
+        try:
+            self.mtime = os.stat (self.dir).st_mtime
+        except OSError:
+            pass
+
+    def search (self, name, type = None):
+        """Return list of records of files `name' of `type'."""
+        self.refresh ()
+        if type is None:
+            return list (self.names.get (name.upper (), ()))
+        return list (self.names_and_types.get ((name.upper (), type), ()))
+
+    def add_entry (self, entry):
+        (fname, ext) = os.path.splitext (entry)
+        ext = ext.upper ()
+        try:
+            file_type = self.ext_types[ext]
+        except KeyError:
+            types = core.find_res_type (ext=ext)
+            file_type = self.ext_types[ext] = types and types[0][0] or None
+
+        if file_type is None:
+            self.entries[entry] = None
+            return None
+
+        rec = {'path': os.path.join (self.dir, entry), 'resref_name': fname, 'type': file_type}
+        self.add_record (entry, rec)
+        return rec
+
+    def add_record (self, entry, rec):
+        self.entries[entry] = rec
+        self.count += 1
+        name = rec['resref_name'].upper ()
+        self.names.setdefault (name, []).append (rec)
+        self.names_and_types.setdefault ((name, rec['type']), []).append (rec)
+
+    def remove_entry (self, entry):
+        rec = self.entries.pop (entry)
+        if rec is None:
+            return
+
+        self.count -= 1
+        name = rec['resref_name'].upper ()
+        for key, index in ((name, self.names), ((name, rec['type']), self.names_and_types)):
+            recs = index[key]
+            recs.remove (rec)
+            if not recs:
+                del index[key]
+
+
+# End of file override.py
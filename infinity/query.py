@@ -0,0 +1,357 @@
+# -*-python-*-
+# ie_shell.py - Simple shell for Infinity Engine-based game files
+# Copyright (C) 2004-2011 by Jaroslav Benkovsky, <edheldil@users.sf.net>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+
+"""
+Prefix, glob and regex queries over lists of names.
+
+NameIndex keeps the names of a list (resref names, BIF file names,
+TLK strings) sorted, so that names with a given prefix or suffix are
+found by bisection. Glob patterns and regular expressions are first
+narrowed to the names sharing their literal prefix (or suffix) and
+only those candidates are matched.
+
+TrigramIndex maps each three-character substring (trigram) of the
+case-folded texts of a list to the positions of the texts containing it,
+so that substring, word and regex searches only look at the texts
+containing all the trigrams of the searched literals.
+
+Queries return positions in the original list in ascending order, i.e.
+in the same order a filter() over the list would.
+"""
+
+import array
+import bisect
+import cPickle
+import fnmatch
+import re
+import sre_constants
+import sre_parse
+
+
+glob_special = '*?['
+
+def glob_affixes (pattern):
+    """Return literal (prefix, suffix) of glob `pattern'.
+    Suffix is None if the pattern is entirely literal."""
+    ends = [ pattern.find (c) for c in glob_special if c in pattern ]
+    if not ends:
+        return pattern, None
+
+    prefix = pattern[:min (ends)]
+    starts = [ pattern.rfind (c) for c in glob_special ]
+    suffix = pattern[max (starts) + 1:]
+    if ']' in suffix:
+        # the last wildcard is inside a character set
+        suffix = ''
+    return prefix, suffix
+
+
+def regex_prefix (rx):
+    """Return literal string any match of regex `rx' has to start with,
+    if the regex is anchored at the start of the string, else ''."""
+    if isinstance (rx, basestring):
+        rx = re.compile (rx)
+
+    if rx.flags & (re.IGNORECASE | re.MULTILINE | re.VERBOSE):
+        return ''
+
+    try:
+        items = list (sre_parse.parse (rx.pattern, rx.flags))
+    except (sre_constants.error, TypeError):
+        return ''
+
+    anchors = ((sre_constants.AT, sre_constants.AT_BEGINNING),
+               (sre_constants.AT, sre_constants.AT_BEGINNING_STRING))
+    if not items or items[0] not in anchors:
+        return ''
+
+    prefix = []
+    for op, av in items[1:]:
+        if op != sre_constants.LITERAL:
+            break
+        prefix.append (unichr (av) if isinstance (rx.pattern, unicode) else chr (av))
+
+    return ''.join (prefix)
+
+
+def regex_literals (rx):
+    """Return list of literal strings any match of regex `rx' has to
+    contain. Strings are lowercased if the regex ignores case."""
+    if isinstance (rx, basestring):
+        rx = re.compile (rx)
+
+    try:
+        items = sre_parse.parse (rx.pattern, rx.flags)
+    except (sre_constants.error, TypeError):
+        return []
+
+    ignore_case = rx.flags & re.IGNORECASE
+    literals = []
+    def collect (items):
+        run = []
+        for op, av in items:
+            if op == sre_constants.LITERAL and not (ignore_case and av > 127):
+                run.append (av)
+                continue
+
+            literals.append (run)
+            run = []
+            if op == sre_constants.SUBPATTERN and av[-1] is not None:
+                collect (av[-1])
+        literals.append (run)
+
+    collect (items)
+
+    if isinstance (rx.pattern, unicode):
+        to_char = unichr
+    else:
+        to_char = chr
+
+    res = [ ''.join ([ to_char (c) for c in run ]) for run in literals if run ]
+    if ignore_case:
+        res = [ s.lower () for s in res ]
+    return res
+
+
+class NameIndex (object):
+    """Sorted index over `names', a list of strings.
+
+    If `fold' is True, names are indexed uppercased and prefix, suffix and
+    glob queries are case insensitive, as are the names of IE resources.
+    Regex queries always match the original names."""
+
+    def __init__ (self, names, fold = False):
+        self.names = names
+        self.fold = fold
+
+        keys = self.keys_of (names)
+        order = sorted (range (len (keys)), key = keys.__getitem__)
+        self.sorted_keys = [ keys[i] for i in order ]
+        self.sorted_pos = order
+
+        # the same for reversed names, for suffix queries
+        self.rev_keys = None
+        self.rev_pos = None
+
+    def keys_of (self, names):
+        if self.fold:
+            return [ name.upper () for name in names ]
+        return list (names)
+
+    def __len__ (self):
+        return len (self.names)
+
+    def scan (self, keys, pos, prefix):
+        lo = bisect.bisect_left (keys, prefix)
+        hi = lo
+        while hi < len (keys) and keys[hi].startswith (prefix):
+            hi += 1
+        return pos[lo:hi]
+
+    def prefix (self, prefix):
+        """Return positions of the names starting with `prefix'."""
+        if self.fold:
+            prefix = prefix.upper ()
+        return sorted (self.scan (self.sorted_keys, self.sorted_pos, prefix))
+
+    def suffix (self, suffix):
+        """Return positions of the names ending with `suffix'."""
+        if self.rev_keys is None:
+            keys = [ key[::-1] for key in self.keys_of (self.names) ]
+            self.rev_pos = sorted (range (len (keys)), key = keys.__getitem__)
+            self.rev_keys = [ keys[i] for i in self.rev_pos ]
+
+        if self.fold:
+            suffix = suffix.upper ()
+        return sorted (self.scan (self.rev_keys, self.rev_pos, suffix[::-1]))
+
+    def glob (self, pattern):
+        """Return positions of the names matching shell-style `pattern'."""
+        if self.fold:
+            pattern = pattern.upper ()
+
+        prefix, suffix = glob_affixes (pattern)
+        if suffix is None:
+            return [ i for i in self.prefix (pattern) if self.key (i) == pattern ]
+        elif prefix or not suffix:
+            candidates = self.prefix (prefix)
+        else:
+            candidates = self.suffix (suffix)
+
+        return [ i for i in candidates if fnmatch.fnmatchcase (self.key (i), pattern) ]
+
+    def search (self, rx):
+        """Return positions of the names in which regex `rx' is found.
+
+        Only the names sharing the literal prefix of an anchored regex are
+        tried and each distinct name is tried just once."""
+        if isinstance (rx, basestring):
+            rx = re.compile (rx)
+
+        prefix = regex_prefix (rx)
+        if prefix:
+            candidates = self.prefix (prefix)
+        else:
+            candidates = range (len (self.names))
+
+        found = {}
+        res = []
+        for i in candidates:
+            name = self.names[i]
+            try:
+                match = found[name]
+            except KeyError:
+                match = found[name] = rx.search (name) is not None
+            if match:
+                res.append (i)
+        return res
+
+    def key (self, i):
+        if self.fold:
+            return self.names[i].upper ()
+        return self.names[i]
+
+
+class TrigramIndex (object):
+    """Inverted index of trigrams of lowercased `texts', a list of strings.
+
+    Searches return positions of the matching texts. Searched literals
+    shorter than three characters can't be looked up, so they don't
+    narrow the search."""
+
+    magic = 'IESH-TRIGRAMS'
+    version = 1
+
+    def __init__ (self, texts = None):
+        self.count = 0
+        self.postings = {}
+        # any value identifying the indexed texts, see save () and load ()
+        self.stamp = None
+
+        if texts is not None:
+            self.build (texts)
+
+    def __len__ (self):
+        return self.count
+
+    def trigrams (self, text):
+        return set ([ text[i:i+3] for i in range (len (text) - 2) ])
+
+    def build (self, texts):
+        postings = {}
+        count = 0
+        for i, text in enumerate (texts):
+            for tri in self.trigrams (text.lower ()):
+                try:
+                    postings[tri].append (i)
+                except KeyError:
+                    postings[tri] = array.array ('i', [ i ])
+            count = i + 1
+
+        self.count = count
+        self.postings = postings
+
+    def candidates (self, literals):
+        """Return sorted positions of texts which may contain all the
+        (lowercased) `literals', or None if there's no usable trigram."""
+        tris = set ()
+        for literal in literals:
+            tris.update (self.trigrams (literal.lower ()))
+        if not tris:
+            return None
+
+        lists = [ self.postings.get (tri, ()) for tri in tris ]
+        lists.sort (key = len)
+        res = set (lists[0])
+        for lst in lists[1:]:
+            if not res:
+                break
+            # intersecting with much longer lists costs more than it saves
+            if len (lst) > 64 * len (res):
+                break
+            res.intersection_update (lst)
+
+        return sorted (res)
+
+    def search (self, rx, get_text):
+        """Return positions of texts in which regex `rx' is found. Texts are
+        got by calling get_text (position)."""
+        if isinstance (rx, basestring):
+            rx = re.compile (rx)
+
+        positions = self.candidates (regex_literals (rx))
+        if positions is None:
+            positions = range (self.count)
+
+        return [ i for i in positions if rx.search (get_text (i)) ]
+
+    def search_substring (self, text, get_text, ignore_case = False):
+        positions = self.candidates ([ text.lower () ])
+        if positions is None:
+            positions = range (self.count)
+
+        if ignore_case:
+            text = text.lower ()
+            return [ i for i in positions if text in get_text (i).lower () ]
+        return [ i for i in positions if text in get_text (i) ]
+
+    def search_words (self, words, get_text):
+        """Return positions of texts containing all the whitespace separated
+        `words' as whole words, ignoring case."""
+        words = words.split ()
+        rxs = [ re.compile (r'\b' + re.escape (word) + r'\b', re.IGNORECASE) for word in words ]
+        positions = self.candidates ([ word.lower () for word in words ])
+        if positions is None:
+            positions = range (self.count)
+
+        return [ i for i in positions if all ([ rx.search (get_text (i)) for rx in rxs ]) ]
+
+    def save (self, filename):
+        fh = open (filename, 'wb')
+        try:
+            cPickle.dump ((self.magic, self.version, self.stamp, self.count, self.postings), fh, 2)
+        finally:
+            fh.close ()
+
+    def load (self, filename, stamp = None):
+        """Load index saved by save(). Return False when the file is missing,
+        damaged or saved with different `stamp'."""
+        try:
+            fh = open (filename, 'rb')
+        except IOError:
+            return False
+
+        try:
+            try:
+                magic, version, saved_stamp, count, postings = cPickle.load (fh)
+            except Exception:
+                return False
+        finally:
+            fh.close ()
+
+        if magic != self.magic or version != self.version or saved_stamp != stamp:
+            return False
+
+        self.stamp = saved_stamp
+        self.count = count
+        self.postings = postings
+        return True
+
+
+# End of file query.py
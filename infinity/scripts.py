@@ -0,0 +1,545 @@
+# -*-python-*-
+# ie_shell.py - Simple shell for Infinity Engine-based game files
+# Copyright (C) 2004-2011 by Jaroslav Benkovsky, <edheldil@users.sf.net>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+
+"""
+Compiled scripts and a game-wide index of the triggers, actions,
+variables and resrefs they use.
+
+get_ast() of BCS_Format and BAF_Format returns the parsed script as
+a compact AST of nested tuples, without the section markers (SC, CR, ...):
+
+    script:   tuple of (triggers, responses) blocks
+    trigger:  (function, args)
+    response: (weight, actions)
+    action:   (function, args)
+
+`function' is the opcode in BCS scripts and the name in BAF scripts.
+`args' are the rest of the tokens of the trigger or action, with objects
+and points as tuples of their tokens (in BAF, nested calls as (name, args)).
+
+ASTs are cached in a marshal file (option scripts.ast_file) keyed by MD5
+of the script data, so that only new or changed scripts are parsed again.
+
+ScriptIndex maps trigger and action opcodes, variables checked by
+triggers and set by actions and string arguments which may be resrefs
+to the names of the scripts using them. build_script_index() compiles
+all BCS scripts of the game in a pool of processes and saves the index
+(option scripts.index_file), get_script_index() returns it, building
+it again only when the KEY file or the script files changed:
+
+    index = get_script_index ()
+    index.sets_variable ('X', 'GLOBAL')
+    index.actions ('StartDialog')
+    index.uses_resref ('AR0602')
+"""
+
+from __future__ import print_function
+
+import hashlib
+import marshal
+import multiprocessing
+import os
+import re
+import sys
+
+from infinity import core
+from infinity.stream import FileStream, MemoryStream, find_bif_file, read_bif_resource
+
+
+# marshal format differs between python versions
+python_version = sys.version_info[0] * 100 + sys.version_info[1]
+
+# scopes of variables, area scripts use their area's name
+scope_re = re.compile ('^(GLOBAL|LOCALS|MYAREA|KAPUTZ|AR[0-9]{4})$', re.IGNORECASE)
+# in BCS, scope and name of a variable are joined in one string
+scoped_name_re = re.compile ('^(GLOBAL|LOCALS|MYAREA|KAPUTZ|AR[0-9]{4})(.+)$', re.IGNORECASE)
+resref_re = re.compile ('^[A-Za-z0-9_#!$-]{1,8}$')
+
+# the index, see get_script_index()
+script_index = None
+
+
+def get_refs (ast):
+    """Return set of (kind, key) used by script `ast'.
+
+    Kind is 'trigger' or 'action' with the opcode (uppercased name in BAF)
+    as key, 'trigger_var' or 'action_var' with (SCOPE, NAME) of a variable
+    used by a trigger or action, or 'resref' with an uppercased string
+    argument which looks like a resref."""
+    refs = set ()
+    for triggers, responses in ast:
+        for fn, args in triggers:
+            add_call_refs (refs, 'trigger', fn, args)
+        for weight, actions in responses:
+            for fn, args in actions:
+                add_call_refs (refs, 'action', fn, args)
+
+    return refs
+
+def add_call_refs (refs, kind, fn, args):
+    strings = [ a[1:-1] for a in args if isinstance (a, str) and a[:1] == '"' and len (a) > 2 ]
+
+    if isinstance (fn, str):
+        # BAF, e.g. Global("name","GLOBAL",1)
+        fn = fn.upper ()
+        if len (strings) >= 2 and scope_re.match (strings[1]):
+            refs.add ((kind + '_var', (strings[1].upper (), strings[0].upper ())))
+            strings = strings[2:]
+    refs.add ((kind, fn))
+
+    for s in strings:
+        mo = scoped_name_re.match (s)
+        if mo and not isinstance (fn, str):
+            refs.add ((kind + '_var', (mo.group (1).upper (), mo.group (2).upper ())))
+        elif resref_re.match (s):
+            refs.add (('resref', s.upper ()))
+
+
+def get_opcodes (idsfile, name):
+    """Return list of opcodes of function `name' in TRIGGER or ACTION
+    `idsfile', ignoring case and the argument list."""
+    idsobj = core.get_ids (idsfile)
+    if idsobj is None:
+        return []
+
+    name = name.lower ()
+    res = []
+    for spec, ids in idsobj.ids2_re.items ():
+        if spec.split ('(', 1)[0].strip ().lower () == name:
+            res.extend (ids)
+
+    return sorted (set (res))
+
+
+def write_file (filename, data):
+    # write to a temporary file first, so that readers never see half of it
+    tmp_filename = filename + '.tmp%d' %os.getpid ()
+    try:
+        fh = open (tmp_filename, 'wb')
+        try:
+            fh.write (data)
+        finally:
+            fh.close ()
+
+        if os.path.exists (filename) and sys.platform == 'win32':
+            os.remove (filename)
+        os.rename (tmp_filename, filename)
+    except EnvironmentError:
+        if os.path.exists (tmp_filename):
+            os.remove (tmp_filename)
+        raise
+
+def read_file (filename, magic, version):
+    """Return payload of a file written by write_file() with `magic' and
+    `version', or None if it's missing, damaged or written otherwise."""
+    try:
+        fh = open (filename, 'rb')
+    except IOError:
+        return None
+
+    try:
+        try:
+            file_magic, file_version, py_version, payload = marshal.load (fh)
+        except (EOFError, ValueError, TypeError):
+            return None
+    finally:
+        fh.close ()
+
+    if file_magic != magic or file_version != version or py_version != python_version:
+        return None
+
+    return payload
+
+def get_cache_path (option):
+    filename = core.get_option (option)
+    if not filename or core.game_dir is None:
+        return None
+    return os.path.join (core.game_dir, filename)
+
+
+class AstCache (object):
+    """ASTs of scripts keyed by MD5 digest of their data, kept in file
+    `filename' (None to keep them just in memory)."""
+
+    magic = 'IESH-SCRIPT-ASTS'
+    version = 1
+
+    def __init__ (self, filename = None):
+        self.filename = filename
+        self.asts = {}
+        self.changed = False
+
+        if filename is not None:
+            asts = read_file (filename, self.magic, self.version)
+            if asts is not None:
+                self.asts = asts
+
+    def __len__ (self):
+        return len (self.asts)
+
+    def get (self, digest):
+        return self.asts.get (digest)
+
+    def add (self, digest, ast):
+        self.asts[digest] = ast
+        self.changed = True
+
+    def prune (self, digests):
+        """Drop ASTs of scripts other than `digests'."""
+        for digest in set (self.asts) - set (digests):
+            del self.asts[digest]
+            self.changed = True
+
+    def save (self):
+        if self.filename is None or not self.changed:
+            return
+
+        write_file (self.filename, marshal.dumps ((self.magic, self.version, python_version, self.asts)))
+        self.changed = False
+
+
+class ScriptIndex (object):
+    """Inverted index of scripts by what they use, see get_refs ().
+
+    Queries return sorted names of the scripts."""
+
+    magic = 'IESH-SCRIPT-INDEX'
+    version = 1
+    kinds = ('trigger', 'action', 'trigger_var', 'action_var', 'resref')
+
+    def __init__ (self):
+        # any value identifying the indexed scripts, see get_scripts_stamp ()
+        self.stamp = None
+        # sorted names and digests of the scripts, postings refer to
+        # positions in these lists
+        self.names = []
+        self.digests = []
+        self.postings = dict ([ (kind, {}) for kind in self.kinds ])
+
+    def __len__ (self):
+        return len (self.names)
+
+    def build (self, scripts):
+        """Index list of (name, digest, ast) `scripts'."""
+        self.names = []
+        self.digests = []
+        self.postings = dict ([ (kind, {}) for kind in self.kinds ])
+
+        for pos, (name, digest, ast) in enumerate (sorted (scripts)):
+            self.names.append (name)
+            self.digests.append (digest)
+            for kind, key in get_refs (ast):
+                self.postings[kind].setdefault (key, []).append (pos)
+
+    def find (self, kind, key):
+        """Return names of scripts using `key' of `kind', see get_refs ()."""
+        return [ self.names[pos] for pos in self.postings[kind].get (key, ()) ]
+
+    def find_all (self, kind, keys):
+        positions = set ()
+        for key in keys:
+            positions.update (self.postings[kind].get (key, ()))
+        return [ self.names[pos] for pos in sorted (positions) ]
+
+    def find_function (self, kind, idsfile, fn):
+        # BAF scripts are indexed by name
+        if isinstance (fn, basestring):
+            keys = get_opcodes (idsfile, fn) + [ fn.upper () ]
+        else:
+            keys = [ fn ]
+        return self.find_all (kind, keys)
+
+    def find_variable (self, kind, name, scope):
+        name = name.upper ()
+        if scope is not None:
+            return self.find (kind, (scope.upper (), name))
+        return self.find_all (kind, [ key for key in self.postings[kind] if key[1] == name ])
+
+    def triggers (self, fn):
+        """Return names of scripts using trigger `fn', an opcode or a name
+        from TRIGGER.IDS."""
+        return self.find_function ('trigger', 'TRIGGER', fn)
+
+    def actions (self, fn):
+        """Return names of scripts using action `fn', an opcode or a name
+        from ACTION.IDS."""
+        return self.find_function ('action', 'ACTION', fn)
+
+    def checks_variable (self, name, scope = None):
+        """Return names of scripts with triggers using variable `name' of
+        `scope' (e.g. 'GLOBAL'), any scope by default."""
+        return self.find_variable ('trigger_var', name, scope)
+
+    def sets_variable (self, name, scope = None):
+        """Return names of scripts with actions using variable `name' of
+        `scope' (e.g. 'GLOBAL'), any scope by default."""
+        return self.find_variable ('action_var', name, scope)
+
+    def uses_resref (self, resref):
+        """Return names of scripts with string argument `resref'."""
+        return self.find ('resref', resref.upper ())
+
+    def save (self, filename):
+        write_file (filename, marshal.dumps ((self.magic, self.version, python_version,
+                                              (self.stamp, self.names, self.digests, self.postings))))
+
+    def load (self, filename, stamp = None):
+        """Load index saved by save(). Return False when the file is missing,
+        damaged or saved with different `stamp'."""
+        payload = read_file (filename, self.magic, self.version)
+        if payload is None:
+            return False
+
+        saved_stamp, names, digests, postings = payload
+        if saved_stamp != stamp:
+            return False
+
+        self.stamp = saved_stamp
+        self.names = names
+        self.digests = digests
+        self.postings = postings
+        return True
+
+
+def get_script_sources ():
+    """Return list of (name, path, resref) of the BCS scripts of the game,
+    in the order of their BIF files. For scripts in BIF files, `resref' is
+    (BIF file name, KEY record) and `path' the BIF file, or None if it's
+    missing. For script files, in override or loose in the game data path,
+    `resref' is None."""
+    type = core.ext_to_type ('BCS')
+    exts = core.type_to_ext (type)
+
+    sources = {}
+    bif_files = {}
+    for o in core.keys.get_resref_by_type (type):
+        name = o['resref_name'].upper ()
+        if name in sources:
+            continue
+
+        order = (o['locator_src_ndx'], o['locator_ntset_ndx'])
+        for ext in exts:
+            path = core.find_file (name + '.' + ext)
+            if path is not None:
+                sources[name] = (order, path, None)
+                break
+        else:
+            ndx = o['locator_src_ndx']
+            if ndx not in bif_files:
+                file_name = core.keys.bif_list[ndx]['file_name']
+                try:
+                    bif_files[ndx] = (file_name, find_bif_file (file_name))
+                except IOError:
+                    bif_files[ndx] = (file_name, None)
+
+            file_name, path = bif_files[ndx]
+            sources[name] = (order, path, (file_name, dict (o)))
+
+    if core.override is not None:
+        for rec in core.override:
+            if rec['type'] == type:
+                sources[rec['resref_name'].upper ()] = ((-1, 0), rec['path'], None)
+
+    items = sorted ([ (order, name, path, resref) for name, (order, path, resref) in sources.items () ])
+    return [ (name, path, resref) for order, name, path, resref in items ]
+
+def get_scripts_stamp (sources):
+    """Return stamp of script `sources', which changes with the KEY file
+    and with the script and BIF files the scripts are read from."""
+    stamps = [ core.file_stamp (core.find_file (core.chitin_file)) ]
+    paths = set ()
+    for name, path, resref in sources:
+        if resref is None:
+            paths.add ((name, path))
+        elif path is not None:
+            paths.add ((None, path))
+
+    for name, path in sorted (paths):
+        try:
+            stamps.append ((name, path, core.file_stamp (path)))
+        except OSError:
+            stamps.append ((name, path, None))
+
+    return hashlib.md5 (repr (stamps)).hexdigest ()
+
+
+def read_script (name, path, resref):
+    if resref is None:
+        stream = FileStream ().open (path)
+        try:
+            return stream.read ()
+        finally:
+            stream.close ()
+
+    file_name, resref = resref
+    if path is None:
+        raise IOError ("Archive not found in path: %s" %file_name)
+    return read_bif_resource (file_name, resref, path)
+
+def compile_script (data):
+    from infinity.formats.bcs import BCS_Format
+
+    b = BCS_Format ()
+    if core.game_type == 'pst':
+        b.type = 'pst'
+    b.read (MemoryStream ().open (data))
+    return b.get_ast ()
+
+
+# digests of ASTs cached by the process building the index, in its workers
+known_digests = frozenset ()
+
+def init_script_worker (digests, game_type, options):
+    global known_digests
+    # processes that are spawned rather than forked start with the default
+    # options and no formats registered
+    import infinity.formats
+    core.options.update (options)
+    core.game_type = game_type
+    known_digests = digests
+    # BIF files opened by the parent share file offsets with it
+    core.bif_files.flush ()
+
+def compile_script_chunk (chunk, digests = None):
+    """Read and compile scripts in list of (position, name, path, resref)
+    `chunk', see get_script_sources(). Scripts with `digests' of cached
+    ASTs (default those passed to init_script_worker()) are not compiled.
+    Return list of (position, digest, AST, error message), where the AST
+    is None if it's cached and on error."""
+    if digests is None:
+        digests = known_digests
+
+    res = []
+    for pos, name, path, resref in chunk:
+        try:
+            data = read_script (name, path, resref)
+            digest = hashlib.md5 (data).hexdigest ()
+            ast = None
+            if digest not in digests:
+                ast = compile_script (data)
+            res.append ((pos, digest, ast, None))
+        except Exception as e:
+            res.append ((pos, None, None, "%s: %s" %(e.__class__.__name__, e)))
+
+    return res
+
+
+def build_script_index (workers = None, chunk_size = 64, verbose = True):
+    """Compile all BCS scripts of the game and build their ScriptIndex.
+
+    Scripts whose ASTs are cached (option scripts.ast_file) are just read
+    and hashed. `workers' is # of processes compiling the scripts (default
+    option scripts.workers). The index is saved into option
+    scripts.index_file and kept for get_script_index(). Scripts which
+    fail to compile are reported and left out. Return the index."""
+    global script_index
+
+    if core.keys is None:
+        raise RuntimeError ("Core game files are not loaded. See load_game ().")
+
+    if workers is None:
+        workers = core.get_option ('scripts.workers')
+    if not workers:
+        workers = multiprocessing.cpu_count ()
+
+    sources = get_script_sources ()
+    stamp = get_scripts_stamp (sources)
+    cache = AstCache (get_cache_path ('scripts.ast_file'))
+
+    items = [ (pos, name, path, resref) for pos, (name, path, resref) in enumerate (sources) ]
+    chunks = [ items[i:i + chunk_size] for i in range (0, len (items), chunk_size) ]
+    digests = frozenset (cache.asts)
+
+    if workers == 1 or len (chunks) <= 1:
+        results = [ compile_script_chunk (chunk, digests) for chunk in chunks ]
+    else:
+        # the workers get all they need from the arguments, so that they
+        # don't depend on the state of a forked parent
+        pool = multiprocessing.Pool (workers, init_script_worker, (digests, core.game_type, core.options))
+        try:
+            results = list (pool.imap_unordered (compile_script_chunk, chunks))
+            pool.close ()
+        finally:
+            pool.terminate ()
+            pool.join ()
+
+    scripts = []
+    errors = []
+    for chunk in results:
+        for pos, digest, ast, error in chunk:
+            name = sources[pos][0]
+            if error is not None:
+                errors.append ((name, error))
+                continue
+
+            if ast is None:
+                ast = cache.get (digest)
+            else:
+                cache.add (digest, ast)
+            scripts.append ((name, digest, ast))
+
+    cache.prune ([ digest for name, digest, ast in scripts ])
+    try:
+        cache.save ()
+    except EnvironmentError as e:
+        print("Compiled scripts not saved: %s" %e, file=sys.stderr)
+
+    index = ScriptIndex ()
+    index.build (scripts)
+    index.stamp = stamp
+
+    filename = get_cache_path ('scripts.index_file')
+    if filename is not None:
+        try:
+            index.save (filename)
+        except EnvironmentError as e:
+            print("Script index not saved: %s" %e, file=sys.stderr)
+
+    if verbose:
+        print("%d scripts indexed" %len (index))
+        for name, msg in errors:
+            print("Error: %s: %s" %(name, msg))
+
+    script_index = index
+    return index
+
+def get_script_index (rebuild = False):
+    """Return ScriptIndex of the game's BCS scripts. The index is loaded
+    from option scripts.index_file, or built by build_script_index() when
+    it's missing or the scripts changed since, or when `rebuild' is True."""
+    global script_index
+
+    if core.keys is None:
+        raise RuntimeError ("Core game files are not loaded. See load_game ().")
+
+    if not rebuild:
+        stamp = get_scripts_stamp (get_script_sources ())
+        if script_index is not None and script_index.stamp == stamp:
+            return script_index
+
+        filename = get_cache_path ('scripts.index_file')
+        if filename is not None:
+            index = ScriptIndex ()
+            if index.load (filename, stamp):
+                script_index = index
+                return index
+
+    return build_script_index ()
+
+# End of file scripts.py
@@ -0,0 +1,364 @@
+# -*-python-*-
+# ie_shell.py - Simple shell for Infinity Engine-based game files
+# Copyright (C) 2004-2011 by Jaroslav Benkovsky, <edheldil@users.sf.net>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+
+"""
+Snapshots of loaded game data.
+
+A snapshot saves what load_game() builds: the KEY tables and lookup
+index, the file tables of the BIF files, the override index and the
+game type. It is a binary file of named sections:
+
+    header:   magic (16s), version (I), python version (I), # of sections (I)
+    sections: name (16s), offset (I), size (I) for each section
+    data of the sections
+
+Small structures are stored with marshal, the record tables in their
+binary form, so that the snapshot can be mapped into memory and the
+records are unpacked only when accessed.
+
+The snapshot records size and mtime of each file it was built from
+and it's not used when any of them changes, except for the override
+index, which is just refreshed (see infinity.override). TLK files are not copied,
+they are read lazily from the mapped file anyway (see format.tlk.lazy).
+"""
+
+import marshal
+import os
+import struct
+import sys
+
+from infinity import core
+from infinity.stream import FileStream
+from infinity.struc import compile_struc, PackedTable, RecordList
+
+
+magic = 'IESH-SNAPSHOT\0\0\0'
+version = 2
+# marshal format differs between python versions
+python_version = sys.version_info[0] * 100 + sys.version_info[1]
+
+header_struct = struct.Struct ('<16sIII')
+section_struct = struct.Struct ('<16sII')
+
+
+def write_snapshot (filename, sections):
+    """Write list of (name, data) `sections' into snapshot file `filename'."""
+    offset = header_struct.size + len (sections) * section_struct.size
+    chunks = [ header_struct.pack (magic, version, python_version, len (sections)) ]
+    for name, data in sections:
+        chunks.append (section_struct.pack (name, offset, len (data)))
+        offset += len (data)
+    chunks.extend ([ data for name, data in sections ])
+
+    # write to a temporary file first, so that readers never see half of it
+    tmp_filename = filename + '.tmp%d' %os.getpid ()
+    try:
+        fh = open (tmp_filename, 'wb')
+        try:
+            fh.write (''.join (chunks))
+        finally:
+            fh.close ()
+
+        if os.path.exists (filename) and sys.platform == 'win32':
+            os.remove (filename)
+        os.rename (tmp_filename, filename)
+    except EnvironmentError:
+        if os.path.exists (tmp_filename):
+            os.remove (tmp_filename)
+        raise
+
+
+def read_snapshot (filename):
+    """Map snapshot file `filename' into memory. Return the buffer and dict
+    of (offset, size) of its sections keyed by name, or None if it's not
+    a usable snapshot."""
+    try:
+        stream = FileStream ().open (filename, 'rb')
+    except EnvironmentError:
+        return None
+
+    buffer = stream.detach_buffer ()
+    if buffer is None:
+        buffer = stream.read ()
+    stream.close ()
+
+    if len (buffer) < header_struct.size:
+        return None
+
+    sig, ver, py_ver, count = header_struct.unpack_from (buffer, 0)
+    if sig != magic or ver != version or py_ver != python_version:
+        return None
+
+    sections = {}
+    for i in range (count):
+        name, offset, size = section_struct.unpack_from (buffer, header_struct.size + i * section_struct.size)
+        sections[name.rstrip ('\0')] = (offset, size)
+
+    return buffer, sections
+
+
+def is_snapshot (filename):
+    try:
+        fh = open (filename, 'rb')
+    except IOError:
+        return False
+
+    try:
+        return fh.read (len (magic)) == magic
+    finally:
+        fh.close ()
+
+
+def get_stamp (path):
+    try:
+        return core.file_stamp (path)
+    except OSError:
+        return None
+
+
+def save_snapshot (filename):
+    """Save a snapshot of the game data loaded by load_game() into `filename'."""
+    keys = core.keys
+
+    stamps = []
+    for name in (core.chitin_file, core.dialog_file):
+        path = core.find_file (name)
+        if path is not None:
+            stamps.append ((os.path.abspath (path), get_stamp (path)))
+
+    meta = {
+        'game_dir': core.game_dir,
+        'game_data_path': core.game_data_path,
+        'override_dir': core.override_dir,
+        'chitin_file': core.chitin_file,
+        'dialog_file': core.dialog_file,
+        'game_type': core.game_type,
+        'stamps': stamps,
+        }
+
+    sections = [ ('meta', marshal.dumps (meta)) ]
+    sections.extend (snapshot_keys (keys))
+    sections.extend (snapshot_bifs (keys))
+    sections.append (('override', marshal.dumps (snapshot_override (core.override))))
+
+    write_snapshot (filename, sections)
+
+
+def snapshot_override (override):
+    if override is None:
+        return None
+    return { 'mtime': override.mtime, 'records': override.get_records () }
+
+
+def snapshot_keys (keys):
+    layout = compile_struc (keys.resref_record_desc)
+    resrefs = keys.resref_list
+    count = len (resrefs)
+
+    data = []
+    offsets = []
+    for i in range (count):
+        if isinstance (resrefs, RecordList) and not resrefs.is_decoded (i):
+            values = resrefs.values[i]
+            offsets.append (resrefs.offsets[i] if resrefs.offsets is not None else resrefs.offset + i * resrefs.stride)
+        else:
+            obj = resrefs[i]
+            values = layout.pack (obj)
+            offsets.append (obj.get ('_offset', 0))
+        data.append (layout.struct.pack (*values))
+
+    # make sure the index is up to date
+    keys.get_resref_index ('name')
+    index = dict (keys.resref_index)
+    index['sorted'] = None
+
+    meta = {
+        'header': keys.header,
+        'bif_list': [ dict (obj) for obj in keys.bif_list ],
+        'bif_hash': keys.bif_hash.keys (),
+        'count': count,
+        'stride': layout.size,
+        'offsets': offsets,
+        'index': index,
+        }
+
+    return [ ('key', marshal.dumps (meta)), ('key.resrefs', ''.join (data)) ]
+
+
+def snapshot_bifs (keys):
+    from infinity.formats.biff import BIFF_Format
+
+    bifs = {}
+    data = []
+    offset = 0
+    for bif in keys.bif_list:
+        path = core.find_file (bif['file_name'])
+        if path is None:
+            continue
+
+        stream = FileStream ().open (path)
+        try:
+            if stream.read_blob (0, 8) != 'BIFFV1  ':
+                continue
+
+            b = BIFF_Format ()
+            b.read_header (stream)
+            size = 16 * b.header['num_of_files'] + 20 * b.header['num_of_tilesets']
+            tables = stream.read_blob (b.header['files_offset'], size)
+        finally:
+            stream.close ()
+
+        if len (tables) != size:
+            continue
+
+        bifs[bif['file_name']] = {
+            'path': os.path.abspath (path),
+            'stamp': get_stamp (path),
+            'header': b.header,
+            'offset': offset,
+            }
+        data.append (tables)
+        offset += size
+
+    return [ ('bifs', marshal.dumps (bifs)), ('bifs.tables', ''.join (data)) ]
+
+
+def load_snapshot (filename, game_dir = None, chitin_file = None, dialog_file = None):
+    """Restore game data from snapshot `filename' saved by save_snapshot().
+
+    If `game_dir', `chitin_file' and `dialog_file' are given, the snapshot
+    has to be saved for them. Return False, leaving the game data alone,
+    if the snapshot can't be used, e.g. because its files changed."""
+    snap = read_snapshot (filename)
+    if snap is None:
+        return False
+    buffer, sections = snap
+
+    def section (name):
+        offset, size = sections[name]
+        return buffer[offset:offset + size]
+
+    try:
+        meta = marshal.loads (section ('meta'))
+
+        if game_dir is not None and (meta['game_dir'], meta['chitin_file'], meta['dialog_file']) != (game_dir, chitin_file, dialog_file):
+            return False
+
+        for path, stamp in meta['stamps']:
+            if get_stamp (path) != stamp:
+                return False
+
+        keys = restore_keys (buffer, sections, marshal.loads (section ('key')))
+        bif_tables = restore_bifs (buffer, sections, marshal.loads (section ('bifs')))
+        override = marshal.loads (section ('override'))
+    except (KeyError, ValueError, EOFError, TypeError):
+        # damaged snapshot
+        return False
+
+    # the dialog file is looked up in the snapshot's game data path
+    game_data_path = core.game_data_path
+    core.game_data_path = meta['game_data_path']
+    try:
+        dialog_file = core.find_file (meta['dialog_file'])
+    finally:
+        core.game_data_path = game_data_path
+    if dialog_file is None:
+        return False
+
+    core.flush_caches ()
+    core.game_dir = meta['game_dir']
+    core.game_data_path = meta['game_data_path']
+    core.override_dir = meta['override_dir']
+    core.chitin_file = meta['chitin_file']
+    core.dialog_file = meta['dialog_file']
+    core.game_type = meta['game_type']
+    core.override = restore_override (core.override_dir, override)
+    core.keys = keys
+    core.bif_tables.update (bif_tables)
+
+    stream = FileStream ().open (dialog_file)
+    core.strrefs = stream.get_format () ()
+    core.strrefs.read (stream)
+    stream.close ()
+
+    return True
+
+
+def restore_override (dir, override):
+    from infinity.override import OverrideIndex
+
+    if dir is None or override is None:
+        return None
+
+    # changes since the snapshot are indexed on the first lookup
+    index = OverrideIndex (dir)
+    index.load_records (override['records'], override['mtime'])
+    return index
+
+
+def restore_keys (buffer, sections, meta):
+    from infinity.formats.key import KEY_Format
+
+    keys = KEY_Format ()
+    keys.header = meta['header']
+    keys.bif_list = meta['bif_list']
+    keys.bif_hash = dict ([ (obj['file_name'], obj) for obj in keys.bif_list if obj['file_name'] in meta['bif_hash'] ])
+
+    layout = compile_struc (keys.resref_record_desc)
+    offset = sections['key.resrefs'][0]
+    table = PackedTable (layout, buffer, offset, meta['count'], meta['stride'])
+    resrefs = RecordList (layout, table, keys.header['resref_offset'], meta['stride'], keys.finish_resref_record)
+    resrefs.offsets = meta['offsets']
+    resrefs.compact (('file_name', ))
+    keys.resref_list = resrefs
+    keys.resref_index = meta['index']
+
+    return keys
+
+
+def restore_bifs (buffer, sections, bifs):
+    from infinity.formats.biff import BIFF_Format
+
+    file_layout = compile_struc (BIFF_Format.file_record_desc)
+    tileset_layout = compile_struc (BIFF_Format.tileset_record_desc)
+    base = sections['bifs.tables'][0]
+
+    bif_tables = {}
+    for name, bif in bifs.items ():
+        # BIFs which changed since are read the usual way
+        if get_stamp (bif['path']) != bif['stamp']:
+            continue
+
+        b = BIFF_Format ()
+        b.header = bif['header']
+        num_of_files = b.header['num_of_files']
+        num_of_tilesets = b.header['num_of_tilesets']
+        off = base + bif['offset']
+        b.file_list = RecordList (file_layout, PackedTable (file_layout, buffer, off, num_of_files, 16),
+                                  b.header['files_offset'], 16)
+        off += 16 * num_of_files
+        b.tileset_list = RecordList (tileset_layout, PackedTable (tileset_layout, buffer, off, num_of_tilesets, 20),
+                                     b.header['files_offset'] + 16 * num_of_files, 20)
+        b.file_list.compact (('data', ))
+        b.tileset_list.compact (('data', ))
+        bif_tables[name] = (bif['path'], b)
+
+    return bif_tables
+
+# End of file snapshot.py
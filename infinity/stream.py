@@ -31,16 +31,37 @@ Classes:
   MemoryStream - read from memory buffers (strings)
   ResourceStream - read IE object referenced by RESREF
   CompressedStream - read compressed buffer
+  BlockCompressedStream - read stream compressed in blocks, e.g. BIFC files
 """
 
 
-import gzip
+import bisect
+import mmap
 import os.path
 import re
 import string
 import struct
+import zlib
+from multiprocessing.pool import ThreadPool
 
 from infinity import core
+from infinity.cache import Cache
+
+
+# # of bytes read at once when looking for a terminator in unbuffered streams
+find_chunk_size = 256
+
+# Precompiled primitives used by the buffer-backed fast paths
+word_struct = struct.Struct ('<H')
+sword_struct = struct.Struct ('<h')
+dword_struct = struct.Struct ('<I')
+sdword_struct = struct.Struct ('<i')
+block_header_struct = struct.Struct ('<II')
+
+# Thread pool decompressing blocks of BlockCompressedStreams and pid of the
+# process which created it, see get_block_pool ()
+block_pool = None
+block_pool_pid = None
 
 
 class Stream (object):
@@ -50,6 +71,11 @@ class Stream (object):
     It implements the basic open / read / write / seek / close
     API to be implemented in the subclasses, as well as
     functions for reading primitive IE data types like RESREF or WORD.
+
+    Streams backed by a memory buffer (MemoryStream and its subclasses,
+    memory-mapped FileStream) keep the data in `self.buffer' and the
+    current position in `self.offset'. Primitive types are then decoded
+    directly from the buffer, without any intermediate copies.
     """
 
     def __init__ (self):
@@ -57,6 +83,8 @@ class Stream (object):
         self.name = None
         self.options = {}
         self.coverage = None
+        self.buffer = None
+        self.offset = 0
 
 
     def __del__ (self):
@@ -85,20 +113,77 @@ class Stream (object):
 
     def seek (self, offset):
         """Set position for next read (current offset) to `offset'.
-        Override in subclasses."""
-        pass
+        Works on `self.buffer', override in subclasses not backed by a buffer."""
+        self.offset = offset
+
+    def tell (self):
+        """Return the current offset.
+        Works on `self.buffer', override in subclasses not backed by a buffer."""
+        return self.offset
 
     def read (self, count=-1):
         """Read `count' of bytes at the current offset and update the offset.
-        If count is zero, read till the end of the stream.
-        Override in subclasses."""
-        pass
+        If count is negative, read till the end of the stream.
+        Works on `self.buffer', override in subclasses not backed by a buffer."""
+        if count >= 0:
+            data = self.buffer[self.offset:self.offset+count]
+        else:
+            data = self.buffer[self.offset:]
+
+        self.offset = self.offset + len (data)
+        return data
+
+    def read_view (self, count=-1):
+        """Like read(), but return a zero-copy view (memoryview, or buffer
+        for objects without the new buffer interface, e.g. mmap in python 2)
+        into `self.buffer' instead of a copy of the data."""
+        if count < 0:
+            count = len (self.buffer) - self.offset
+        count = max (0, min (count, len (self.buffer) - self.offset))
+
+        try:
+            data = memoryview (self.buffer)[self.offset:self.offset+count]
+        except TypeError:
+            data = buffer (self.buffer, self.offset, count)
+
+        self.offset = self.offset + count
+        return data
+
+    def detach_buffer (self):
+        """Return `self.buffer' (or None) and leave it valid even after
+        the stream is closed, for objects reading from it lazily."""
+        return self.buffer
+
+    def unpack_from (self, st, offset):
+        """Decode struct.Struct `st' directly from `self.buffer' at `offset'
+        and update the current offset. Return None when reading past the end."""
+        # offset == None means "current offset" here
+        if offset is None:
+            offset = self.offset
+
+        if offset >= len (self.buffer):
+            self.offset = offset
+            return None
+
+        value = st.unpack_from (self.buffer, offset)[0]
+        self.offset = offset + st.size
+        return value
 
     def write (self, data, count = None):
         """Write `data' to current offset in file.
        Override in subclasses."""
         pass
 
+    def pack_into (self, st, offset, *values):
+        """Write `values' packed by struct.Struct `st' at `offset'.
+        Override in subclasses able to pack them in place."""
+        self.write_blob (st.pack (*values), offset)
+
+    def reserve (self, size):
+        """Hint that about `size' bytes are going to be written in total,
+        for streams which can allocate them ahead."""
+        pass
+
     # Methods for reading and writing primitive IE data types
 
     def get_char (self, offset = None):
@@ -130,6 +215,13 @@ class Stream (object):
 
     def read_word (self, offset, signed = False):
         # offset == None means "current offset" here
+        if self.buffer is not None:
+            value = self.unpack_from (sword_struct if signed else word_struct, offset)
+            if value is None:
+                print("Erorr in read_word: empty value read!")
+                return 0
+            return value
+
         if offset is not None:
             self.seek (offset)
 
@@ -143,13 +235,17 @@ class Stream (object):
 
     def write_word (self, value, offset = None):
         # offset == None means "current offset" here
-        if offset is not None:
-            self.seek (offset)
-        bytes = struct.pack ('<H', value)
-        self.write (bytes)
+        self.pack_into (word_struct, offset, value)
 
     def read_dword (self, offset, signed = False):
         # offset == None means "current offset" here
+        if self.buffer is not None:
+            value = self.unpack_from (sdword_struct if signed else dword_struct, offset)
+            if value is None:
+                print("Erorr in read_dword: empty value read!")
+                return 0
+            return value
+
         if offset is not None:
             self.seek (offset)
 
@@ -163,10 +259,7 @@ class Stream (object):
 
     def write_dword (self, value, offset = None):
         # offset == None means "current offset" here
-        if offset is not None:
-            self.seek (offset)
-        bytes = struct.pack ('<I', value)
-        self.write (bytes)
+        self.pack_into (dword_struct, offset, value)
 
     def read_sized_string (self, offset, size):
         # offset == None means "current offset" here
@@ -186,32 +279,63 @@ class Stream (object):
         bytes = struct.pack ('%ds' %size, value.encode())
         self.write (bytes)
 
+    def find_char (self, char, offset):
+        """Return offset of the first `char' at or after `offset', or -1 if it's
+        not found before the end of the stream. The current offset is left
+        undefined."""
+        if self.buffer is not None:
+            return self.buffer.find (char, offset)
+
+        self.seek (offset)
+        while True:
+            chunk = self.read (find_chunk_size)
+            if chunk == '':
+                return -1
+            pos = chunk.find (char)
+            if pos >= 0:
+                return offset + pos
+            offset += len (chunk)
+
     def read_asciiz_string (self, off):
-        s = ''
+        if off is None:
+            off = self.tell ()
 
-        while 1:
-            c = self.get_char (off)
-            if c == '\0': break
-            s = s + c
-            off = off + 1
+        end = self.find_char ('\0', off)
+        if end < 0:
+            s = self.read_blob (off)
+        else:
+            s = self.read_blob (off, end - off)
+            # skip the terminator
+            self.read (1)
 
         return s
 
     def read_line_string (self):
-        s = ''
-
-        while 1:
-            c = self.get_char (None)
-            if c == '\n': break
-            if c == '':
-                if s == '':
-                    s = None
-                break
+        off = self.tell ()
 
-            s = s + c
+        end = self.find_char ('\n', off)
+        if end < 0:
+            s = self.read_blob (off)
+            if s == '':
+                s = None
+        else:
+            s = self.read_blob (off, end - off)
+            # skip the newline
+            self.read (1)
 
         return s
 
+    def iter_lines (self):
+        """Generate lines (without the newline) from the current offset till
+        the end of the stream, as read_line_string () would return them.
+        The rest of the stream is split at once."""
+        data = self.read ()
+        lines = data.split ('\n')
+        if lines[-1] == '':
+            # no line after the last newline
+            lines.pop ()
+        return iter (lines)
+
     def write_line_string (self, value, offset=None):
         if offset:
             self.seek(offset)
@@ -297,6 +421,8 @@ class Stream (object):
         obj = fmt ()
         self.seek (0)
         obj.read (self)
+        if core.get_option ('format.keep_source'):
+            obj.keep_source (self)
         return obj
 
 
@@ -355,10 +481,14 @@ class Stream (object):
 
 
 class FileStream (Stream):
-    """Specialized Stream for working with normal files in filesystem"""
+    """Specialized Stream for working with normal files in filesystem.
+
+    Files opened for reading are memory-mapped, so reads are served
+    from the mapping instead of issuing seek() and read() syscalls."""
 
     def __init__ (self):
         Stream.__init__ (self)
+        self.map = None
 
     def open (self, filename, mode = 'r'):
         # FIXME: reset offset?
@@ -374,24 +504,58 @@ class FileStream (Stream):
         if self.get_option ('stream.debug_coverage'):
             size = os.stat (filename)[6]
             self.coverage = [0] * size
+        elif self.filename != '<file>' and mode in ('r', 'rb'):
+            self.map_file ()
 
         return self
 
+    def map_file (self):
+        try:
+            self.map = mmap.mmap (self.fh.fileno (), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError):
+            # e.g. empty files can't be mapped, fall back to plain reads
+            return
+
+        self.buffer = self.map
+        self.offset = 0
+
+    def detach_buffer (self):
+        # the mapping is closed when the last reference to it is dropped
+        self.map = None
+        return self.buffer
+
     def close (self):
         if not self.is_open:
             return
 
+        self.buffer = None
+        if self.map is not None:
+            try:
+                self.map.close ()
+            except BufferError:
+                # views returned by read_view() are still alive,
+                #   the mapping is released when they are
+                pass
+            self.map = None
+
         self.fh.close ()
         Stream.close (self)
 
     def seek (self, offset):
+        if self.buffer is not None:
+            return Stream.seek (self, offset)
+
         self.fh.seek (offset)
 
-    def read (self, size=-1):
-        # FIXME: do some caching/buffering here?
+    def tell (self):
+        if self.buffer is not None:
+            return Stream.tell (self)
 
-        #if size == None:
-        #   raise RuntimeError ()
+        return self.fh.tell ()
+
+    def read (self, size=-1):
+        if self.buffer is not None:
+            return Stream.read (self, size)
 
         if self.get_option ('stream.debug_coverage'):
             off = self.fh.tell ()
@@ -411,7 +575,7 @@ class FileStream (Stream):
         #if size != None:
         #    self.fh.write (bytes, size)
         #else:
-        if type(bytes) == type(""):
+        if type(bytes) == type(u""):
             self.fh.write (bytes.encode())
         else:
             self.fh.write (bytes)
@@ -435,29 +599,95 @@ class MemoryStream (Stream):
         for i in range (len (self.buffer)):
             print(chr (ord (self.buffer[i]) ^ ord (core.xor_key[i])))
 
-    def seek (self, offset):
-        self.offset = offset
-
-    def read (self, count=-1):
-        if count >= 0:
-            data = self.buffer[self.offset:self.offset+count]
+    def write (self, bytes, count=-1):
+        if count != -1:
+            bytes = bytes[:count]
+        buffer = self.buffer
+        start = self.offset
+        end = start + len (bytes)
+        if start > len (buffer):
+            buffer.extend (b'\0' * (start - len (buffer)))
+        if start == len (buffer):
+            # bytearray grows in amortised constant time
+            buffer.extend (bytes)
         else:
-            data = self.buffer[self.offset:]
+            buffer[start:end] = bytes
+        self.offset = end
 
-        self.offset = self.offset + len (data)
-        return data
+    def pack_into (self, st, offset, *values):
+        # offset == None means "current offset" here
+        if offset is None:
+            offset = self.offset
+        if not isinstance (self.buffer, bytearray) or offset + st.size > len (self.buffer):
+            return Stream.pack_into (self, st, offset, *values)
+        st.pack_into (self.buffer, offset, *values)
+        self.offset = offset + st.size
 
-    def write (self, bytes, count=-1):
-        if count == -1:
-            count = len(bytes)
-        end = len (self.buffer) - (self.offset + len (bytes))
-        if end  < 0:
-            self.buffer.extend ([0] * -end)
+    def __repr__ (self):
+        return "<MemoryStream: %s at 0x%08x>" %(self.name, id (self))
+
+
+class WriteStream (MemoryStream):
+    """Stream for writing files into memory.
+
+    The data are written into a bytearray allocated ahead, whose first
+    `self.size' bytes are used. When a write goes past its end, the buffer
+    is grown to at least double its size. Structures are packed straight
+    into it (see pack_into ()) and formats knowing the size of the file up
+    front can allocate it at once with reserve (). getvalue () returns the
+    data written."""
 
-        self.buffer[self.offset:self.offset + len(self.buffer)] = bytes[:count]
+    def __init__ (self):
+        MemoryStream.__init__ (self)
+        self.size = 0
+
+    def open (self, size = 0, name = '?'):
+        MemoryStream.open (self, bytearray (size), name)
+        self.size = 0
+        return self
+
+    def reserve (self, size):
+        capacity = len (self.buffer)
+        if size > capacity:
+            self.buffer.extend (b'\0' * (max (size, 2 * capacity) - capacity))
+
+    def read (self, count=-1):
+        if count < 0 or self.offset + count > self.size:
+            count = max (self.size - self.offset, 0)
+        return MemoryStream.read (self, count)
+
+    def write (self, bytes, count=-1):
+        if count != -1:
+            bytes = bytes[:count]
+        if isinstance (bytes, unicode):
+            bytes = bytes.encode ()
+        end = self.offset + len (bytes)
+        if end > len (self.buffer):
+            self.reserve (end)
+        self.buffer[self.offset:end] = bytes
+        self.offset = end
+        if end > self.size:
+            self.size = end
+
+    def pack_into (self, st, offset, *values):
+        # offset == None means "current offset" here
+        if offset is None:
+            offset = self.offset
+        end = offset + st.size
+        if end > len (self.buffer):
+            self.reserve (end)
+        st.pack_into (self.buffer, offset, *values)
+        self.offset = end
+        if end > self.size:
+            self.size = end
+
+    def getvalue (self):
+        """Return the data written as a string."""
+        del self.buffer[self.size:]
+        return str (self.buffer)
 
     def __repr__ (self):
-        return "<MemoryStream: %s at 0x%08x>" %(self.name, id (self))
+        return "<WriteStream: %s at 0x%08x>" %(self.name, id (self))
 
 
 class ResourceStream (MemoryStream):
@@ -474,9 +704,7 @@ class ResourceStream (MemoryStream):
         if core.keys is None:
             raise RuntimeError("Core game files are not loaded. See load_game ().")
 
-        oo = core.keys.get_resref_by_name (self.resref)
-        if self.type is not None:
-            oo = filter (lambda o: o['type'] == self.type, oo)
+        oo = core.keys.get_resref_by_name_and_type (self.resref, self.type)
 
         if len (oo) > 1 and self.type is None:
             raise RuntimeError(name + ": more than one result, types " + ' '.join([ str(o['type']) for o in oo ]))
@@ -493,34 +721,8 @@ class ResourceStream (MemoryStream):
         # The object was not found in the filesystem, so look for it in BIF archives.
         # Lookup the BIF archive file containing the object
         src_file = core.keys.bif_list[o['locator_src_ndx']]
-        use_cache = core.get_option ('use_cache')
-        if src_file['file_name'] in core.bif_files:
-            # FIXME: convert to uppercase?
-            b, bif_stream = core.bif_files[src_file['file_name']]
-        else:
-            bif_file = core.find_file (src_file['file_name'])
-            if bif_file is None:
-                bif_file = os.path.splitext (src_file['file_name'])[0] + '.cbf'
-                bif_file = core.find_file (bif_file)
+        buffer = read_bif_resource (src_file['file_name'], o)
 
-            if bif_file is None:
-                raise IOError ("Archive not found in path: %s" %src_file['file_name'])
-
-            bif_stream = FileStream ().open (bif_file)
-            b = bif_stream.get_format()()
-            b.read (bif_stream)
-
-            if use_cache:
-                core.bif_files[src_file['file_name']] = (b, bif_stream)
-
-        if o['type'] != 0x3eb:  # TIS
-            obj = b.file_list[o['locator_ntset_ndx']]
-        else:
-            obj = b.file_list[o['locator_tset_ndx']]
-
-        b.get_file_data (bif_stream, obj)
-
-        buffer = obj['data']
         return MemoryStream.open (self, buffer,  name = name)
 
     def load_object (self):
@@ -529,6 +731,79 @@ class ResourceStream (MemoryStream):
     def __repr__ (self):
         return "<ResourceStream: %s at 0x%08x>" %(self.resref, id (self))
 
+def find_bif_file (file_name):
+    """Return path of BIF file `file_name' listed in the KEY file, or of its
+    compressed .cbf variant."""
+    bif_file = core.find_file (file_name)
+    if bif_file is None:
+        bif_file = os.path.splitext (file_name)[0] + '.cbf'
+        bif_file = core.find_file (bif_file)
+
+    if bif_file is None:
+        raise IOError ("Archive not found in path: %s" %file_name)
+
+    return bif_file
+
+def read_bif (file_name, bif_file = None):
+    """Open BIF file `file_name' listed in the KEY file and read its file
+    tables. Return the BIF format object and the open stream.
+
+    File tables restored from a snapshot are used when available. If the
+    path `bif_file' is not given, it's looked up by find_bif_file()."""
+    if file_name in core.bif_tables:
+        path, b = core.bif_tables[file_name]
+        if bif_file is None or os.path.abspath (bif_file) == path:
+            return b, FileStream ().open (path)
+
+    if bif_file is None:
+        bif_file = find_bif_file (file_name)
+
+    bif_stream = FileStream ().open (bif_file)
+    b = bif_stream.get_format()()
+    b.read (bif_stream)
+    return b, bif_stream
+
+def read_bif_resource (file_name, resref, bif_file = None):
+    """Return data of KEY record `resref' stored in BIF file `file_name',
+    found at path `bif_file' or by find_bif_file(). Open BIF files are
+    kept in core.bif_files if option use_cache is set."""
+    use_cache = core.get_option ('use_cache')
+    cache = core.bif_files
+    cache.set_limits (core.get_option ('cache.bif.max_count'),
+                      core.get_option ('cache.bif.max_size'),
+                      core.get_option ('cache.bif.max_files'))
+
+    # FIXME: convert to uppercase?
+    bif = use_cache and cache.get (file_name)
+    if bif:
+        b, bif_stream = bif
+    else:
+        b, bif_stream = read_bif (file_name, bif_file)
+
+        files = 1
+        if b.has_all_data ():
+            # e.g. CBF files are decompressed whole, no need to keep them open
+            bif_stream.close ()
+            files = 0
+
+        if use_cache:
+            cache.add (file_name, (b, bif_stream), b.get_data_size (), files)
+
+    obj = get_bif_record (b, resref)
+    buffer = b.read_file_data (bif_stream, obj)
+    if not use_cache:
+        bif_stream.close ()
+
+    return buffer
+
+def get_bif_record (b, resref):
+    """Return record of BIF `b' holding data of KEY record `resref'."""
+    if resref['type'] != 0x3eb:  # TIS
+        return b.file_list[resref['locator_ntset_ndx']]
+    else:
+        return b.file_list[resref['locator_tset_ndx']]
+
+
 class OverrideStream (MemoryStream):
     """A subclass of MemoryStream for looking up data in the override directory."""
 
@@ -539,7 +814,7 @@ class OverrideStream (MemoryStream):
         self.resref = name
         self.type = core.ext_to_type(filetype)
 
-        if not core.override:
+        if core.override is None:
             raise RuntimeError("Override is empty.")
 
         obj = core.search_override (self.resref, self.type)
@@ -565,19 +840,223 @@ class OverrideStream (MemoryStream):
         return "<OverrideStream: %s at 0x%08x>" %(self.resref, id (self))
 
 class CompressedStream (MemoryStream):
-    """Stream for reading compressed files in memory."""
+    """Stream for reading compressed files in memory.
+
+    The data are decompressed incrementally, only as far as the reads
+    get. Decompressed data are retained, so that they can be read again,
+    unless the stream.compressed.max_retained option limits their size,
+    in which case the data before the current offset are dropped and
+    decompressed again if needed. When everything was decompressed and
+    retained, the stream reads from `self.buffer' like a MemoryStream."""
+
+    # bytes of compressed data decompressed at once
+    chunk_size = 64 * 1024
 
     def open (self, membuffer,  name = '?'):
-        if membuffer:
-            return MemoryStream.open (self, gzip.zlib.decompress (membuffer),  name)
+        MemoryStream.open (self, None,  name)
+        self.data = membuffer or ''
+        self.max_retained = self.get_option ('stream.compressed.max_retained')
+        self.restart ()
+        return self
+
+    def restart (self):
+        self.dobj = zlib.decompressobj ()
+        # offset of the next compressed data to decompress
+        self.in_offset = 0
+        # retained decompressed data, starting at offset `out_start'
+        self.out = bytearray ()
+        self.out_start = 0
+
+    def inflate (self, start, end):
+        """Decompress data till offset `end' (till the end if negative),
+        retaining data from offset `start' on."""
+        if start < self.out_start:
+            self.restart ()
+
+        while (end < 0 or self.out_start + len (self.out) < end) and self.dobj is not None:
+            if self.in_offset < len (self.data):
+                chunk = self.data[self.in_offset:self.in_offset + self.chunk_size]
+                self.in_offset += len (chunk)
+                self.out += self.dobj.decompress (chunk)
+            else:
+                if not self.is_finished ():
+                    # as zlib.decompress () of the whole data would
+                    raise zlib.error ("Error -5 while decompressing data: incomplete or truncated stream")
+                self.out += self.dobj.flush ()
+                self.dobj = None
+
+            if self.max_retained:
+                self.trim (start)
+
+        if self.dobj is None and self.out_start == 0:
+            # all data are decompressed, read them the usual way
+            self.buffer = str (self.out)
+            self.out = None
+            self.data = None
+
+    def is_finished (self):
+        """Return True if the decompressor reached the end of the zlib stream."""
+        dobj = self.dobj
+        if hasattr (dobj, 'eof'):
+            return dobj.eof
+        if dobj.unused_data:
+            return True
+
+        # data past the end of the stream are put aside in unused_data
+        probe = dobj.copy ()
+        try:
+            probe.decompress ('\0')
+        except zlib.error:
+            return False
+        return probe.unused_data != ''
+
+    def trim (self, start):
+        drop = min (len (self.out) - self.max_retained, start - self.out_start)
+        if drop > 0:
+            del self.out[:drop]
+            self.out_start += drop
+
+    def read (self, count=-1):
+        if self.buffer is None:
+            if count < 0:
+                self.inflate (self.offset, -1)
+            else:
+                self.inflate (self.offset, self.offset + count)
+
+        if self.buffer is not None:
+            return MemoryStream.read (self, count)
 
+        start = self.offset - self.out_start
+        if count < 0:
+            data = str (self.out[start:])
         else:
-            ms = MemoryStream.open (self, None,  name)
-            #gzip.zlib.compress (ms.buffer)
+            data = str (self.out[start:start + count])
+
+        self.offset = self.offset + len (data)
+        return data
+
+    def read_view (self, count=-1):
+        if self.buffer is None:
+            return self.read (count)
+        return MemoryStream.read_view (self, count)
 
     def __repr__ (self):
         return "<CompressedStream: %s at 0x%08x>" %(self.name, id (self))
 
+def get_block_pool ():
+    """Return pool of threads for decompressing blocks, or None if the
+    format.biff.block_threads option is less than two."""
+    global block_pool, block_pool_pid
+
+    threads = core.get_option ('format.biff.block_threads')
+    if threads < 2:
+        return None
+    # threads of a pool inherited by a forked process don't run in it
+    if block_pool is None or block_pool_pid != os.getpid ():
+        block_pool = ThreadPool (threads)
+        block_pool_pid = os.getpid ()
+    return block_pool
+
+class BlockCompressedStream (Stream):
+    """Stream for reading data compressed in independent zlib blocks, as
+    in BIFC V1.0 files, each block prefixed with its uncompressed and
+    compressed size (DWORDs).
+
+    The block headers are indexed when the stream is opened, and a read
+    decompresses only the blocks covering the bytes read. Several blocks
+    are decompressed in a thread pool (see get_block_pool ()) and the
+    last format.biff.block_cache_size blocks are kept decompressed."""
+
+    def __init__ (self):
+        Stream.__init__ (self)
+        self.stream = None
+        # uncompressed offsets of the blocks, for bisection
+        self.starts = []
+        # (uncompressed size, compressed data offset, compressed size)
+        self.blocks = []
+        self.size = 0
+        self.cache = None
+
+    def open (self, stream, offset, size = None, name = '?'):
+        """Open the blocks found in `stream' from `offset' on, till `size'
+        bytes of uncompressed data or the end of the stream."""
+        Stream.open (self, name, '')
+        self.stream = stream
+        self.offset = 0
+        self.cache = Cache (max_count = max (1, self.get_option ('format.biff.block_cache_size')))
+
+        pos = 0
+        while size is None or pos < size:
+            header = stream.read_blob (offset, block_header_struct.size)
+            if len (header) < block_header_struct.size:
+                break
+
+            usize, csize = block_header_struct.unpack (header)
+            self.starts.append (pos)
+            self.blocks.append ((usize, offset + block_header_struct.size, csize))
+            pos += usize
+            offset += block_header_struct.size + csize
+
+        self.size = pos
+        return self
+
+    def close (self):
+        if not self.is_open:
+            return
+
+        # the compressed stream belongs to the caller
+        self.stream = None
+        self.cache = None
+        Stream.close (self)
+
+    def get_blocks (self, first, last):
+        """Return list of decompressed blocks `first' to `last'."""
+        datas = {}
+        missing = []
+        for i in range (first, last + 1):
+            data = self.cache.get (i)
+            if data is None:
+                missing.append (i)
+            else:
+                datas[i] = data
+
+        if missing:
+            compressed = [ self.stream.read_blob (self.blocks[i][1], self.blocks[i][2]) for i in missing ]
+            # small reads aren't worth handing over to the threads
+            size = sum ([ self.blocks[i][0] for i in missing ])
+            pool = len (missing) > 1 and size >= 256 * 1024 and get_block_pool ()
+            if pool:
+                # zlib releases the GIL while decompressing
+                decompressed = pool.map (zlib.decompress, compressed)
+            else:
+                decompressed = map (zlib.decompress, compressed)
+
+            for i, data in zip (missing, decompressed):
+                datas[i] = data
+                self.cache.add (i, data, len (data))
+
+        return [ datas[i] for i in range (first, last + 1) ]
+
+    def read (self, count=-1):
+        start = min (self.offset, self.size)
+        if count < 0:
+            end = self.size
+        else:
+            end = min (start + count, self.size)
+        if end <= start:
+            return ''
+
+        first = bisect.bisect_right (self.starts, start) - 1
+        last = bisect.bisect_right (self.starts, end - 1) - 1
+        data = ''.join (self.get_blocks (first, last))
+
+        base = self.starts[first]
+        self.offset = end
+        return data[start - base:end - base]
+
+    def __repr__ (self):
+        return "<BlockCompressedStream: %s at 0x%08x>" %(self.name, id (self))
+
 class DecryptedStream (Stream):
     def __init__ (self, stream):
         Stream.__init__ (self)
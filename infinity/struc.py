@@ -0,0 +1,795 @@
+# -*-python-*-
+# ie_shell.py - Simple shell for Infinity Engine-based game files
+# Copyright (C) 2004-2011 by Jaroslav Benkovsky, <edheldil@users.sf.net>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+
+"""
+Compile structure descriptors into struct.Struct layouts.
+
+Format descriptors (tuples of dicts like `header_desc') are
+interpreted field by field by Format.read_datum and write_datum.
+This module turns a descriptor into a StrucLayout: a single
+struct.Struct covering all fixed-size fields, plus a plan describing
+how to turn the unpacked values into the record dict (RESREF
+stripping, bit fields, arrays, POINT/RECT tuples) and back.
+
+Fields which can't be handled this way (STROFF, STRSIZED, fields
+partially overlapping other fields, unknown types) are left to the
+interpreter and listed in StrucLayout.slow_desc.
+
+Records of big tables can be built as instances of a Record class
+generated for the layout, which keeps the fields in __slots__ instead
+of a dict of its own, but can be used as one (see RecordList.compact()).
+"""
+
+import operator
+import string
+import struct
+
+from infinity import core
+
+
+# type: (struct code, size, number of values per element)
+fixed_types = {
+    'BYTE':    ('B',   1, 1),
+    'WORD':    ('H',   2, 1),
+    'SWORD':   ('h',   2, 1),
+    'DWORD':   ('I',   4, 1),
+    'SDWORD':  ('i',   4, 1),
+    'POINT':   ('HH',  4, 2),
+    'RECT':    ('HHHH', 8, 4),
+    'CTLID':   ('I',   4, 1),
+    'RGBA':    ('I',   4, 1),
+    'STR2':    ('2s',  2, 1),
+    'STR4':    ('4s',  4, 1),
+    'STR8':    ('8s',  8, 1),
+    'STR32':   ('32s', 32, 1),
+    'RESREF':  ('8s',  8, 1),
+    'STRREF':  ('i',   4, 1),
+    'RESTYPE': ('H',   2, 1),
+    }
+
+# Values of these pseudo types are set without reading anything
+const_types = {
+    '_STRING': '',
+    '_BYTE': '?',
+    }
+
+# Ad-hoc descriptors (built on the fly by the caller) would otherwise
+#   make the cache grow forever
+max_cached_layouts = 4096
+layout_cache = {}
+
+
+def bits_to_mask (bits):
+    bh, bl = [ int (b) for b in bits.split ('-') ]
+    if bl > bh:
+        print("warning: bh < bl:", bits)
+        bh, bl = bl, bh
+
+    mask = 0
+    for i in range (bl, bh + 1):
+        mask = mask | (1 << i)
+
+    return mask, bl
+
+
+def to_bytes (value):
+    if isinstance (value, bytes):
+        return value
+    return value.encode ()
+
+
+class StrucLayout (object):
+    """Compiled form of a structure descriptor.
+
+    `struct' decodes all fixed-size fields of a record at once,
+    `size' is the number of bytes it spans and `slow_desc' lists the
+    descriptor entries which have to be interpreted by Format.read_datum
+    and Format.write_datum."""
+
+    def __init__ (self, desc):
+        self.desc = desc
+        self.slow_desc = []
+
+        # filled in lazily by Format.get_struc_size ()
+        self.struc_size = None
+
+        # Record classes keyed by extra keys, see record_class ()
+        self.record_classes = {}
+
+        # offset -> (struct code, size) of primitive slots
+        slots = {}
+        fields = []
+
+        for d in desc:
+            type = d['type']
+
+            if type in const_types:
+                fields.append ((d, None))
+                continue
+
+            if type.startswith ('_'):
+                continue
+
+            if 'off' not in d:
+                self.slow_desc.append (d)
+                continue
+
+            if type == 'BYTES':
+                code, size, nvals = '%ds' %d['size'], d['size'], 1
+            elif type in fixed_types:
+                code, size, nvals = fixed_types[type]
+            else:
+                self.slow_desc.append (d)
+                continue
+
+            count = d.get ('count', 1)
+            codes = self.split_code (code, nvals)
+            elem_size = size // nvals
+            field_slots = []
+            for index in range (count):
+                for j in range (nvals):
+                    field_slots.append ((d['off'] + index * size + j * elem_size, codes[j], elem_size))
+
+            if not self.can_merge (slots, field_slots):
+                self.slow_desc.append (d)
+                continue
+
+            for off, code, elem_size in field_slots:
+                slots[off] = (code, elem_size)
+            fields.append ((d, field_slots))
+
+        # Build the struct, padding the gaps between slots
+        fmt = [ '<' ]
+        index = {}
+        self.runs = []
+        end = 0
+        for off in sorted (slots.keys ()):
+            code, elem_size = slots[off]
+            if off > end:
+                fmt.append ('%dx' %(off - end))
+                self.runs.append ((off, off + elem_size))
+            elif self.runs:
+                self.runs[-1] = (self.runs[-1][0], off + elem_size)
+            else:
+                self.runs.append ((off, off + elem_size))
+            fmt.append (code)
+            index[off] = len (index)
+            end = off + elem_size
+
+        self.struct = struct.Struct (''.join (fmt))
+        self.size = self.struct.size
+        self.nslots = len (index)
+
+        self.build_plan (fields, index)
+
+
+    def split_code (self, code, nvals):
+        if nvals == 1:
+            return [ code ]
+        return list (code)
+
+
+    def can_merge (self, slots, field_slots):
+        """Return True if `field_slots' either match existing slots exactly
+        or do not overlap any of them."""
+        for off, code, size in field_slots:
+            if off in slots:
+                if slots[off] != (code, size):
+                    return False
+                continue
+
+            for off2, (code2, size2) in slots.items ():
+                if off < off2 + size2 and off2 < off + size:
+                    return False
+
+        return True
+
+
+    def build_plan (self, fields, index):
+        # Simple fields are scalar values copied to the record unchanged,
+        #   the rest needs some post-processing
+        simple_keys = []
+        simple_ndx = []
+        self.plan = []
+        self.consts = []
+
+        # slots written from a plain (not bit field) value and
+        #   slots holding strings
+        self.plain_slots = set ()
+        self.str_slots = []
+
+        for d, field_slots in fields:
+            key = d['key']
+            type = d['type']
+
+            if field_slots is None:
+                self.consts.append ((key, const_types[type]))
+                continue
+
+            count = d.get ('count', 1)
+            ndx = [ index[off] for off, code, size in field_slots ]
+
+            if 'bits' in d:
+                mask, bl = bits_to_mask (d['bits'])
+            else:
+                mask, bl = None, 0
+
+            if type in ('STR2', 'STR4', 'STR8', 'STR32', 'RESREF', 'BYTES'):
+                self.str_slots.extend (ndx)
+
+            if count == 1 and mask is None and type not in ('RESREF', 'POINT', 'RECT'):
+                simple_keys.append (key)
+                simple_ndx.append (ndx[0])
+                self.plain_slots.add (ndx[0])
+                continue
+
+            if mask is None:
+                self.plain_slots.update (ndx)
+
+            self.plan.append ((key, type, count, ndx, mask, bl))
+
+        self.simple_keys = simple_keys
+        self.simple_ndx = simple_ndx
+        self.field_ndx = dict (zip (simple_keys, simple_ndx))
+        if len (simple_ndx) > 1:
+            self.simple_getter = operator.itemgetter (*simple_ndx)
+            self.simple_key_getter = operator.itemgetter (*simple_keys)
+        elif simple_ndx:
+            self.simple_getter = lambda values, i=simple_ndx[0]: (values[i], )
+            self.simple_key_getter = lambda obj, key=simple_keys[0]: (obj[key], )
+        else:
+            self.simple_getter = lambda values: ()
+            self.simple_key_getter = lambda obj: ()
+
+        # simple fields take the first slots in order, so pack () can
+        #   start with them
+        self.simple_first = simple_ndx == range (len (simple_ndx))
+
+
+    def unpack (self, values, obj):
+        """Fill record dict `obj' from the `values' unpacked by self.struct"""
+        if getattr (obj, '_layout', None) is self:
+            obj._fill_simple (self.simple_getter (values))
+        else:
+            obj.update (zip (self.simple_keys, self.simple_getter (values)))
+
+        for key, value in self.consts:
+            obj[key] = value
+
+        for key, type, count, ndx, mask, bl in self.plan:
+            if type == 'POINT':
+                items = [ (values[ndx[i]], values[ndx[i + 1]]) for i in range (0, len (ndx), 2) ]
+            elif type == 'RECT':
+                items = [ tuple ([ values[j] for j in ndx[i:i + 4] ]) for i in range (0, len (ndx), 4) ]
+            else:
+                items = [ values[i] for i in ndx ]
+                if type == 'RESREF':
+                    items = [ string.translate (v, core.slash_trans, '\x00') for v in items ]
+                if mask is not None:
+                    items = [ (v & mask) >> bl for v in items ]
+
+            if count > 1:
+                obj[key] = items
+            else:
+                obj[key] = items[0]
+
+
+    def getter (self, key):
+        """Return function decoding field `key' from the values unpacked
+        by self.struct, without building the whole record."""
+        if key in self.field_ndx:
+            return operator.itemgetter (self.field_ndx[key])
+
+        for key2, type, count, ndx, mask, bl in self.plan:
+            if key2 == key and count == 1 and type not in ('RESREF', 'POINT', 'RECT'):
+                if mask is None:
+                    return operator.itemgetter (ndx[0])
+                return lambda values, i=ndx[0], mask=mask, bl=bl: (values[i] & mask) >> bl
+            if key2 == key and count == 1 and type == 'RESREF':
+                return lambda values, i=ndx[0]: string.translate (values[i], core.slash_trans, '\x00')
+
+        obj = {}
+        def decode (values):
+            self.unpack (values, obj)
+            return obj[key]
+        return decode
+
+
+    def keys (self):
+        """Return list of keys of the records filled by unpack ()"""
+        keys = self.simple_keys + [ key for key, value in self.consts ] + [ p[0] for p in self.plan ]
+        res = []
+        for key in keys:
+            if key not in res:
+                res.append (key)
+        return res
+
+
+    def record_class (self, extra_keys = ()):
+        """Return Record subclass with slots for the record's offset, the fields
+        of the layout and `extra_keys', e.g. keys set by a RecordList's finish."""
+        extra_keys = tuple (extra_keys)
+        try:
+            return self.record_classes[extra_keys]
+        except KeyError:
+            pass
+
+        keys = [ '_offset' ]
+        for key in self.keys () + list (extra_keys):
+            if key not in keys:
+                keys.append (key)
+
+        # keys need not be identifiers, so slots are just numbered
+        slot_of = dict ([ (key, 's%d' %i) for i, key in enumerate (keys) ])
+
+        # set and get the simple fields at once, see unpack () and pack ()
+        namespace = {}
+        if self.simple_keys:
+            targets = ''.join ([ 'self.%s, ' %slot_of[key] for key in self.simple_keys ])
+            exec 'def fill (self, values):\n    %s= values\n' %targets in namespace
+            exec 'def get (self):\n    return %s\n' %targets in namespace
+        else:
+            exec 'def fill (self, values):\n    pass\n' in namespace
+            exec 'def get (self):\n    return ()\n' in namespace
+
+        cls = type ('Record', (Record, ), {
+            '__slots__': tuple ([ slot_of[key] for key in keys ]),
+            '_keys': tuple (keys),
+            '_slot_of': slot_of,
+            '_layout': self,
+            '_fill_simple': namespace['fill'],
+            '_get_simple': namespace['get'],
+            })
+        self.record_classes[extra_keys] = cls
+        return cls
+
+
+    def pack (self, obj):
+        """Return list of values for self.struct taken from record dict `obj'"""
+        if getattr (obj, '_layout', None) is self:
+            try:
+                simple = obj._get_simple ()
+            except AttributeError:
+                # a field was deleted
+                raise KeyError ("record field missing")
+        else:
+            simple = self.simple_key_getter (obj)
+
+        if self.simple_first:
+            values = list (simple)
+            values.extend ([ 0 ] * (self.nslots - len (values)))
+        else:
+            values = [ 0 ] * self.nslots
+            for i, value in zip (self.simple_ndx, simple):
+                values[i] = value
+
+        for key, type, count, ndx, mask, bl in self.plan:
+            if count > 1:
+                items = obj[key]
+            else:
+                items = [ obj[key] ]
+
+            if mask is not None:
+                # bit fields are combined, unless a plain field
+                #   at the same offset provides the whole value
+                if ndx[0] not in self.plain_slots:
+                    for i, v in zip (ndx, items):
+                        values[i] = values[i] | ((v << bl) & mask)
+                continue
+
+            if type in ('POINT', 'RECT'):
+                items = [ v for item in items for v in item ]
+
+            for i, v in zip (ndx, items):
+                values[i] = v
+
+        for i in self.str_slots:
+            values[i] = to_bytes (values[i])
+
+        return values
+
+
+class Record (object):
+    """Base of the compact record classes built by StrucLayout.record_class().
+
+    Values of the keys known to the class are stored in slots, any other
+    keys in a dict created when first needed. Records behave like dicts
+    as far as the formats use them, and are pickled as plain dicts."""
+
+    __slots__ = ('_extra', )
+    _keys = ()
+    _slot_of = {}
+    _layout = None
+
+    # dicts are unhashable as well
+    __hash__ = None
+
+    def __init__ (self, *args, **kw):
+        self._extra = None
+        if args or kw:
+            self.update (*args, **kw)
+
+    def __getitem__ (self, key):
+        slot = self._slot_of.get (key)
+        if slot is not None:
+            try:
+                return getattr (self, slot)
+            except AttributeError:
+                raise KeyError (key)
+        if self._extra is None:
+            raise KeyError (key)
+        return self._extra[key]
+
+    def __setitem__ (self, key, value):
+        slot = self._slot_of.get (key)
+        if slot is not None:
+            setattr (self, slot, value)
+        elif self._extra is None:
+            self._extra = { key: value }
+        else:
+            self._extra[key] = value
+
+    def __delitem__ (self, key):
+        slot = self._slot_of.get (key)
+        if slot is not None:
+            try:
+                delattr (self, slot)
+            except AttributeError:
+                raise KeyError (key)
+        elif self._extra is None:
+            raise KeyError (key)
+        else:
+            del self._extra[key]
+
+    def __contains__ (self, key):
+        slot = self._slot_of.get (key)
+        if slot is not None:
+            return hasattr (self, slot)
+        return self._extra is not None and key in self._extra
+
+    has_key = __contains__
+
+    def __iter__ (self):
+        for key in self._keys:
+            if hasattr (self, self._slot_of[key]):
+                yield key
+        if self._extra is not None:
+            for key in list (self._extra):
+                yield key
+
+    iterkeys = __iter__
+
+    def __len__ (self):
+        # not len (self.keys ()), list () asks __len__ for a length hint
+        count = 0
+        for key in self._keys:
+            if hasattr (self, self._slot_of[key]):
+                count += 1
+        if self._extra is not None:
+            count += len (self._extra)
+        return count
+
+    def keys (self):
+        return [ key for key in self ]
+
+    def itervalues (self):
+        for key in self:
+            yield self[key]
+
+    def values (self):
+        return list (self.itervalues ())
+
+    def iteritems (self):
+        for key in self:
+            yield key, self[key]
+
+    def items (self):
+        return list (self.iteritems ())
+
+    def get (self, key, default = None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def setdefault (self, key, default = None):
+        try:
+            return self[key]
+        except KeyError:
+            self[key] = default
+            return default
+
+    def pop (self, key, *default):
+        try:
+            value = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[key]
+        return value
+
+    def update (self, *args, **kw):
+        for other in args + (kw, ):
+            if hasattr (other, 'keys'):
+                for key in other.keys ():
+                    self[key] = other[key]
+            else:
+                for key, value in other:
+                    self[key] = value
+
+    def copy (self):
+        return dict (self.iteritems ())
+
+    def __eq__ (self, other):
+        if isinstance (other, (dict, Record)):
+            return dict (self.iteritems ()) == dict (other.iteritems ())
+        return NotImplemented
+
+    def __ne__ (self, other):
+        res = self.__eq__ (other)
+        if res is NotImplemented:
+            return res
+        return not res
+
+    def __repr__ (self):
+        return repr (dict (self.iteritems ()))
+
+    def __reduce__ (self):
+        # the classes are generated, so save it as a plain dict
+        return (dict, (dict (self.iteritems ()), ))
+
+
+def unpack_table (layout, buffer, offset, count, stride):
+    """Return list of value tuples of `count' records `stride' bytes apart"""
+    st = layout.struct
+    if stride == layout.size and hasattr (st, 'iter_unpack'):
+        return list (st.iter_unpack (memoryview (buffer)[offset:offset + count * stride]))
+
+    unpack_from = st.unpack_from
+    return [ unpack_from (buffer, off) for off in range (offset, offset + count * stride, stride) ]
+
+
+class PackedTable (object):
+    """Values of `count' records packed in `buffer' from `offset' on,
+    `stride' bytes apart, unpacked only when accessed.
+
+    It can stand for the list of value tuples of a RecordList, keeping
+    big tables at the size of their binary form."""
+
+    def __init__ (self, layout, buffer, offset, count, stride):
+        self.layout = layout
+        self.buffer = buffer
+        self.offset = offset
+        self.count = count
+        self.stride = stride
+        # values set by the RecordList (None once a record is decoded)
+        self.changed = {}
+
+    def __len__ (self):
+        return self.count
+
+    def __getitem__ (self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError ("table index out of range")
+        try:
+            return self.changed[index]
+        except KeyError:
+            return self.layout.struct.unpack_from (self.buffer, self.offset + index * self.stride)
+
+    def __setitem__ (self, index, values):
+        if index < 0:
+            index += self.count
+        self.changed[index] = values
+
+    def __iter__ (self):
+        for i in range (self.count):
+            yield self[i]
+
+
+class RecordList (object):
+    """List of records of a fixed-size table decoded on first access.
+
+    It is filled with value tuples unpacked by the layout's struct and
+    builds the record dict of an item only when the item is accessed.
+    `finish', if given, is called as finish (obj, index) on each newly
+    built record. Operations shifting the items (insert, delete, sort...)
+    decode all remaining records first. `values' may be a PackedTable
+    instead of a list."""
+
+    def __init__ (self, layout, values, offset, stride, finish = None):
+        self.layout = layout
+        self.values = values
+        self.items = [ None ] * len (values)
+        self.offset = offset
+        self.stride = stride
+        self.finish = finish
+        # explicit record offsets, once some records were filtered out
+        self.offsets = None
+        # class of the records if not dicts, see compact ()
+        self.record_class = None
+
+    def compact (self, extra_keys = ()):
+        """Build the records as instances of the layout's Record class with
+        slots for `extra_keys' too, instead of dicts, if the
+        format.compact_records option is on. Must be called before any
+        record is accessed."""
+        if core.get_option ('format.compact_records'):
+            self.record_class = self.layout.record_class (extra_keys)
+
+    def filter_values (self, fn):
+        """Drop records whose unpacked values don't satisfy `fn', without
+        decoding them. Must be called before any record is accessed."""
+        if self.offsets is None:
+            self.offsets = [ self.offset + i * self.stride for i in range (len (self.values)) ]
+
+        keep = [ i for i, values in enumerate (self.values) if fn (values) ]
+        self.values = [ self.values[i] for i in keep ]
+        self.offsets = [ self.offsets[i] for i in keep ]
+        self.items = [ None ] * len (self.values)
+
+    def decode (self, index):
+        if self.record_class is not None:
+            obj = self.record_class ()
+        else:
+            obj = {}
+        if self.offsets is not None:
+            obj['_offset'] = self.offsets[index]
+        else:
+            obj['_offset'] = self.offset + index * self.stride
+        self.layout.unpack (self.values[index], obj)
+        if self.finish is not None:
+            self.finish (obj, index)
+        self.items[index] = obj
+        # the dict is the master copy from now on
+        self.values[index] = None
+        return obj
+
+    def decode_all (self):
+        for i in range (len (self.items)):
+            if self.items[i] is None and self.values[i] is not None:
+                self.decode (i)
+        if not isinstance (self.values, list):
+            self.values = [ None ] * len (self.items)
+
+    def is_decoded (self, index):
+        return self.values[index] is None
+
+    def column (self, key):
+        """Return list of field `key' of all the records. Records not
+        accessed yet are not built, only the field is decoded."""
+        get = self.layout.getter (key)
+        return [ get (values) if obj is None else obj[key] for obj, values in zip (self.items, self.values) ]
+
+    def __len__ (self):
+        return len (self.items)
+
+    def __getitem__ (self, index):
+        if isinstance (index, slice):
+            return [ self[i] for i in range (*index.indices (len (self.items))) ]
+
+        obj = self.items[index]
+        if obj is None and self.values[index] is not None:
+            if index < 0:
+                index += len (self.items)
+            obj = self.decode (index)
+        return obj
+
+    def __setitem__ (self, index, obj):
+        if isinstance (index, slice):
+            self.decode_all ()
+            obj = list (obj)
+            self.items[index] = obj
+            self.values[index] = [ None ] * len (obj)
+            return
+
+        self.items[index] = obj
+        self.values[index] = None
+
+    def __delitem__ (self, index):
+        self.decode_all ()
+        del self.items[index]
+        del self.values[index]
+
+    def __iter__ (self):
+        i = 0
+        while i < len (self.items):
+            yield self[i]
+            i += 1
+
+    def __contains__ (self, obj):
+        return obj in iter (self)
+
+    def __eq__ (self, other):
+        return list (self) == list (other)
+
+    def __ne__ (self, other):
+        return not self == other
+
+    def __add__ (self, other):
+        return list (self) + list (other)
+
+    def __repr__ (self):
+        return repr (list (self))
+
+    def __reduce__ (self):
+        # structs can't be pickled, so save it as a plain list
+        return (list, (list (self), ))
+
+    def append (self, obj):
+        if not isinstance (self.values, list):
+            self.values = list (self.values)
+        self.items.append (obj)
+        self.values.append (None)
+
+    def extend (self, objs):
+        for obj in objs:
+            self.append (obj)
+
+    def insert (self, index, obj):
+        self.decode_all ()
+        self.items.insert (index, obj)
+        self.values.insert (index, None)
+
+    def pop (self, index = -1):
+        obj = self[index]
+        del self[index]
+        return obj
+
+    def remove (self, obj):
+        del self[self.index (obj)]
+
+    def index (self, obj):
+        for i, obj2 in enumerate (self):
+            if obj2 is obj or obj2 == obj:
+                return i
+        raise ValueError ("record not in list")
+
+    def count (self, obj):
+        return len ([ obj2 for obj2 in self if obj2 == obj ])
+
+    def sort (self, *args, **kw):
+        self.decode_all ()
+        self.items.sort (*args, **kw)
+
+    def reverse (self):
+        self.decode_all ()
+        self.items.reverse ()
+
+
+def compile_struc (desc):
+    """Return StrucLayout for descriptor `desc', compiling it on first use"""
+    try:
+        layout = layout_cache[id (desc)]
+        if layout.desc is desc:
+            return layout
+    except KeyError:
+        pass
+
+    if len (layout_cache) >= max_cached_layouts:
+        layout_cache.clear ()
+
+    layout = StrucLayout (desc)
+    layout_cache[id (desc)] = layout
+    return layout
+
+
+# End of file struc.py
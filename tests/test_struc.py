@@ -0,0 +1,84 @@
+# -*-python-*-
+# ie_shell.py - Simple shell for Infinity Engine-based game files
+# Copyright (C) 2004-2011 by Jaroslav Benkovsky, <edheldil@users.sf.net>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+# Run with `python -m unittest discover tests' from the top directory.
+
+import copy
+import cPickle
+import unittest
+
+from infinity.struc import compile_struc
+
+
+desc = (
+    { 'key': 'name', 'type': 'RESREF', 'off': 0x0000, 'label': 'name' },
+    { 'key': 'type', 'type': 'WORD', 'off': 0x0008, 'label': 'type' },
+    { 'key': 'locator', 'type': 'DWORD', 'off': 0x000A, 'label': 'locator' },
+    )
+
+
+class RecordTest (unittest.TestCase):
+    def setUp (self):
+        layout = compile_struc (desc)
+        cls = layout.record_class (('file_name', ))
+        self.rec = cls ()
+        self.rec.update ({ 'name': 'SWORD01', 'type': 0x3ed, 'locator': 12 })
+        self.rec['file_name'] = 'data/items.bif'
+        self.rec['extra'] = 1
+        self.expected = { 'name': 'SWORD01', 'type': 0x3ed, 'locator': 12,
+                          'file_name': 'data/items.bif', 'extra': 1 }
+
+    def test_dict_protocol (self):
+        rec = self.rec
+        self.assertEqual (sorted (rec.keys ()), sorted (self.expected.keys ()))
+        self.assertEqual (len (rec), len (self.expected))
+        self.assertTrue (rec)
+        self.assertEqual (dict (rec), self.expected)
+        self.assertEqual (sorted (rec), sorted (self.expected))
+
+        d = {}
+        d.update (rec)
+        self.assertEqual (d, self.expected)
+
+        def fn (**kw):
+            return kw
+        self.assertEqual (fn (**rec), self.expected)
+
+        self.assertEqual (rec, self.expected)
+        self.assertEqual (rec.copy (), self.expected)
+
+    def test_missing_keys (self):
+        rec = self.rec.__class__ ()
+        self.assertEqual (len (rec), 0)
+        self.assertFalse (rec)
+        self.assertEqual (rec.keys (), [])
+        self.assertRaises (KeyError, lambda: rec['name'])
+
+        del self.rec['locator']
+        self.assertEqual (len (self.rec), len (self.expected) - 1)
+        self.assertFalse ('locator' in self.rec)
+
+    def test_pickle_and_copy (self):
+        for proto in (0, 2):
+            self.assertEqual (cPickle.loads (cPickle.dumps (self.rec, proto)), self.expected)
+        self.assertEqual (copy.copy (self.rec), self.expected)
+        self.assertEqual (copy.deepcopy (self.rec), self.expected)
+
+
+if __name__ == '__main__':
+    unittest.main ()